@@ -0,0 +1,282 @@
+"""
+Memory-budget preflight for fine-tuning.
+
+Before training, one forward/backward step is probed for every candidate
+setting: micro-batch size, gradient checkpointing per layer group (vision
+tower, language model) and max sequence length. Each probe records the peak
+memory and the step time. The fastest setting (samples/s) that fits the budget
+wins. `gradient_accumulation_steps` is adjusted so that `batch_size *
+gradient_accumulation_steps` stays what the config asked for.
+
+On CUDA the peak is `torch.cuda.max_memory_allocated`. On CPU it is estimated
+from the parameters, gradients and the tensors autograd saves for backward, so
+the selection logic can be dry-run anywhere against the tiny model:
+
+    uv run python -m src.street_object_detection.autoconfig --budget-gb 0.5
+"""
+
+import argparse
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import torch
+from PIL import Image
+
+CHECKPOINT_GROUPS = {
+    "none": (),
+    "vision": ("vision",),
+    "language": ("language",),
+    "all": ("vision", "language"),
+}
+# Optimizer state bytes per trainable parameter
+OPTIMIZER_STATE_BYTES = {"adamw_8bit": 2, "paged_adamw_8bit": 2, "adamw_torch": 8, "adamw_torch_fused": 8, "sgd": 0}
+
+
+@dataclass
+class ProbeResult:
+    micro_batch_size: int
+    gradient_accumulation_steps: int
+    checkpointing: str
+    max_length: int
+    peak_gb: Optional[float] = None  # None when the probe ran out of memory
+    step_s: Optional[float] = None
+
+    @property
+    def samples_per_s(self) -> float:
+        return self.micro_batch_size / self.step_s if self.step_s else 0.0
+
+
+def checkpointable_layers(model) -> dict[str, list]:
+    """Decoder/encoder layers that support gradient checkpointing, by group."""
+    from transformers.modeling_layers import GradientCheckpointingLayer
+
+    groups = {"vision": [], "language": []}
+    for name, module in model.named_modules():
+        if isinstance(module, GradientCheckpointingLayer):
+            groups["vision" if "vision" in name else "language"].append(module)
+    return groups
+
+
+def apply_gradient_checkpointing(model, mode: str):
+    """
+    Checkpoints only the layer groups of `mode` (see `CHECKPOINT_GROUPS`).
+    Non-reentrant checkpointing, so frozen inputs (LoRA) need no grad hooks.
+    """
+    groups = CHECKPOINT_GROUPS[mode]
+    if not groups:
+        model.gradient_checkpointing_disable()
+        return
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    for group, layers in checkpointable_layers(model).items():
+        if group not in groups:
+            for layer in layers:
+                layer.gradient_checkpointing = False
+
+
+def probe_batch(processor, micro_batch_size: int, max_length: int, device) -> Optional[dict]:
+    """
+    Worst-case training batch: a full-size image and text padded with filler
+    tokens up to `max_length`. None if the image alone is longer than that.
+    """
+    from .data_preparation import build_conversation, get_target_image_edge
+    from .fine_tune import create_collate_fn
+
+    edge = get_target_image_edge(processor)
+    image = Image.new("RGB", (edge, edge), (127, 127, 127))
+    conversation = build_conversation(image, "none", "system", "user")
+    batch = create_collate_fn(processor)([conversation] * micro_batch_size)
+
+    extra = max_length - batch["input_ids"].shape[1]
+    if extra < 0:
+        return None
+    filler = torch.full((micro_batch_size, extra), processor.tokenizer.eos_token_id)
+    batch["input_ids"] = torch.cat([batch["input_ids"], filler], dim=1)
+    batch["labels"] = torch.cat([batch["labels"], filler], dim=1)
+    batch["attention_mask"] = torch.cat([batch["attention_mask"], torch.ones_like(filler)], dim=1)
+    return {k: v.to(device) if hasattr(v, "to") else v for k, v in batch.items()}
+
+
+def _step(model, batch) -> tuple[float, int]:
+    """One forward/backward; returns its time and the bytes saved for backward."""
+    param_ptrs = {p.data_ptr() for p in model.parameters()}
+    saved = 0
+
+    def pack(tensor):
+        nonlocal saved
+        if tensor.data_ptr() not in param_ptrs:
+            saved += tensor.numel() * tensor.element_size()
+        return tensor
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = model(**batch).loss
+    loss.backward()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, saved
+
+
+def probe(model, batch, optimizer_bytes: int, repeats: int = 2) -> tuple[float, float]:
+    """Peak memory (GB) and median step time of the candidate."""
+    model.train()
+    on_cuda = batch["input_ids"].is_cuda
+    if on_cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+    times, saved = [], 0
+    for i in range(repeats + 1):
+        elapsed, saved = _step(model, batch)
+        if i > 0:  # the first step is warmup
+            times.append(elapsed)
+        model.zero_grad(set_to_none=True)
+
+    trainable = [p for p in model.parameters() if p.requires_grad]
+    if on_cuda:
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        params = sum(p.numel() * p.element_size() for p in model.parameters())
+        grads = sum(p.numel() * p.element_size() for p in trainable)
+        peak = params + grads + saved
+    peak += optimizer_bytes * sum(p.numel() for p in trainable)
+    return peak / 1024**3, sorted(times)[len(times) // 2]
+
+
+def run_probes(
+    model,
+    processor,
+    effective_batch_size: int,
+    micro_batch_sizes: list[int],
+    checkpointing_modes: list[str],
+    max_length: int,
+    optimizer_bytes: int,
+) -> list[ProbeResult]:
+    device = next(model.parameters()).device
+    results = []
+    for mode in checkpointing_modes:
+        apply_gradient_checkpointing(model, mode)
+        for micro_batch_size in micro_batch_sizes:
+            if effective_batch_size % micro_batch_size:
+                continue  # would change the effective batch size
+            result = ProbeResult(micro_batch_size, effective_batch_size // micro_batch_size, mode, max_length)
+            batch = probe_batch(processor, micro_batch_size, max_length, device)
+            if batch is None:
+                raise ValueError(f"max_length {max_length} is shorter than one image")
+            try:
+                result.peak_gb, result.step_s = probe(model, batch, optimizer_bytes)
+            except torch.cuda.OutOfMemoryError:
+                model.zero_grad(set_to_none=True)
+                torch.cuda.empty_cache()
+            results.append(result)
+            print(
+                f"  batch={micro_batch_size:<3} accum={result.gradient_accumulation_steps:<3} "
+                f"checkpointing={mode:<9} "
+                + (f"peak {result.peak_gb:6.2f} GB  {result.samples_per_s:7.2f} samples/s"
+                   if result.peak_gb is not None else "OOM")
+            )
+    return results
+
+
+def choose(results: list[ProbeResult], budget_gb: float) -> Optional[ProbeResult]:
+    """Fastest probe within the budget; ties go to the lower peak."""
+    fitting = [r for r in results if r.peak_gb is not None and r.peak_gb <= budget_gb]
+    if not fitting:
+        return None
+    return max(fitting, key=lambda r: (r.samples_per_s, -r.peak_gb))
+
+
+def default_budget_gb(device) -> float:
+    if device.type == "cuda":
+        return 0.9 * torch.cuda.get_device_properties(device).total_memory / 1024**3
+    raise ValueError("Set memory_budget_gb for CPU runs")
+
+
+def required_max_length(dataset, processor, candidates: list[int]) -> int:
+    """Smallest candidate max length that fits the longest training sample."""
+    from .bucketing import compute_sample_lengths
+
+    try:
+        longest = max(compute_sample_lengths(dataset, processor))
+    except TypeError:
+        return max(candidates)  # lengths unknown (e.g. streaming), be safe
+    fitting = [length for length in sorted(candidates) if length >= longest]
+    if not fitting:
+        raise ValueError(f"Longest sample has {longest} tokens, above every max length {candidates}")
+    return fitting[0]
+
+
+def autoconfigure(model, processor, config, train_dataset=None) -> ProbeResult:
+    """
+    Probes the candidates of `config` and writes the winner back into it
+    (`batch_size`, `gradient_accumulation_steps`, `gradient_checkpointing`,
+    `max_seq_length`), leaving the model with that checkpointing applied.
+    """
+    effective = config.batch_size * config.gradient_accumulation_steps
+    max_length = (
+        required_max_length(train_dataset, processor, config.autoconfig_max_lengths)
+        if train_dataset is not None
+        else config.max_seq_length
+    )
+    device = next(model.parameters()).device
+    budget = config.memory_budget_gb or default_budget_gb(device)
+
+    print(f"🧮 Probing memory for an effective batch of {effective}, "
+          f"max length {max_length}, budget {budget:.1f} GB...")
+    results = run_probes(
+        model,
+        processor,
+        effective,
+        config.autoconfig_micro_batch_sizes,
+        config.autoconfig_checkpointing_modes,
+        max_length,
+        OPTIMIZER_STATE_BYTES.get(config.optim, 8),
+    )
+    best = choose(results, budget)
+    if best is None:
+        raise RuntimeError(f"No candidate fits in {budget:.1f} GB, lower max_length or add checkpointing modes")
+
+    print(f"✅ Chosen: batch_size={best.micro_batch_size}, "
+          f"gradient_accumulation_steps={best.gradient_accumulation_steps}, "
+          f"gradient_checkpointing={best.checkpointing}, max_seq_length={best.max_length} "
+          f"({best.peak_gb:.2f} GB, {best.samples_per_s:.2f} samples/s)")
+    config.batch_size = best.micro_batch_size
+    config.gradient_accumulation_steps = best.gradient_accumulation_steps
+    config.gradient_checkpointing = best.checkpointing
+    config.max_seq_length = best.max_length
+    apply_gradient_checkpointing(model, best.checkpointing)
+    return best
+
+
+def main():
+    from types import SimpleNamespace
+
+    from .tiny_model import build_tiny_model_and_processor
+
+    parser = argparse.ArgumentParser(description="Dry-run the fine-tuning memory preflight on the tiny model")
+    parser.add_argument("--budget-gb", type=float, default=0.5)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--gradient-accumulation-steps", type=int, default=2)
+    parser.add_argument("--max-length", type=int, default=256)
+    args = parser.parse_args()
+
+    model, processor = build_tiny_model_and_processor()
+    config = SimpleNamespace(
+        batch_size=args.batch_size,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        memory_budget_gb=args.budget_gb,
+        max_seq_length=args.max_length,
+        autoconfig_micro_batch_sizes=[1, 2, 4, 8],
+        autoconfig_checkpointing_modes=list(CHECKPOINT_GROUPS),
+        autoconfig_max_lengths=[args.max_length],
+        optim="adamw_torch",
+        gradient_checkpointing="all",
+    )
+    best = autoconfigure(model, processor, config)
+    print(asdict(best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""
+Offline CPU benchmark suite.
+
+Times the inference, data and evaluation hot paths against a tiny random
+LFM2-VL (see `tiny_model`), so it runs anywhere without downloads or a GPU.
+Every run is appended to `benchmarks/history.json`; `compare` checks the latest
+run against a saved baseline and exits non-zero on regressions.
+
+    uv run python -m src.street_object_detection.benchmark run
+    uv run python -m src.street_object_detection.benchmark save-baseline
+    uv run python -m src.street_object_detection.benchmark compare --threshold 0.2
+"""
+
+import argparse
+import importlib
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+import torch
+from PIL import Image
+
+from .paths import get_path_to_benchmarks
+from .tiny_model import build_tiny_model_and_processor
+
+BACKEND_DIR = Path(__file__).resolve().parents[3] / "backend"
+
+LABELS = ["red", "green", "zebra", "none"]
+RAW_OUTPUTS = [
+    "red",
+    "The traffic light is green.",
+    "I can see a zebra crossing ahead",
+    "none",
+    "Sorry, I cannot provide that.",
+    "Caution: Car approaching",
+    "Clear: Path is safe",
+    "There is something strange on the path ahead of you that I cannot identify",
+]
+
+
+def time_call(fn: Callable[[], object], repeat: int, warmup: int = 1) -> dict:
+    """Median, p95 and min wall time of `fn` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "median_ms": statistics.median(times),
+        "p95_ms": times[min(len(times) - 1, round(0.95 * (len(times) - 1)))],
+        "min_ms": times[0],
+        "repeat": repeat,
+    }
+
+
+def random_image(rng: random.Random, size=(640, 480)) -> Image.Image:
+    color = tuple(rng.randrange(256) for _ in range(3))
+    return Image.new("RGB", size, color)
+
+
+def conversation(image: Image.Image, answer: str | None = None) -> list[dict]:
+    messages = [
+        {"role": "system", "content": [{"type": "text", "text": "Identify traffic lights and crosswalks."}]},
+        {"role": "user", "content": [{"type": "image", "image": image}, {"type": "text", "text": "Can I cross?"}]},
+    ]
+    if answer is not None:
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": answer}]})
+    return messages
+
+
+def load_backend_server():
+    """Imports `backend/server.py` without starting it (no model is loaded)."""
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
+    return importlib.import_module("server")
+
+
+def run_suite(repeat: int, seed: int = 0) -> dict[str, dict]:
+    from .batching import create_batches
+    from .evaluate import parse_prediction
+    from .fine_tune import create_collate_fn
+    from .inference import get_model_output
+    from .report import EvalReport
+
+    torch.manual_seed(seed)
+    rng = random.Random(seed)
+    model, processor = build_tiny_model_and_processor(seed=seed)
+    image = random_image(rng)
+    results = {}
+
+    print("⏱️  inference.get_model_output")
+    results["inference.get_model_output"] = time_call(
+        lambda: get_model_output(model, processor, conversation(image), max_new_tokens=10),
+        repeat,
+    )
+
+    print("⏱️  server.run_inference_sync")
+    server = load_backend_server()
+    server.models[server.LARGE] = model
+    server.processors[(server.LARGE, "benchmark")] = processor
+    results["server.run_inference_sync"] = time_call(
+        lambda: server.run_inference_sync(
+            image, server.OBSTACLE_PROMPT, server.SAFETY_SYSTEM_PROMPT, "benchmark"
+        ),
+        repeat,
+    )
+
+    print("⏱️  server.clean_model_response")
+    outputs = RAW_OUTPUTS * 125
+    results["server.clean_model_response[1k]"] = time_call(
+        lambda: [
+            server.clean_model_response(text, server.OBSTACLE_LABELS, server.OBSTACLE_FALLBACK)
+            for text in outputs
+        ],
+        repeat * 5,
+    )
+
+    print("⏱️  evaluate.parse_prediction")
+    results["evaluate.parse_prediction[1k]"] = time_call(
+        lambda: [parse_prediction(text) for text in outputs], repeat * 5
+    )
+
+    print("⏱️  batching.create_batches")
+    samples = [
+        {"image": random_image(rng, (64, 64)), "text_label": rng.choice(LABELS)}
+        for _ in range(2000)
+    ]
+    batch_config = SimpleNamespace(
+        image_column="image", label_column="text_label", label_mapping={}, batch_size=8
+    )
+    results["batching.create_batches[2k]"] = time_call(
+        lambda: create_batches(samples, batch_config), repeat * 5
+    )
+
+    print("⏱️  fine_tune.create_collate_fn")
+    collate_fn = create_collate_fn(processor)
+    train_batch = [conversation(random_image(rng), rng.choice(LABELS)) for _ in range(4)]
+    results["fine_tune.collate_fn[batch=4]"] = time_call(lambda: collate_fn(train_batch), repeat)
+
+    print("⏱️  EvalReport")
+    gts = [rng.choice(LABELS) for _ in range(10_000)]
+    preds = [rng.choice(LABELS + ["unknown"]) for _ in range(10_000)]
+
+    def build_report():
+        report = EvalReport()
+        report.add_records(gts, preds)
+        return report
+
+    report = build_report()
+    results["report.add_records[10k]"] = time_call(build_report, repeat)
+    results["report.add_record[1k]"] = time_call(
+        lambda: [EvalReport().add_record(g, p) for g, p in zip(gts[:1000], preds[:1000])],
+        repeat,
+    )
+    results["report.confusion_counts[safety]"] = time_call(
+        lambda: report.confusion_counts("safety"), repeat * 5
+    )
+    results["report.get_accuracy[safety]"] = time_call(
+        lambda: report.get_accuracy("safety"), repeat * 5
+    )
+    results["report.to_arrow[10k]"] = time_call(report.to_arrow, repeat)
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(data, path: Path):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    tmp_path.replace(path)
+
+
+def compare_runs(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Names of benchmarks whose median got slower by more than `threshold`."""
+    regressions = []
+    print(f"{'benchmark':<36} {'baseline ms':>12} {'current ms':>12} {'change':>8}")
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<36} {'-':>12} {result['median_ms']:>12.2f} {'new':>8}")
+            continue
+        change = result["median_ms"] / max(base["median_ms"], 1e-9) - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = " ⚠️"
+        print(
+            f"{name:<36} {base['median_ms']:>12.2f} {result['median_ms']:>12.2f} "
+            f"{change:>+7.1%}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline CPU benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run the suite and append it to the history")
+    run.add_argument("--repeat", type=int, default=10)
+    run.add_argument("--seed", type=int, default=0)
+    sub.add_parser("save-baseline", help="save the latest run as the baseline")
+    compare = sub.add_parser("compare", help="compare the latest run with the baseline")
+    compare.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown")
+    args = parser.parse_args()
+
+    bench_dir = Path(get_path_to_benchmarks())
+    history_path = bench_dir / "history.json"
+    baseline_path = bench_dir / "baseline.json"
+
+    if args.command == "run":
+        entry = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "results": run_suite(args.repeat, args.seed),
+        }
+        history = load_history(history_path)
+        history.append(entry)
+        save_json(history, history_path)
+        for name, result in entry["results"].items():
+            print(f"{name:<36} {result['median_ms']:>9.2f} ms (p95 {result['p95_ms']:.2f})")
+        print(f"📄 Results appended to {history_path}")
+        return
+
+    history = load_history(history_path)
+    if not history:
+        sys.exit("No benchmark runs yet, run `benchmark run` first")
+
+    if args.command == "save-baseline":
+        save_json(history[-1], baseline_path)
+        print(f"💾 Baseline saved from run {history[-1]['timestamp']} ({history[-1]['commit']})")
+        return
+
+    if not baseline_path.exists():
+        sys.exit("No baseline yet, run `benchmark save-baseline` first")
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = compare_runs(baseline, history[-1], args.threshold)
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    print("✅ No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Length-aware batching for SFT, counting image tokens in the sequence length."""
+
+import io
+import math
+from typing import Callable, Iterator, Optional
+
+import torch
+from datasets import Dataset
+from PIL import Image
+from torch.utils.data import Sampler
+
+from .data_preparation import ConversationDataset
+from .vision_cache import VisionFeatureDataset
+
+
+def _round_by_factor(number: float, factor: int) -> int:
+    return round(number / factor) * factor
+
+
+def _grid_layout(width: int, height: int, min_tiles: int, max_tiles: int, tile_size: int) -> tuple[int, int]:
+    """Tile grid (columns, rows) whose aspect ratio is closest to the image's."""
+    ratios = sorted(
+        {
+            (w, h)
+            for n in range(min_tiles, max_tiles + 1)
+            for w in range(1, n + 1)
+            for h in range(1, n + 1)
+            if min_tiles <= w * h <= max_tiles
+        },
+        key=lambda ratio: ratio[0] * ratio[1],
+    )
+    aspect_ratio = width / height
+    best, best_diff = (1, 1), float("inf")
+    for w, h in ratios:
+        diff = abs(aspect_ratio - w / h)
+        if diff < best_diff:
+            best, best_diff = (w, h), diff
+        elif diff == best_diff and width * height > 0.5 * tile_size * tile_size * w * h:
+            best = (w, h)
+    return best
+
+
+def _resized_tokens(width: int, height: int, patch: int, min_tokens: int, max_tokens: int) -> int:
+    """Tokens of a single image after the processor's smart resize."""
+    w_bar = max(patch, _round_by_factor(width, patch))
+    h_bar = max(patch, _round_by_factor(height, patch))
+    if w_bar * h_bar > max_tokens * patch**2:
+        beta = math.sqrt(width * height / (max_tokens * patch**2))
+        w_bar = max(patch, math.floor(width / beta / patch) * patch)
+        h_bar = max(patch, math.floor(height / beta / patch) * patch)
+    elif w_bar * h_bar < min_tokens * patch**2:
+        beta = math.sqrt(min_tokens * patch**2 / (width * height))
+        w_bar = math.ceil(width * beta / patch) * patch
+        h_bar = math.ceil(height * beta / patch) * patch
+    return (w_bar // patch) * (h_bar // patch)
+
+
+def estimate_image_tokens(width: int, height: int, image_processor) -> int:
+    """
+    Tokens the LFM2-VL processor spends on an image, following its rule: an
+    image too large for `max_image_tokens` is split into `tile_size` tiles
+    (plus a downscaled thumbnail with `use_thumbnail`) when image splitting is
+    on, otherwise it is resized to fit the token budget. The image start/end,
+    tile position and thumbnail marker tokens are included.
+    """
+    encoder_patch = getattr(image_processor, "encoder_patch_size", 16)
+    patch = encoder_patch * getattr(image_processor, "downsample_factor", 2)
+    min_tokens = getattr(image_processor, "min_image_tokens", 64)
+    max_tokens = getattr(image_processor, "max_image_tokens", 256)
+    tolerance = getattr(image_processor, "max_pixels_tolerance", 2.0)
+
+    w_bar = max(encoder_patch, _round_by_factor(width, patch))
+    h_bar = max(encoder_patch, _round_by_factor(height, patch))
+    too_large = w_bar * h_bar > max_tokens * patch**2 * tolerance
+
+    if getattr(image_processor, "do_image_splitting", True) and too_large:
+        tile_size = getattr(image_processor, "tile_size", 512)
+        columns, rows = _grid_layout(
+            width,
+            height,
+            getattr(image_processor, "min_tiles", 2),
+            getattr(image_processor, "max_tiles", 10),
+            tile_size,
+        )
+        tiles = columns * rows
+        tokens = tiles * (tile_size // patch) ** 2 + tiles  # one position token per tile
+        if getattr(image_processor, "use_thumbnail", True) and tiles > 1:
+            tokens += _resized_tokens(width, height, patch, min_tokens, max_tokens) + 1
+        return tokens + 2  # image start and end
+
+    return _resized_tokens(width, height, patch, min_tokens, max_tokens) + 2
+
+
+def compute_sample_lengths(dataset, processor) -> list[int]:
+    """
+    Total sequence length of every training sample, image tokens included.
+
+    Pre-tokenized datasets already hold the expanded `input_ids`. For lazy
+    conversations only the image headers are read (no decode) and the text
+    part is tokenized once per distinct label, since the prompts are shared.
+    """
+    if isinstance(dataset, VisionFeatureDataset):
+        dataset = dataset.dataset
+    if isinstance(dataset, Dataset) and "input_ids" in dataset.column_names:
+        return [len(ids) for ids in dataset.with_format(None)["input_ids"]]
+
+    if not isinstance(dataset, ConversationDataset):
+        raise TypeError(f"Cannot compute lengths for {type(dataset).__name__}")
+
+    tokenizer = processor.tokenizer
+    prompt_tokens = len(
+        tokenizer(dataset.system_prompt + dataset.user_prompt)["input_ids"]
+    )
+    label_tokens: dict[str, int] = {}
+
+    lengths = []
+    for batch in dataset.dataset.iter(batch_size=256):
+        for encoded, label in zip(
+            batch[dataset.image_column], batch[dataset.label_column]
+        ):
+            label = dataset.label_mapping.get(label, label)
+            if label not in label_tokens:
+                label_tokens[label] = len(tokenizer(label)["input_ids"])
+
+            if encoded["bytes"] is not None:
+                source = io.BytesIO(encoded["bytes"])
+            else:
+                source = encoded["path"]
+            with Image.open(source) as img:
+                width, height = img.size
+
+            image_tokens = estimate_image_tokens(
+                width, height, processor.image_processor
+            )
+            lengths.append(prompt_tokens + label_tokens[label] + image_tokens)
+    return lengths
+
+
+def check_sample_lengths(dataset, processor, lengths: list[int], n_samples: int = 8) -> float:
+    """
+    Compares the estimated lengths of the first samples with the `input_ids`
+    the processor actually produces, printing a warning when they disagree.
+    Returns the largest relative error.
+    """
+    if isinstance(dataset, VisionFeatureDataset):
+        dataset = dataset.dataset
+    if not isinstance(dataset, ConversationDataset):
+        return 0.0  # pre-tokenized lengths are exact
+
+    worst = 0.0
+    for i in range(min(n_samples, len(dataset))):
+        actual = processor.apply_chat_template(
+            [dataset[i]], tokenize=True, return_dict=True, return_tensors="pt"
+        )["input_ids"].shape[1]
+        worst = max(worst, abs(lengths[i] - actual) / actual)
+    if worst > 0.1:
+        print(f"⚠️  Sample length estimates are off by up to {worst:.0%} from the processor output")
+    return worst
+
+
+def padding_ratio(batches: list[list[int]], lengths: list[int]) -> float:
+    """Fraction of the padded batch tensors that is padding."""
+    padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    if not padded:
+        return 0.0
+    return 1.0 - sum(lengths[i] for batch in batches for i in batch) / padded
+
+
+class LengthBucketSampler(Sampler[int]):
+    """
+    Yields indices so that every consecutive `batch_size` chunk holds samples of
+    similar length.
+
+    Each epoch the dataset is shuffled and cut into mega-batches of
+    `batch_size * bucket_size_multiplier` samples; each mega-batch is sorted by
+    length and split into batches, and the batch order is shuffled again. The
+    padding ratio of the epoch is passed to `on_epoch`. Meant for a single
+    process; the DataLoader must use the same `batch_size` and no shuffling.
+    """
+
+    def __init__(
+        self,
+        lengths: list[int],
+        batch_size: int,
+        bucket_size_multiplier: int = 50,
+        seed: int = 0,
+        on_epoch: Optional[Callable[[float], None]] = None,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.seed = seed
+        self.on_epoch = on_epoch
+        self.epoch = 0
+        self.last_padding_ratio: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def _batches(self) -> list[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.lengths), generator=generator).tolist()
+
+        mega_batch = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for start in range(0, len(order), mega_batch):
+            bucket = sorted(
+                order[start : start + mega_batch],
+                key=lambda i: self.lengths[i],
+                reverse=True,
+            )
+            batches.extend(
+                bucket[i : i + self.batch_size]
+                for i in range(0, len(bucket), self.batch_size)
+            )
+
+        # Only the very last batch can be short; keep it last so the DataLoader's
+        # fixed-size chunking stays aligned with the buckets.
+        tail = [batches.pop()] if len(batches[-1]) < self.batch_size else []
+        shuffled = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i] for i in shuffled] + tail
+
+    def __iter__(self) -> Iterator[int]:
+        batches = self._batches() if self.lengths else []
+        self.epoch += 1
+
+        self.last_padding_ratio = padding_ratio(batches, self.lengths)
+        if self.on_epoch is not None:
+            self.on_epoch(self.last_padding_ratio)
+
+        return (i for batch in batches for i in batch)
@@ -1,6 +1,20 @@
 """Custom callbacks for training."""
 
+import copy
+import json
 import os
+import queue
+import random
+import resource
+import shutil
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+import torch
+import wandb
 from transformers import TrainerCallback
 
 
@@ -32,4 +46,314 @@ class ProcessorSaveCallback(TrainerCallback):
         )
         print(f"💾 Saving processor to {checkpoint_dir}")
         self.processor.save_pretrained(checkpoint_dir)
-        print(f"✅ Processor saved to: {checkpoint_dir}")
\ No newline at end of file
+        print(f"✅ Processor saved to: {checkpoint_dir}")
+
+class ThroughputProfilerCallback(TrainerCallback):
+    """
+    Breaks down where training time goes, once per logging window.
+
+    For every window (`logging_steps` optimizer steps) it reports the time spent
+    waiting for the dataloader, in forward/backward, in the optimizer step, in
+    evaluation and in checkpointing, plus samples/s, tokens/s and peak memory.
+    Results are appended as JSON lines to `output_path` and logged to wandb when
+    a run is active. Optionally a `torch.profiler` trace is captured for the
+    optimizer steps in `[trace_start, trace_end)`.
+
+    Dataloader wait is the gap between the end of one step (or of the logging,
+    evaluation and saving that follow it) and the start of the next, which is
+    when the trainer fetches the batches for the next optimizer step.
+    """
+
+    def __init__(
+        self,
+        output_path: Optional[str] = None,
+        trace_steps: Optional[tuple[int, int]] = None,
+        trace_dir: Optional[str] = None,
+    ):
+        self.output_path = output_path
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self._profiler = None
+        self._reset_window(time.perf_counter(), tokens_seen=0)
+
+    def _reset_window(self, now: float, tokens_seen: int):
+        self._window_start = now
+        self._window_tokens_start = tokens_seen
+        self._idle_since = now
+        self._step_start = None
+        self._pre_optimizer = None
+        self._totals = defaultdict(float)
+        self._steps = 0
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._reset_window(time.perf_counter(), state.num_input_tokens_seen)
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        self._totals["dataloader_wait_s"] += now - self._idle_since
+        self._step_start = now
+        self._pre_optimizer = None
+
+        if self.trace_steps and state.global_step == self.trace_steps[0]:
+            self._start_trace(args)
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._pre_optimizer = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self._pre_optimizer is not None:
+            self._totals["optimizer_s"] += time.perf_counter() - self._pre_optimizer
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        if self._step_start is not None:
+            # Without the optimizer hooks (older transformers) the whole step
+            # counts as forward/backward.
+            forward_end = self._pre_optimizer or now
+            self._totals["forward_backward_s"] += forward_end - self._step_start
+        self._steps += 1
+        self._idle_since = now
+
+        if self._profiler is not None:
+            self._profiler.step()
+            if state.global_step >= self.trace_steps[1]:
+                self._stop_trace(state)
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        self._totals["evaluation_s"] += now - self._idle_since
+        self._idle_since = now
+
+    def on_save(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        self._totals["checkpoint_s"] += now - self._idle_since
+        self._idle_since = now
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if not self._steps:
+            return
+
+        now = time.perf_counter()
+        window_s = now - self._window_start
+        samples = (
+            self._steps
+            * args.per_device_train_batch_size
+            * args.gradient_accumulation_steps
+            * args.world_size
+        )
+        tokens = state.num_input_tokens_seen - self._window_tokens_start
+
+        metrics = {f"throughput/{k}": v for k, v in self._totals.items()}
+        metrics.update(
+            {
+                "throughput/window_s": window_s,
+                "throughput/steps": self._steps,
+                "throughput/samples_per_s": samples / window_s,
+                "throughput/tokens_per_s": tokens / window_s,
+                "throughput/peak_memory_mb": self._peak_memory_mb(),
+                "train/global_step": state.global_step,
+            }
+        )
+
+        if self.output_path:
+            with open(self.output_path, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        if wandb.run is not None:
+            wandb.log(metrics)
+
+        self._reset_window(time.perf_counter(), state.num_input_tokens_seen)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._profiler is not None:
+            self._stop_trace(state)
+
+    def _peak_memory_mb(self) -> float:
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated() / 2**20
+        # On CPU only the process-wide peak RSS is available (KB on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _start_trace(self, args):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        print(f"🔬 Starting torch.profiler trace at step {self.trace_steps[0]}")
+        self._profiler = torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True
+        )
+        self._profiler.start()
+        self.trace_dir = self.trace_dir or os.path.join(args.output_dir, "profiler")
+
+    def _stop_trace(self, state):
+        self._profiler.stop()
+        os.makedirs(self.trace_dir, exist_ok=True)
+        trace_path = os.path.join(
+            self.trace_dir, f"trace-steps-{self.trace_steps[0]}-{state.global_step}.json"
+        )
+        self._profiler.export_chrome_trace(trace_path)
+        self._profiler = None
+        print(f"🔬 Profiler trace saved to: {trace_path}")
+
+
+class BackgroundWriter:
+    """
+    Single background thread that runs serialization jobs in order.
+
+    The queue is bounded, so if checkpoints are produced faster than they can
+    be written, training waits instead of piling up CPU copies. Errors raised
+    by a job are re-raised in the training thread on the next submit/wait.
+    """
+
+    def __init__(self, max_pending: int = 2):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+            except BaseException as e:  # surfaced to the training thread
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+
+    def submit(self, job):
+        self._raise_pending_error()
+        self._queue.put(job)
+
+    def wait(self):
+        self._queue.join()
+        self._raise_pending_error()
+
+
+def _to_cpu(obj):
+    """Deep-copies every tensor of a (nested) state dict to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncAdapterCheckpointCallback(TrainerCallback):
+    """
+    Adapter-only checkpoints for LoRA runs, written by a background thread.
+
+    Every `save_steps` optimizer steps the adapter weights, optimizer, scheduler,
+    RNG and trainer state are copied to CPU (the only part that blocks training)
+    and handed to a `BackgroundWriter`. Checkpoints use the trainer's layout
+    (`checkpoint-<step>/adapter_model.safetensors`, `optimizer.pt`, ...) so
+    `resume_from_checkpoint` works as before. The processor is saved once to the
+    output directory instead of into every checkpoint.
+
+    Use it with `save_strategy="no"`. Since the trainer then cannot load the best
+    model at the end, the callback tracks `metric_for_best_model` itself and
+    restores the best adapter weights when training ends.
+    """
+
+    def __init__(self, model, processor, save_steps: int):
+        self.model = model
+        self.processor = processor
+        self.save_steps = save_steps
+        self.writer = BackgroundWriter()
+        self._last_checkpoint: Optional[str] = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        output_dir = args.output_dir
+        self.writer.submit(lambda: self.processor.save_pretrained(output_dir))
+
+    def on_step_end(self, args, state, control, optimizer=None, lr_scheduler=None, **kwargs):
+        if state.global_step % self.save_steps != 0:
+            return
+
+        from peft import get_peft_model_state_dict
+
+        checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+        snapshot = {
+            "adapter": _to_cpu(get_peft_model_state_dict(self.model)),
+            "optimizer": _to_cpu(optimizer.state_dict()) if optimizer else None,
+            "scheduler": lr_scheduler.state_dict() if lr_scheduler else None,
+            "rng": {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "cpu": torch.random.get_rng_state(),
+                "cuda": self._cuda_rng_state(args),
+            },
+            "state": copy.deepcopy(state),
+        }
+        self._last_checkpoint = checkpoint_dir
+        self.writer.submit(lambda: self._write_checkpoint(checkpoint_dir, snapshot))
+        print(f"💾 Queued adapter checkpoint {checkpoint_dir}")
+
+    @staticmethod
+    def _cuda_rng_state(args):
+        """Same layout as the trainer, so `Trainer._load_rng_state` restores it on resume."""
+        from transformers.training_args import ParallelMode
+
+        if not torch.cuda.is_available():
+            return None
+        if args.parallel_mode == ParallelMode.DISTRIBUTED:
+            return torch.cuda.random.get_rng_state_all()
+        return torch.cuda.random.get_rng_state()
+
+    def _write_checkpoint(self, checkpoint_dir: str, snapshot: dict):
+        from safetensors.torch import save_file
+
+        start = time.perf_counter()
+        tmp_dir = checkpoint_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        save_file(snapshot["adapter"], os.path.join(tmp_dir, "adapter_model.safetensors"))
+        for peft_config in self.model.peft_config.values():
+            peft_config.save_pretrained(tmp_dir)
+        if snapshot["optimizer"] is not None:
+            torch.save(snapshot["optimizer"], os.path.join(tmp_dir, "optimizer.pt"))
+        if snapshot["scheduler"] is not None:
+            torch.save(snapshot["scheduler"], os.path.join(tmp_dir, "scheduler.pt"))
+        torch.save(snapshot["rng"], os.path.join(tmp_dir, "rng_state.pth"))
+        snapshot["state"].save_to_json(os.path.join(tmp_dir, "trainer_state.json"))
+
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        os.rename(tmp_dir, checkpoint_dir)
+        print(f"✅ Checkpoint written in {time.perf_counter() - start:.1f}s: {checkpoint_dir}")
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        metric_name = args.metric_for_best_model or "loss"
+        if not metric_name.startswith("eval_"):
+            metric_name = f"eval_{metric_name}"
+        if not metrics or metric_name not in metrics or self._last_checkpoint is None:
+            return
+
+        value = metrics[metric_name]
+        better = np.greater if args.greater_is_better else np.less
+        if state.best_metric is None or better(value, state.best_metric):
+            state.best_metric = value
+            state.best_model_checkpoint = self._last_checkpoint
+
+    def on_train_end(self, args, state, control, **kwargs):
+        print("⏳ Waiting for pending checkpoint writes...")
+        self.writer.wait()
+
+        # Training may continue past the last checkpoint, so the current
+        # weights are the best ones only if the best checkpoint is this step
+        best = state.best_model_checkpoint
+        if best and int(best.rsplit("-", 1)[-1]) != state.global_step:
+            from peft import set_peft_model_state_dict
+            from safetensors.torch import load_file
+
+            print(f"🏆 Loading best adapter from {best}")
+            weights = load_file(os.path.join(best, "adapter_model.safetensors"))
+            set_peft_model_state_dict(self.model, weights)
@@ -30,6 +30,22 @@ class FineTuningConfig(BaseSettings):
     label_mapping: Optional[dict[Any, str]] = None
     train_split_ratio: float
     preprocessing_workers: int = 2
+    max_image_tokens: int = 256
+
+    # Stream the datasets instead of downloading them: sources are interleaved
+    # with `mixing_probabilities` (crosswalk, traffic lights) and shuffled
+    # through a bounded buffer, and only `dataset_samples` samples are read
+    streaming: bool = False
+    shuffle_buffer_size: int = 1000
+    mixing_probabilities: Optional[list[float]] = None
+
+    # Read images pre-resized by `prepare_data` instead of the raw datasets
+    use_prepared_dataset: bool = False
+    # Tokenize the dataset once and reuse it from a fingerprinted Arrow cache
+    use_preprocessed_cache: bool = False
+    # Run the frozen vision tower once and train from its cached embeddings
+    # (requires use_preprocessed_cache; LoRA is restricted to the language model)
+    cache_vision_features: bool = False
 
     system_prompt: str
     user_prompt: str
@@ -61,11 +77,36 @@ class FineTuningConfig(BaseSettings):
     weight_decay: float
     logging_steps: int
     eval_steps: int
+    # Gradient checkpointing per layer group: "all", "language", "vision" or "none"
+    gradient_checkpointing: str = "all"
+    # Memory preflight (see autoconfig): probe the candidate micro-batch sizes,
+    # checkpointing modes and max lengths, and train with the fastest setting
+    # that fits `memory_budget_gb` (default: 90% of the GPU). The effective batch
+    # size, batch_size * gradient_accumulation_steps, is kept.
+    auto_configure: bool = False
+    memory_budget_gb: Optional[float] = None
+    autoconfig_micro_batch_sizes: list[int] = [1, 2, 4, 8, 16]
+    autoconfig_checkpointing_modes: list[str] = ["none", "language", "vision", "all"]
+    autoconfig_max_lengths: list[int] = [512, 1024, 2048]
+    # Batch samples of similar length (image tokens included) to cut padding
+    group_by_length: bool = False
+    bucket_size_multiplier: int = 50
 
     # Weights and Biases configuration
     wandb_project_name: str = "car-maker-identification-fine-tuning"
     wandb_experiment_name: str | None = None
     skip_eval: bool = False
+
+    # LoRA checkpointing: save adapter-only checkpoints from a background thread
+    # (see callbacks.AsyncAdapterCheckpointCallback), and whether the final model
+    # is saved merged or as the adapter alone
+    async_checkpointing: bool = False
+    merge_adapter_at_end: bool = True
+
+    # Throughput profiling (see callbacks.ThroughputProfilerCallback)
+    profile_throughput: bool = False
+    profiler_trace_steps: Optional[list[int]] = None  # [start, end) optimizer steps
+    throughput_log_file: Optional[str] = None  # defaults to <checkpoints>/throughput.jsonl
     output_dir: str = "outputs"
 
     modal_app_name: str
@@ -84,6 +125,39 @@ class FineTuningConfig(BaseSettings):
 
         return cls(**data)
 
+    @model_validator(mode="after")
+    def check_vision_feature_cache(self):
+        if self.cache_vision_features and not self.use_preprocessed_cache:
+            raise ValueError("cache_vision_features requires use_preprocessed_cache")
+        if self.cache_vision_features and not self.use_peft:
+            raise ValueError("cache_vision_features requires use_peft (frozen vision tower)")
+        return self
+
+    @model_validator(mode="after")
+    def check_streaming(self):
+        if not self.streaming:
+            return self
+        for option in ["use_preprocessed_cache", "use_prepared_dataset", "group_by_length"]:
+            if getattr(self, option):
+                raise ValueError(f"streaming is incompatible with {option} (needs random access)")
+        if self.mixing_probabilities is not None and len(self.mixing_probabilities) != 2:
+            raise ValueError("mixing_probabilities needs one weight per source (crosswalk, traffic lights)")
+        return self
+
+    @model_validator(mode="after")
+    def check_gradient_checkpointing(self):
+        modes = {"all", "language", "vision", "none"}
+        for mode in [self.gradient_checkpointing, *self.autoconfig_checkpointing_modes]:
+            if mode not in modes:
+                raise ValueError(f"Unknown gradient_checkpointing mode '{mode}', use one of {sorted(modes)}")
+        return self
+
+    @model_validator(mode="after")
+    def check_async_checkpointing(self):
+        if self.async_checkpointing and not self.use_peft:
+            raise ValueError("async_checkpointing saves LoRA adapters and requires use_peft")
+        return self
+
     @model_validator(mode="after")
     def set_experiment_name(self):
         if self.wandb_experiment_name is None:
@@ -103,8 +177,33 @@ class EvaluationConfig(BaseSettings):
     # Model parameters
     model: str
     structured_generation: bool = False
+    max_image_tokens: int = 256
+    # Image-token budgets to sweep (accuracy vs. latency per tier); when set,
+    # `max_image_tokens` is ignored
+    image_token_tiers: Optional[list[int]] = None
+    # Cheapest tier is recommended if its safety accuracy is within this of the best
+    tier_safety_tolerance: float = 0.01
+    # Crop images to the walking corridor first, as the backend's ROI mode does
+    roi_crop: bool = False
+    roi_use_horizon: bool = False
+    # Sequential early stopping (see sequential.SequentialStopper): stop once the
+    # Wilson intervals on accuracy and on the recall of `ci_recall_classes` are
+    # narrower than `ci_target_width`, or once the comparison with
+    # `reference_csv` (a predictions CSV of an earlier run) is decided
+    early_stopping: bool = False
+    ci_target_width: float = 0.05
+    ci_confidence: float = 0.95
+    ci_min_samples: int = 100
+    ci_check_every: int = 50
+    ci_recall_classes: list[str] = ["STOP/ALERT (Pedestrian)", "STOP (Traffic Light)"]
+    ci_mode: str = "detailed"  # or "safety"
+    reference_csv: Optional[str] = None
 
     # Dataset parameters
+    # Stream only the `n_samples` evaluated instead of downloading the datasets
+    streaming: bool = False
+    shuffle_buffer_size: int = 1000
+    mixing_probabilities: Optional[list[float]] = None
     dataset: str
     split: str
     n_samples: int
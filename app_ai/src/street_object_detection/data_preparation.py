@@ -1,4 +1,15 @@
+import io
+import math
+from pathlib import Path
+
+import datasets
 from datasets import Dataset
+from PIL import Image
+from torch.utils.data import Dataset as TorchDataset
+from torch.utils.data import IterableDataset as TorchIterableDataset
+
+from .paths import get_path_prepared_dataset_in_modal_volume
+
 
 def split_dataset(
     dataset: Dataset,
@@ -12,31 +23,216 @@ def split_dataset(
     split = dataset.train_test_split(test_size=test_size, seed=seed)
     return split["train"], split["test"]
 
+def split_streaming_dataset(
+    dataset: datasets.IterableDataset,
+    n_samples: int,
+    test_size: float = 0.1,
+) -> tuple[datasets.IterableDataset, Dataset]:
+    """
+    Splits a stream of `n_samples` into a training stream and an eval set.
+
+    The eval set is the head of the stream, materialized so the trainer can
+    evaluate it repeatedly; training skips it. Both sides see the same order
+    because the stream is only reshuffled when its epoch changes, which
+    `IterableConversationDataset` never does.
+    """
+    if not 0 < test_size < 1:
+        raise ValueError("test_size must be between 0 and 1")
+
+    n_eval = max(1, round(n_samples * test_size))
+    eval_dataset = Dataset.from_list(list(dataset.take(n_eval)))
+    return dataset.skip(n_eval), eval_dataset
+
+def build_conversation(
+    image,
+    answer: str,
+    system_prompt: str,
+    user_prompt: str,
+) -> list[dict]:
+    """Builds the system/user/assistant chat used for SFT from one sample."""
+    return [
+        {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+        {
+            "role": "user",
+            "content": [
+                {"type": "image", "image": image},
+                {"type": "text", "text": user_prompt},
+            ],
+        },
+        {
+            "role": "assistant",
+            "content": [{"type": "text", "text": answer}],
+        },
+    ]
+
+def decode_image(encoded: dict) -> Image.Image:
+    """Decodes an image stored by `datasets.Image(decode=False)`."""
+    if encoded["bytes"] is not None:
+        return Image.open(io.BytesIO(encoded["bytes"])).convert("RGB")
+    return Image.open(encoded["path"]).convert("RGB")
+
+
+class ConversationDataset(TorchDataset):
+    """
+    Lazy view of a dataset as SFT conversations.
+
+    Images stay encoded in the underlying Arrow table and a conversation is only
+    built (and its image decoded) when the sample is indexed, i.e. inside the
+    DataLoader right before collation. Memory at trainer start no longer grows
+    with the dataset size.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        system_prompt: str,
+        user_prompt: str,
+        image_column: str,
+        label_column: str,
+        label_mapping: dict = None,
+    ):
+        self.dataset = dataset.select_columns([image_column, label_column]).cast_column(
+            image_column, datasets.Image(decode=False)
+        )
+        self.system_prompt = system_prompt
+        self.user_prompt = user_prompt
+        self.image_column = image_column
+        self.label_column = label_column
+        self.label_mapping = label_mapping or {}
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> list[dict]:
+        sample = self.dataset[idx]
+        answer = sample[self.label_column]
+        answer = self.label_mapping.get(answer, answer)
+
+        return build_conversation(
+            decode_image(sample[self.image_column]),
+            answer,
+            self.system_prompt,
+            self.user_prompt,
+        )
+
+
+class IterableConversationDataset(TorchIterableDataset):
+    """
+    Streaming view of a dataset as SFT conversations.
+
+    Samples are pulled from the stream and turned into conversations one at a
+    time, so only the shuffle buffer is ever held in memory. The stream order is
+    the same every epoch (see `split_streaming_dataset`).
+    """
+
+    def __init__(
+        self,
+        dataset: datasets.IterableDataset,
+        system_prompt: str,
+        user_prompt: str,
+        image_column: str,
+        label_column: str,
+        label_mapping: dict = None,
+    ):
+        self.dataset = dataset
+        self.system_prompt = system_prompt
+        self.user_prompt = user_prompt
+        self.image_column = image_column
+        self.label_column = label_column
+        self.label_mapping = label_mapping or {}
+
+    def __iter__(self):
+        for sample in self.dataset:
+            image = sample[self.image_column]
+            image = decode_image(image) if isinstance(image, dict) else image.convert("RGB")
+            answer = sample[self.label_column]
+            answer = self.label_mapping.get(answer, answer)
+
+            yield build_conversation(image, answer, self.system_prompt, self.user_prompt)
+
+
 def format_dataset_as_conversation(
-    dataset: Dataset,
+    dataset: Dataset | datasets.IterableDataset,
     system_prompt: str,
     user_prompt: str,
     image_column: str,
     label_column: str,
     label_mapping: dict = None,
-) -> Dataset:
-    
-    def format_sample(sample):
-        answer = sample['text_label']
-
-        return [
-            {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "image": sample[image_column]},
-                    {"type": "text", "text": user_prompt},
-                ],
-            },
-            {
-                "role": "assistant",
-                "content": [{"type": "text", "text": answer}],
-            },
-        ]
-
-    return [format_sample(s) for s in dataset]
\ No newline at end of file
+) -> ConversationDataset | IterableConversationDataset:
+    if isinstance(dataset, datasets.IterableDataset):
+        return IterableConversationDataset(
+            dataset,
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            image_column=image_column,
+            label_column=label_column,
+            label_mapping=label_mapping,
+        )
+    return ConversationDataset(
+        dataset,
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        image_column=image_column,
+        label_column=label_column,
+        label_mapping=label_mapping,
+    )
+
+
+JPEG_QUALITY = 90
+
+
+def get_target_image_edge(processor) -> int:
+    """
+    Longest image edge the processor works with: its tile size, or the square
+    that `max_image_tokens` covers when the processor does not tile.
+    """
+    image_processor = processor.image_processor
+    tile_size = getattr(image_processor, "tile_size", None)
+    if tile_size:
+        return int(tile_size)
+
+    patch = image_processor.encoder_patch_size * image_processor.downsample_factor
+    return math.isqrt(image_processor.max_image_tokens) * patch
+
+
+def resize_image_bytes(data: bytes, max_edge: int) -> bytes:
+    """Downscales an encoded image so its longest edge is `max_edge`, as JPEG."""
+    img = Image.open(io.BytesIO(data))
+    if img.format == "JPEG" and max(img.size) <= max_edge:
+        return data
+
+    # For JPEGs, draft() lets the decoder skip straight to a smaller DCT scale
+    img.draft("RGB", (max_edge, max_edge))
+    img = img.convert("RGB")
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def prepare_images(
+    dataset: datasets.Dataset, image_column: str, max_edge: int, num_proc: int
+) -> datasets.Dataset:
+    """Resizes and re-encodes the image column, decoding each image only once."""
+    dataset = dataset.cast_column(image_column, datasets.Image(decode=False))
+
+    def resize_sample(sample):
+        encoded = sample[image_column]
+        data = encoded["bytes"]
+        if data is None:
+            with open(encoded["path"], "rb") as f:
+                data = f.read()
+        return {image_column: {"bytes": resize_image_bytes(data, max_edge), "path": None}}
+
+    dataset = dataset.map(resize_sample, num_proc=num_proc, desc="Resizing images")
+    return dataset.cast_column(image_column, datasets.Image())
+
+
+def get_prepared_dataset_path(config, processor) -> tuple[Path, int]:
+    """Location of the pre-resized dataset for a fine-tuning config, and its max edge."""
+    max_edge = get_target_image_edge(processor)
+    path = get_path_prepared_dataset_in_modal_volume(
+        config.dataset_name, config.dataset_samples, config.seed, max_edge
+    )
+    return path, max_edge
@@ -1,13 +1,20 @@
 import time
 import tempfile
+from pathlib import Path
+from typing import Optional
 from tqdm import tqdm
 import wandb
 import matplotlib.pyplot as plt
 from .config import EvaluationConfig
-from .inference import get_model_output
-from .loaders import load_dataset, load_model_and_processor
+from .inference import get_model_output_with_stats, get_structured_generator, get_structured_outputs_with_stats
+from .labels import PREDICTION_LABELS
+from .loaders import load_dataset, load_model_and_processor, load_processor
 from .modal_infra import get_docker_image, get_modal_app, get_secrets, get_volume
-from .report import EvalReport
+from .output_types import get_model_output_schema
+from .paths import get_path_to_evals
+from .report import STATS_FIELDS, EvalReport
+from .roi import RoiConfig, compute_roi, crop_to_roi
+from .sequential import SequentialStopper, correct_count
 from .batching import create_batches
 
 app = get_modal_app("pedestrian-assistant")
@@ -16,51 +23,114 @@ datasets_volume = get_volume("datasets")
 models_volume = get_volume("models")
 
 def parse_prediction(text):
-    text = text.lower().strip()
-    
-    if "cannot" in text or "pictured" in text or "provide" in text or "sorry" in text:
-        return "unknown"
-
-    if "no zebra" in text or "no traffic" in text or "clear" in text or "safe" in text or "none" in text:
-        return "none"
-
-    if "red" in text: return "red"
-    if "green" in text: return "green"
-    if "zebra" in text or "crosswalk" in text or "crossing" in text: return "zebra"
-        
-    return "unknown"
+    return PREDICTION_LABELS.normalize(text)
 
 def parse_label(text):
     return text.lower().strip()
 
+def load_reference_counts(config: EvaluationConfig) -> Optional[tuple[int, int]]:
+    """(correct, total) of the reference run, read locally before going remote."""
+    if config.reference_csv is None:
+        return None
+    path = Path(config.reference_csv)
+    if not path.is_absolute():
+        path = Path(get_path_to_evals()) / path
+    reference = EvalReport.from_csv(str(path), normalizer=PREDICTION_LABELS)
+    return correct_count(reference, config.ci_mode), len(reference)
+
+def run_evaluation(
+    model, processor, batches, config: EvaluationConfig,
+    reference: Optional[tuple[int, int]] = None,
+) -> EvalReport:
+    eval_report = EvalReport()
+    stopper = SequentialStopper.from_config(config, reference) if config.early_stopping else None
+
+    structured = None
+    if config.structured_generation:
+        # Wrapper and output index are built once and reused for every batch
+        output_type = get_model_output_schema(config.dataset)
+        structured = get_structured_generator(model, processor)
+        structured.generator(output_type)
+
+    roi_config = RoiConfig(use_horizon=config.roi_use_horizon) if config.roi_crop else None
+
+    for batch_images, batch_labels in tqdm(batches, desc="Evaluare"):
+        if roi_config is not None:
+            batch_images = [crop_to_roi(img, compute_roi(img, roi_config)) for img in batch_images]
+
+        if structured is not None:
+            outputs, stats = get_structured_outputs_with_stats(
+                structured,
+                processor,
+                output_type,
+                config.system_prompt,
+                config.user_prompt,
+                list(batch_images),
+                max_new_tokens=30,
+            )
+            eval_report.add_records(
+                [parse_label(label) for label in batch_labels],
+                [o.pred_class if o is not None else "unknown" for o in outputs],
+                stats={name: [getattr(s, name) for s in stats] for name in STATS_FIELDS} if stats else None,
+            )
+        else:
+            for image, raw_label in zip(batch_images, batch_labels):
+                conversation = [
+                    {"role": "system", "content": [{"type": "text", "text": config.system_prompt}]},
+                    {"role": "user", "content": [{"type": "image", "image": image}, {"type": "text", "text": config.user_prompt}]}
+                ]
+
+                raw_pred, stats = get_model_output_with_stats(
+                    model, processor, conversation, max_new_tokens=30
+                )
+
+                clean_pred = parse_prediction(raw_pred)
+                clean_label = parse_label(raw_label)
+
+                eval_report.add_record(clean_label, clean_pred, stats)
+
+        if stopper is not None and stopper.should_stop(eval_report):
+            print(f"⏹️  Oprire timpurie: {stopper.reason}")
+            break
+
+
+    return eval_report
+
+def tier_summary(report: EvalReport) -> dict[str, float]:
+    latency = report.latency_summary()
+    return {
+        "accuracy": report.get_accuracy(),
+        "safety_accuracy": report.get_accuracy(mode="safety"),
+        "latency_p50_s": latency.get("latency_p50_s", float("nan")),
+        "latency_p95_s": latency.get("latency_p95_s", float("nan")),
+        "mean_input_tokens": latency.get("mean_input_tokens", float("nan")),
+    }
+
+def choose_tier(summaries: dict[int, dict[str, float]], tolerance: float) -> int:
+    """Smallest image-token budget whose safety accuracy is within `tolerance` of the best."""
+    best = max(s["safety_accuracy"] for s in summaries.values())
+    return min(t for t, s in summaries.items() if s["safety_accuracy"] >= best - tolerance)
+
 @app.function(
     image=image, gpu="L40S",
     volumes={"/datasets": datasets_volume, "/models": models_volume},
     secrets=get_secrets(), timeout=3600
 )
-def evaluate(config: EvaluationConfig) -> EvalReport:
+def evaluate(config: EvaluationConfig, reference: Optional[tuple[int, int]] = None) -> EvalReport:
     wandb.init(project=config.wandb_project_name, config=config.model_dump())
     
-    dataset = load_dataset(dataset_name=config.dataset, splits=[config.split], n_samples=config.n_samples, cache_dir="/datasets")
-    model, processor = load_model_and_processor(model_id=config.model, cache_dir="/models")
-    eval_report = EvalReport()
+    dataset = load_dataset(
+        dataset_name=config.dataset, splits=[config.split], n_samples=config.n_samples, cache_dir="/datasets",
+        streaming=config.streaming, shuffle_buffer_size=config.shuffle_buffer_size,
+        mixing_probabilities=config.mixing_probabilities,
+    )
+    model, processor = load_model_and_processor(
+        model_id=config.model, cache_dir="/models", max_image_tokens=config.max_image_tokens
+    )
     batches = create_batches(dataset, config)
 
     print("🚀 Începere Evaluare...")
-    
-    for batch_images, batch_labels in tqdm(batches, desc="Evaluare"):
-        for image, raw_label in zip(batch_images, batch_labels):
-            conversation = [
-                {"role": "system", "content": [{"type": "text", "text": config.system_prompt}]},
-                {"role": "user", "content": [{"type": "image", "image": image}, {"type": "text", "text": config.user_prompt}]}
-            ]
-            
-            raw_pred = get_model_output(model, processor, conversation, max_new_tokens=30)
-            
-            clean_pred = parse_prediction(raw_pred)
-            clean_label = parse_label(raw_label)
-            
-            eval_report.add_record(image, clean_label, clean_pred)
+    eval_report = run_evaluation(model, processor, batches, config, reference)
 
     for m_type in ["safety", "type", "detailed"]:
         fig = eval_report.plot_matrix(mode=m_type)
@@ -71,13 +141,96 @@ def evaluate(config: EvaluationConfig) -> EvalReport:
                 plt.close(fig)
 
     acc = eval_report.get_accuracy()
-    wandb.log({"final_accuracy": acc})
+    latency = eval_report.latency_summary()
+    wandb.log({"final_accuracy": acc, **{f"latency/{k}": v for k, v in latency.items()}})
+    wandb.run.summary.update({"final_accuracy": acc, "n_evaluated": len(eval_report), **latency})
+    if config.early_stopping:
+        wandb.run.summary.update(
+            {f"ci/{k}": v for k, v in SequentialStopper.from_config(config, reference).summary(eval_report).items()}
+        )
     wandb.finish()
     return eval_report
 
+@app.function(
+    image=image, gpu="L40S",
+    volumes={"/datasets": datasets_volume, "/models": models_volume},
+    secrets=get_secrets(), timeout=3 * 3600
+)
+def evaluate_image_token_tiers(config: EvaluationConfig) -> dict[int, EvalReport]:
+    """
+    Evaluates the same samples once per image-token budget in
+    `config.image_token_tiers`. The model is loaded once; only the processor
+    changes between tiers.
+    """
+    wandb.init(project=config.wandb_project_name, config=config.model_dump())
+
+    dataset = load_dataset(
+        dataset_name=config.dataset, splits=[config.split], n_samples=config.n_samples, cache_dir="/datasets",
+        streaming=config.streaming, shuffle_buffer_size=config.shuffle_buffer_size,
+        mixing_probabilities=config.mixing_probabilities,
+    )
+    tiers = sorted(config.image_token_tiers)
+    if config.early_stopping:
+        # Every tier must be measured on the same samples for choose_tier
+        print("⚠️  early_stopping este ignorat la compararea nivelurilor de tokeni")
+        config = config.model_copy(update={"early_stopping": False})
+    model, _ = load_model_and_processor(
+        model_id=config.model, cache_dir="/models", max_image_tokens=tiers[0]
+    )
+    batches = create_batches(dataset, config)
+
+    reports = {}
+    table = wandb.Table(columns=["max_image_tokens", "accuracy", "safety_accuracy", "latency_p50_s", "latency_p95_s", "mean_input_tokens"])
+    for max_image_tokens in tiers:
+        print(f"🚀 Evaluare cu max_image_tokens={max_image_tokens}...")
+        processor = load_processor(config.model, cache_dir="/models", max_image_tokens=max_image_tokens)
+        reports[max_image_tokens] = run_evaluation(model, processor, batches, config)
+
+        summary = tier_summary(reports[max_image_tokens])
+        table.add_data(max_image_tokens, *summary.values())
+        wandb.log({f"tiers/{k}": v for k, v in summary.items()} | {"tiers/max_image_tokens": max_image_tokens})
+
+    wandb.log({"image_token_tiers": table})
+    wandb.finish()
+    return reports
+
 @app.local_entrypoint()
 def main(config_file_name: str):
     config = EvaluationConfig.from_yaml(config_file_name)
-    report = evaluate.remote(config)
-    print(f"✅ Evaluare terminată. Acuratețe: {report.get_accuracy():.2f}")
-    report.to_csv()
\ No newline at end of file
+    if config.image_token_tiers:
+        return main_tiers(config)
+
+    reference = load_reference_counts(config)
+    report = evaluate.remote(config, reference)
+    print(f"✅ Evaluare terminată. Acuratețe: {report.get_accuracy():.2f} ({len(report)} exemple)")
+    if config.early_stopping:
+        stopper = SequentialStopper.from_config(config, reference)
+        for name, (low, high) in stopper.intervals(report).items():
+            print(f"📐 {name}: [{low:.3f}, {high:.3f}] ({config.ci_confidence:.0%} CI)")
+        comparison = stopper.comparison(report)
+        if comparison is not None:
+            print(f"⚖️  Diferență față de referință: [{comparison[0]:+.3f}, {comparison[1]:+.3f}]")
+    latency = report.latency_summary()
+    if latency:
+        print(
+            f"⏱️  Latency p50/p95: {latency['latency_p50_s']:.3f}s / "
+            f"{latency['latency_p95_s']:.3f}s, {latency['tokens_per_s']:.1f} tokens/s"
+        )
+    report.to_csv()
+    report.to_parquet()
+
+def main_tiers(config: EvaluationConfig):
+    reports = evaluate_image_token_tiers.remote(config)
+    summaries = {tokens: tier_summary(report) for tokens, report in reports.items()}
+
+    print("✅ Evaluare terminată pe niveluri de tokeni:")
+    print(f"{'tokens':>8} {'acc':>7} {'safety':>7} {'p50 (s)':>8} {'p95 (s)':>8}")
+    for tokens, summary in sorted(summaries.items()):
+        print(
+            f"{tokens:>8} {summary['accuracy']:>7.3f} {summary['safety_accuracy']:>7.3f} "
+            f"{summary['latency_p50_s']:>8.3f} {summary['latency_p95_s']:>8.3f}"
+        )
+        reports[tokens].to_csv(prefix=f"predictions_tokens{tokens}")
+
+    best = choose_tier(summaries, config.tier_safety_tolerance)
+    print(f"🏷️  Cheapest tier keeping safety accuracy: max_image_tokens={best}")
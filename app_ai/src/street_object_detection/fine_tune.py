@@ -1,12 +1,24 @@
+import math
 import os
 
 import wandb
 from datasets import Dataset
-from trl import SFTConfig, SFTTrainer
-
-from .callbacks import ProcessorSaveCallback
+from trl import SFTConfig
+
+from .autoconfig import apply_gradient_checkpointing, autoconfigure
+from .bucketing import check_sample_lengths, compute_sample_lengths
+from .callbacks import (
+    AsyncAdapterCheckpointCallback,
+    ProcessorSaveCallback,
+    ThroughputProfilerCallback,
+)
 from .config import FineTuningConfig
-from .data_preparation import format_dataset_as_conversation, split_dataset
+from .data_preparation import (
+    format_dataset_as_conversation,
+    get_prepared_dataset_path,
+    split_dataset,
+    split_streaming_dataset,
+)
 from .loaders import load_dataset, load_model_and_processor
 from .modal_infra import (
     get_docker_image,
@@ -15,11 +27,25 @@ from .modal_infra import (
     get_secrets,
     get_volume,
 )
-from .paths import get_path_model_checkpoints_in_modal_volume
+from .paths import (
+    get_path_model_checkpoints_in_modal_volume,
+    get_path_vision_feature_cache_in_modal_volume,
+)
+from .preprocessing import (
+    create_pretokenized_collate_fn,
+    get_cache_fingerprint,
+    load_or_build_preprocessed_datasets,
+)
+from .trainer import PedestrianSFTTrainer
+from .vision_cache import (
+    load_or_build_vision_feature_dataset,
+    lora_targets_for_language_model,
+)
 
 app = get_modal_app("car-maker-identification")
 image = get_docker_image()
 volume = get_volume("models")
+datasets_volume = get_volume("datasets")
 
 
 def create_collate_fn(processor):
@@ -44,6 +70,7 @@ def create_collate_fn(processor):
     gpu="L40S",
     volumes={
         "/model_checkpoints": volume,
+        "/datasets": datasets_volume,
     },
     secrets=get_secrets(),
     timeout=1 * 60 * 60,
@@ -69,42 +96,88 @@ def fine_tune(
     else:
         os.environ["WANDB_DISABLED"] = "true"
 
-    model, processor = load_model_and_processor(model_id=config.model_name)
-
-    train_ds: Dataset = load_dataset(
-        dataset_name=config.dataset_name,
-        splits=config.dataset_splits,
-        n_samples=config.dataset_samples,
-        seed=config.seed,
+    model, processor = load_model_and_processor(
+        model_id=config.model_name, max_image_tokens=config.max_image_tokens
     )
 
-    print("Splitting the dataset into train and eval sets...")
-    train_dataset, eval_dataset = split_dataset(
-        train_ds, test_size=(1 - config.train_split_ratio), seed=config.seed
-    )
+    if config.use_preprocessed_cache:
+        print("Loading the tokenized datasets from the preprocessed cache...")
+        train_dataset, eval_dataset = load_or_build_preprocessed_datasets(
+            config, processor
+        )
+        collate_fn = create_pretokenized_collate_fn(processor)
+
+        if config.cache_vision_features:
+            fingerprint = get_cache_fingerprint(config, processor)
+            train_dataset, eval_dataset = (
+                load_or_build_vision_feature_dataset(
+                    model,
+                    dataset,
+                    get_path_vision_feature_cache_in_modal_volume(
+                        fingerprint, config.model_name, split
+                    ),
+                )
+                for dataset, split in [(train_dataset, "train"), (eval_dataset, "eval")]
+            )
+    else:
+        prepared_path = None
+        if config.use_prepared_dataset:
+            prepared_path, _ = get_prepared_dataset_path(config, processor)
+
+        train_ds: Dataset = load_dataset(
+            dataset_name=config.dataset_name,
+            splits=config.dataset_splits,
+            n_samples=config.dataset_samples,
+            seed=config.seed,
+            prepared_path=prepared_path,
+            streaming=config.streaming,
+            shuffle_buffer_size=config.shuffle_buffer_size,
+            mixing_probabilities=config.mixing_probabilities,
+        )
 
-    print("Formatting the datasets into a conversation format...")
-    train_dataset = format_dataset_as_conversation(
-        train_dataset,
-        system_prompt=config.system_prompt,
-        user_prompt=config.user_prompt,
-        image_column=config.dataset_image_column,
-        label_column=config.dataset_label_colum,
-        label_mapping=config.label_mapping,
-    )
-    eval_dataset = format_dataset_as_conversation(
-        eval_dataset,
-        system_prompt=config.system_prompt,
-        user_prompt=config.user_prompt,
-        image_column=config.dataset_image_column,
-        label_column=config.dataset_label_colum,
-        label_mapping=config.label_mapping,
-    )
+        print("Splitting the dataset into train and eval sets...")
+        if config.streaming:
+            train_dataset, eval_dataset = split_streaming_dataset(
+                train_ds, config.dataset_samples, test_size=(1 - config.train_split_ratio)
+            )
+        else:
+            train_dataset, eval_dataset = split_dataset(
+                train_ds, test_size=(1 - config.train_split_ratio), seed=config.seed
+            )
+
+        print("Formatting the datasets into a conversation format...")
+        train_dataset = format_dataset_as_conversation(
+            train_dataset,
+            system_prompt=config.system_prompt,
+            user_prompt=config.user_prompt,
+            image_column=config.dataset_image_column,
+            label_column=config.dataset_label_colum,
+            label_mapping=config.label_mapping,
+        )
+        eval_dataset = format_dataset_as_conversation(
+            eval_dataset,
+            system_prompt=config.system_prompt,
+            user_prompt=config.user_prompt,
+            image_column=config.dataset_image_column,
+            label_column=config.dataset_label_colum,
+            label_mapping=config.label_mapping,
+        )
+        collate_fn = create_collate_fn(processor)
 
     print("✅ SFT Dataset formatted:")
-    print(f"📚 Train samples: {len(train_dataset)}")
+    max_steps = -1
+    if config.streaming:
+        # A stream has no length, so the trainer needs the step count up front
+        n_train = config.dataset_samples - len(eval_dataset)
+        steps_per_epoch = math.ceil(
+            n_train / (config.batch_size * config.gradient_accumulation_steps)
+        )
+        max_steps = steps_per_epoch * config.num_train_epochs
+        print(f"📚 Train samples: {n_train} (streamed, {max_steps} steps)")
+    else:
+        print(f"📚 Train samples: {len(train_dataset)}")
+        print("Train sample: ", train_dataset[0])
     print(f"🧪 Eval samples: {len(eval_dataset)}")
-    print("Train sample: ", train_dataset[0])
     print("Eval sample: ", eval_dataset[0])
 
     if config.use_peft:
@@ -115,14 +188,28 @@ def fine_tune(
             lora_dropout=config.lora_dropout,
             r=config.lora_r,
             bias="none",
-            target_modules=config.lora_target_modules,
+            target_modules=(
+                lora_targets_for_language_model(config.lora_target_modules)
+                if config.cache_vision_features
+                else config.lora_target_modules
+            ),
             task_type="CAUSAL_LM",
         )
 
         model = get_peft_model(model, peft_config)
         model.print_trainable_parameters()
 
-    collate_fn = create_collate_fn(processor)
+    if config.auto_configure:
+        autoconfigure(
+            model,
+            processor,
+            config,
+            train_dataset=None if config.streaming else train_dataset,
+        )
+    # Trainer's own checkpointing covers every layer; other modes are applied
+    # per layer group
+    if config.gradient_checkpointing not in ("all", "none"):
+        apply_gradient_checkpointing(model, config.gradient_checkpointing)
 
     checkpoints_dir = get_path_model_checkpoints_in_modal_volume(
         config.wandb_experiment_name
@@ -134,6 +221,7 @@ def fine_tune(
     sft_config = SFTConfig(
         output_dir=checkpoints_dir,
         num_train_epochs=config.num_train_epochs,
+        max_steps=max_steps,
         per_device_train_batch_size=config.batch_size,
         gradient_accumulation_steps=config.gradient_accumulation_steps,
         learning_rate=config.learning_rate,
@@ -141,36 +229,67 @@ def fine_tune(
         weight_decay=config.weight_decay,
         logging_steps=config.logging_steps,
         optim=config.optim,
-        gradient_checkpointing=True,
-        max_length=512,  # TODO: use config.max_seq_length ?
+        gradient_checkpointing=config.gradient_checkpointing == "all",
+        max_length=config.max_seq_length,
         dataset_kwargs={"skip_prepare_dataset": True},
+        remove_unused_columns=False,
         report_to="wandb" if config.use_wandb else None,
         # Add these for step-based evaluation:
         eval_strategy="steps",  # Evaluate every N steps
         eval_steps=config.eval_steps,  # Evaluate every 1000 steps
         per_device_eval_batch_size=config.batch_size,  # Eval batch size
-        save_strategy="steps",  # Save checkpoints every N steps
+        # With async checkpointing the callback saves and restores the best adapter
+        save_strategy="no" if config.async_checkpointing else "steps",
         save_steps=config.eval_steps,  # Save every 1000 steps
-        load_best_model_at_end=True,  # Load best model after training
+        load_best_model_at_end=not config.async_checkpointing,
         metric_for_best_model="eval_loss",  # Metric to determine best model
+        include_num_input_tokens_seen=config.profile_throughput,
     )
 
     # Create callbacks
-    processor_callback = ProcessorSaveCallback(processor)
+    if config.async_checkpointing:
+        processor_callback = AsyncAdapterCheckpointCallback(
+            model, processor, save_steps=config.eval_steps
+        )
+    else:
+        processor_callback = ProcessorSaveCallback(processor)
     # debug_callback = DebugPredictionCallback(eval_dataset, processor, num_samples=5)
+    callbacks = [
+        processor_callback,
+        # debug_callback
+    ]
+    if config.profile_throughput:
+        checkpoints_dir.mkdir(parents=True, exist_ok=True)
+        callbacks.append(
+            ThroughputProfilerCallback(
+                output_path=config.throughput_log_file
+                or str(checkpoints_dir / "throughput.jsonl"),
+                trace_steps=(
+                    tuple(config.profiler_trace_steps)
+                    if config.profiler_trace_steps
+                    else None
+                ),
+            )
+        )
+
+    train_lengths = None
+    if config.group_by_length:
+        print("📏 Computing sample lengths for length-grouped batching...")
+        train_lengths = compute_sample_lengths(train_dataset, processor)
+        check_sample_lengths(train_dataset, processor, train_lengths)
 
     print("🏗️  Creating SFT trainer...")
-    trainer = SFTTrainer(
+    trainer = PedestrianSFTTrainer(
         model=model,
         args=sft_config,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         data_collator=collate_fn,
         processing_class=processor.tokenizer,
-        callbacks=[
-            processor_callback,
-            # debug_callback
-        ],
+        callbacks=callbacks,
+        train_lengths=train_lengths,
+        bucket_size_multiplier=config.bucket_size_multiplier,
+        image_token_id=getattr(model.config, "image_token_id", None),
     )
 
     print("\n🚀 Starting SFT training...")
@@ -187,8 +306,10 @@ def fine_tune(
             )
         )
 
-    print("Saving merged model")
-    if hasattr(model, 'peft_config'):
+    if hasattr(model, 'peft_config') and not config.merge_adapter_at_end:
+        print("Saving LoRA adapter only")
+    elif hasattr(model, 'peft_config'):
+        print("Saving merged model")
         print("🔄 Merging LoRA weights...")
         model = model.merge_and_unload()
     model.save_pretrained(checkpoints_dir / "final")
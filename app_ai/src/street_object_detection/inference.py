@@ -1,11 +1,125 @@
+import time
+from dataclasses import dataclass
+
 import outlines
+import torch
 from PIL import Image
-from typing import Union, List
+from typing import Dict, List, Type, Union
 
 from outlines.inputs import Image as OutlinesImage, Chat
-from transformers import AutoModelForImageTextToText, AutoProcessor
+from pydantic import BaseModel
+from transformers import AutoModelForImageTextToText, AutoProcessor, StoppingCriteria
+
+from .output_types import CarIdentificationOutputType, ModelOutputType
+
+
+class StructuredGenerator:
+    """
+    Constrained generation with Outlines, built once per model.
+
+    `outlines.from_transformers` wraps the model and each `outlines.Generator`
+    compiles the output type's JSON schema into a token index, which takes far
+    longer than a short generation. Both are kept here and reused across calls;
+    use `get_structured_generator` to share one instance per (model, processor).
+    """
+
+    def __init__(self, model: AutoModelForImageTextToText, processor: AutoProcessor):
+        self.model = model
+        self.outlines_model = outlines.from_transformers(model, processor)
+        self._generators: Dict[Type[BaseModel], outlines.Generator] = {}
+
+    def generator(self, output_type: Type[BaseModel]) -> outlines.Generator:
+        """Returns the compiled generator for `output_type`, compiling it on first use."""
+        if output_type not in self._generators:
+            print(f"🧩 Compiling output index for {output_type.__name__}...")
+            self._generators[output_type] = outlines.Generator(
+                self.outlines_model, output_type
+            )
+        return self._generators[output_type]
+
+    def __call__(
+        self,
+        output_type: Type[ModelOutputType],
+        system_prompt: str,
+        user_prompt: str,
+        images: Union[Image.Image, List[Image.Image]],
+        max_new_tokens: int | None = 64,
+    ) -> Union[ModelOutputType, List[ModelOutputType | None], None]:
+        """
+        Generates one `output_type` instance per image (None if it does not parse).
+        A single image returns a single instance.
+        """
+        generator = self.generator(output_type)
+
+        if isinstance(images, Image.Image):
+            response: str = generator(
+                _build_chat(system_prompt, user_prompt, images),
+                max_new_tokens=max_new_tokens,
+            )
+            try:
+                return output_type.model_validate_json(response)
+            except Exception as e:
+                print("Error generating structured output: ", e)
+                print("Raw model output: ", response)
+                return None
+
+        prompts = [_build_chat(system_prompt, user_prompt, image) for image in images]
+        try:
+            responses: List[str] = generator.batch(prompts, max_new_tokens=max_new_tokens)
+        except Exception as e:
+            print("Error in batch processing: ", e)
+            return None
+
+        return _parse_responses(output_type, responses)
+
+
+def _parse_responses(output_type: Type[ModelOutputType], responses: List[str]) -> List[ModelOutputType | None]:
+    parsed_responses = []
+    for i, response in enumerate(responses):
+        try:
+            parsed_responses.append(output_type.model_validate_json(response))
+        except Exception as e:
+            print(f"Error parsing response {i}: {e}")
+            print(f"Raw model output {i}: {response}")
+            parsed_responses.append(None)
+    return parsed_responses
 
-from .output_types import CarIdentificationOutputType
+
+# Keyed by object ids; the entry keeps the model and processor alive so the ids
+# cannot be reused while cached.
+_structured_generators: Dict[tuple[int, int], tuple] = {}
+
+
+def get_structured_generator(
+    model: AutoModelForImageTextToText, processor: AutoProcessor
+) -> StructuredGenerator:
+    """Returns the shared `StructuredGenerator` of a (model, processor) pair."""
+    key = (id(model), id(processor))
+    if key not in _structured_generators:
+        _structured_generators[key] = (
+            model,
+            processor,
+            StructuredGenerator(model, processor),
+        )
+    return _structured_generators[key][2]
+
+
+def _build_chat(system_prompt: str, user_prompt: str, image: Image.Image) -> Chat:
+    return Chat(
+        [
+            {
+                "role": "system",
+                "content": system_prompt,
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": OutlinesImage(image)},
+                    {"type": "text", "text": user_prompt},
+                ],
+            },
+        ]
+    )
 
 
 def get_structured_model_output(
@@ -15,7 +129,8 @@ def get_structured_model_output(
     user_prompt: str,
     images: Union[Image.Image, List[Image.Image]],
     max_new_tokens: int | None = 64,
-) -> Union[CarIdentificationOutputType, List[CarIdentificationOutputType], None]:
+    output_type: Type[BaseModel] = CarIdentificationOutputType,
+) -> Union[BaseModel, List[BaseModel | None], None]:
     """
     Gets structured model output for single image or batch of images.
     
@@ -26,82 +141,14 @@ def get_structured_model_output(
         user_prompt: User prompt for the conversation
         images: Single PIL Image or list of PIL Images
         max_new_tokens: Maximum number of tokens to generate
+        output_type: Pydantic model the output is constrained to
     
     Returns:
-        Single CarIdentificationOutputType or list of CarIdentificationOutputType, or None if error
-    """
-    outlines_model = outlines.from_transformers(model, processor)
-
-    # Handle both single image and batch of images
-    if isinstance(images, Image.Image):
-        # Single image case
-        prompt = Chat(
-            [
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": OutlinesImage(images)},
-                        {"type": "text", "text": user_prompt},
-                    ],
-                },
-            ]
-        )
-
-        response: str = outlines_model(prompt, CarIdentificationOutputType, max_new_tokens=max_new_tokens)
-
-        try:
-            # Parse the response into the structured output type
-            parsed_response = CarIdentificationOutputType.model_validate_json(response)
-            return parsed_response
-        except Exception as e:
-            print("Error generating structured output: ", e)
-            print("Raw model output: ", response)
-            return None
-    
-    else:
-        # Batch case
-        prompts = []
-        for image in images:
-            prompt = Chat(
-                [
-                    {
-                        "role": "system",
-                        "content": system_prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "image", "image": OutlinesImage(image)},
-                            {"type": "text", "text": user_prompt},
-                        ],
-                    },
-                ]
-            )
-            prompts.append(prompt)
-
-        try:
-            # Use batch processing with output type specified
-            responses: List[str] = outlines_model.batch(prompts, output_type=CarIdentificationOutputType, max_new_tokens=max_new_tokens)
-            
-            parsed_responses = []
-            for i, response in enumerate(responses):
-                try:
-                    parsed_response = CarIdentificationOutputType.model_validate_json(response)
-                    parsed_responses.append(parsed_response)
-                except Exception as e:
-                    print(f"Error parsing response {i}: {e}")
-                    print(f"Raw model output {i}: {response}")
-                    parsed_responses.append(None)
-            
-            return parsed_responses
-        
-        except Exception as e:
-            print("Error in batch processing: ", e)
-            return None
+        Single output_type instance or list of them, or None if error
+    """
+    return get_structured_generator(model, processor)(
+        output_type, system_prompt, user_prompt, images, max_new_tokens
+    )
 
 
 def get_structured_model_output_batch(
@@ -111,7 +158,8 @@ def get_structured_model_output_batch(
     user_prompt: str,
     images: List[Image.Image],
     max_new_tokens: int | None = 64,
-) -> List[CarIdentificationOutputType | None]:
+    output_type: Type[BaseModel] = CarIdentificationOutputType,
+) -> List[BaseModel | None]:
     """
     Dedicated batch processing function for structured model output.
     
@@ -122,20 +170,104 @@ def get_structured_model_output_batch(
         user_prompt: User prompt for the conversation
         images: List of PIL Images to process
         max_new_tokens: Maximum number of tokens to generate
+        output_type: Pydantic model the output is constrained to
     
     Returns:
-        List of CarIdentificationOutputType or None for each image
+        List of output_type instances or None for each image
     """
     return get_structured_model_output(
-        model, processor, system_prompt, user_prompt, images, max_new_tokens
+        model, processor, system_prompt, user_prompt, images, max_new_tokens, output_type
     )
 
+@dataclass
+class InferenceStats:
+    """Timings (seconds), token counts and peak device memory of one generation."""
+
+    preprocess_s: float
+    prefill_s: float
+    decode_s: float
+    input_tokens: int
+    output_tokens: int
+    peak_memory_mb: float = float("nan")
+
+    @property
+    def latency_s(self) -> float:
+        return self.preprocess_s + self.prefill_s + self.decode_s
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """
+    Never stops generation, only records when the first new token is ready.
+    `generate` calls stopping criteria after every step, so the first call marks
+    the end of the prefill forward pass.
+    """
+
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_time is None:
+            _synchronize(input_ids.device)
+            self.first_token_time = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class TokenCountingTimer(FirstTokenTimer):
+    """
+    `FirstTokenTimer` that also keeps the (left-padded) prompt length and the
+    latest ids, to count the input and output tokens of every row.
+    """
+
+    def __init__(self, pad_token_id: int):
+        super().__init__()
+        self.pad_token_id = pad_token_id
+        self.prompt_len = None
+        self.input_ids = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1] - 1  # one token generated so far
+        self.input_ids = input_ids
+        return super().__call__(input_ids, scores, **kwargs)
+
+    def token_counts(self) -> tuple[list[int], list[int]]:
+        """Non-padding prompt and generated tokens per row; empty before generation."""
+        if self.input_ids is None:
+            return [], []
+        real = self.input_ids != self.pad_token_id
+        return (
+            real[:, : self.prompt_len].sum(dim=1).tolist(),
+            real[:, self.prompt_len :].sum(dim=1).tolist(),
+        )
+
+
 def get_model_output(model, processor, conversation, max_new_tokens=50):
     """
     Generează text curat, lăsând procesorul să gestioneze token-ul <image>.
     """
+    text, _ = get_model_output_with_stats(model, processor, conversation, max_new_tokens)
+    return text
+
+
+def get_model_output_with_stats(
+    model, processor, conversation, max_new_tokens=50
+) -> tuple[str, InferenceStats]:
+    """
+    Same as `get_model_output`, but also measures preprocessing, prefill and
+    decode time, input/output token counts and peak device memory.
+    """
+    device = torch.device(model.device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.perf_counter()
     text_prompt = processor.apply_chat_template(conversation, add_generation_prompt=True)
-    
+
     image = None
     for message in reversed(conversation):
         if message["role"] == "user":
@@ -146,7 +278,10 @@ def get_model_output(model, processor, conversation, max_new_tokens=50):
         if image: break
 
     inputs = processor(text=text_prompt, images=image, return_tensors="pt").to(model.device)
-    
+    _synchronize(device)
+    preprocessed = time.perf_counter()
+
+    timer = FirstTokenTimer()
     output_ids = model.generate(
         **inputs,
         max_new_tokens=max_new_tokens,
@@ -155,7 +290,79 @@ def get_model_output(model, processor, conversation, max_new_tokens=50):
         repetition_penalty=1.2,
         pad_token_id=processor.tokenizer.pad_token_id,
         eos_token_id=processor.tokenizer.eos_token_id,
+        stopping_criteria=[timer],
     )
-    
+    _synchronize(device)
+    finished = time.perf_counter()
+
     generated_ids = output_ids[:, inputs['input_ids'].shape[1]:]
-    return processor.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
\ No newline at end of file
+    first_token_time = timer.first_token_time or finished
+    stats = InferenceStats(
+        preprocess_s=preprocessed - start,
+        prefill_s=first_token_time - preprocessed,
+        decode_s=finished - first_token_time,
+        input_tokens=int(inputs["input_ids"].shape[1]),
+        output_tokens=int((generated_ids != processor.tokenizer.pad_token_id).sum()),
+        peak_memory_mb=(
+            torch.cuda.max_memory_allocated(device) / 2**20
+            if device.type == "cuda"
+            else float("nan")
+        ),
+    )
+    text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
+    return text, stats
+
+
+def get_structured_outputs_with_stats(
+    structured: StructuredGenerator,
+    processor,
+    output_type: Type[ModelOutputType],
+    system_prompt: str,
+    user_prompt: str,
+    images: List[Image.Image],
+    max_new_tokens: int | None = 64,
+) -> tuple[List[ModelOutputType | None], List[InferenceStats]]:
+    """
+    Batched `StructuredGenerator` call that also returns the stats of every image.
+
+    Outlines preprocesses inside its generate call, so `prefill_s` covers
+    preprocessing and prefill (`preprocess_s` is 0). The batch timings are
+    split evenly over its images, so sums and throughput match unbatched runs
+    and the percentiles are of the per-image cost. Token counts are read from
+    the ids that generate itself ran on.
+    """
+    device = torch.device(structured.model.device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    prompts = [_build_chat(system_prompt, user_prompt, image) for image in images]
+    timer = TokenCountingTimer(processor.tokenizer.pad_token_id)
+    start = time.perf_counter()
+    try:
+        responses: List[str] = structured.generator(output_type).batch(
+            prompts, max_new_tokens=max_new_tokens, stopping_criteria=[timer]
+        )
+    except Exception as e:
+        print("Error in batch processing: ", e)
+        return [None] * len(images), []
+    _synchronize(device)
+    finished = time.perf_counter()
+    first_token_time = timer.first_token_time or finished
+    peak_memory_mb = (
+        torch.cuda.max_memory_allocated(device) / 2**20 if device.type == "cuda" else float("nan")
+    )
+
+    n = len(images)
+    input_tokens, output_tokens = timer.token_counts()
+    stats = [
+        InferenceStats(
+            preprocess_s=0.0,
+            prefill_s=(first_token_time - start) / n,
+            decode_s=(finished - first_token_time) / n,
+            input_tokens=input_tokens[i] if input_tokens else float("nan"),
+            output_tokens=output_tokens[i] if output_tokens else float("nan"),
+            peak_memory_mb=peak_memory_mb,
+        )
+        for i in range(n)
+    ]
+    return _parse_responses(output_type, responses), stats
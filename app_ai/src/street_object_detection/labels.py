@@ -0,0 +1,188 @@
+"""
+Label normalization shared by the serving backend and the evaluation code.
+
+Every label set is compiled into a single regular expression, so mapping raw
+model text to a canonical label is one scan over the text instead of a chain
+of substring checks. This module only depends on the standard library (pyarrow
+is imported lazily), so `backend/server.py` can import it without pulling in
+the training stack.
+"""
+
+import csv
+import re
+from typing import Iterable, Optional, Sequence
+
+
+class LabelNormalizer:
+    """
+    Maps free-form model output to one of a fixed set of canonical labels.
+
+    `rules` is an ordered list of `(label, synonyms)` pairs. Matching is
+    case-insensitive substring matching, and when several rules match, the one
+    listed first wins, exactly like an `if ... in text` chain would.
+    """
+
+    def __init__(
+        self,
+        rules: Sequence[tuple[str, Sequence[str]]],
+        default: Optional[str] = None,
+    ):
+        self.labels = [label for label, _ in rules]
+        self.default = default
+
+        alternatives = []
+        for i, (_, synonyms) in enumerate(rules):
+            # Longest synonyms first so the alternation never stops at a prefix
+            ordered = sorted({s.lower() for s in synonyms}, key=len, reverse=True)
+            alternatives.append(f"(?P<r{i}>{'|'.join(map(re.escape, ordered))})")
+
+        # A zero-width lookahead is tried at every position, so overlapping
+        # synonyms are all seen; at each position the alternation already picks
+        # the highest-priority rule matching there.
+        self._pattern = re.compile(f"(?=(?:{'|'.join(alternatives)}))")
+
+    def normalize(self, text: Optional[str]) -> Optional[str]:
+        """Returns the canonical label for `text`, or `default` if nothing matches."""
+        if not text:
+            return self.default
+
+        best = len(self.labels)
+        for match in self._pattern.finditer(text.lower()):
+            best = min(best, int(match.lastgroup[1:]))
+            if best == 0:
+                break
+
+        return self.labels[best] if best < len(self.labels) else self.default
+
+    __call__ = normalize
+
+    def normalize_many(self, texts: Iterable[Optional[str]]) -> list[Optional[str]]:
+        """Normalizes a column of texts, running the automaton once per distinct value."""
+        cache: dict[Optional[str], Optional[str]] = {}
+        normalized = []
+        for text in texts:
+            if text not in cache:
+                cache[text] = self.normalize(text)
+            normalized.append(cache[text])
+        return normalized
+
+    def normalize_arrow(self, column):
+        """
+        Normalizes a pyarrow string (Chunked)Array. The column is dictionary
+        encoded first, so only its distinct values go through the automaton.
+        """
+        import pyarrow as pa
+
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        encoded = column.dictionary_encode()
+        dictionary = pa.array(
+            self.normalize_many(encoded.dictionary.to_pylist()), type=pa.string()
+        )
+        return dictionary.take(encoded.indices)
+
+    def normalize_csv(
+        self,
+        csv_file_path: str,
+        column: str,
+        output_path: Optional[str] = None,
+        output_column: Optional[str] = None,
+    ) -> str:
+        """
+        Re-normalizes one column of a CSV file. Writes to `output_column`
+        (default: overwrite `column`) in `output_path` (default: in place).
+        """
+        with open(csv_file_path, newline="", encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            fieldnames = list(reader.fieldnames or [])
+            rows = list(reader)
+
+        if column not in fieldnames:
+            raise ValueError(f"Column '{column}' not found in {csv_file_path}")
+
+        output_column = output_column or column
+        if output_column not in fieldnames:
+            fieldnames.append(output_column)
+
+        for row, label in zip(rows, self.normalize_many(r[column] for r in rows)):
+            row[output_column] = label if label is not None else ""
+
+        output_path = output_path or csv_file_path
+        with open(output_path, "w", newline="", encoding="utf-8") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        return output_path
+
+
+# Evaluation: raw model text -> dataset label (red / green / zebra / none)
+PREDICTION_LABELS = LabelNormalizer(
+    [
+        ("unknown", ["cannot", "pictured", "provide", "sorry"]),
+        ("none", ["no zebra", "no traffic", "clear", "safe", "none"]),
+        ("red", ["red"]),
+        ("green", ["green"]),
+        ("zebra", ["zebra", "crosswalk", "crossing"]),
+    ],
+    default="unknown",
+)
+
+# Evaluation: label -> safety decision, used by the safety confusion matrix
+SAFETY_CATEGORIES = LabelNormalizer(
+    [
+        ("GO (Safe)", ["green"]),
+        ("STOP/ALERT (Pedestrian)", ["zebra", "crosswalk"]),
+        ("STOP (Traffic Light)", ["red", "yellow"]),
+        ("GO (Clear Road)", ["none", "clear"]),
+    ],
+    default="UNKNOWN",
+)
+
+# Evaluation: label -> detected object type, used by the type confusion matrix
+OBJECT_TYPES = LabelNormalizer(
+    [
+        ("Traffic Light", ["red", "green", "yellow"]),
+        ("Crosswalk", ["zebra", "crosswalk"]),
+        ("Background/None", ["none"]),
+    ],
+    default="Unknown",
+)
+
+# Serving: `/obstacles` answers. No default, the server decides the fallback.
+OBSTACLE_LABELS = LabelNormalizer(
+    [
+        ("Caution: Car approaching", ["Caution: Car approaching"]),
+        ("Caution: Obstacle on path", ["Caution: Obstacle on path"]),
+        ("Clear: Path is safe", ["Clear: Path is safe"]),
+        ("Caution: Unpaved surface", ["Caution: Unpaved surface"]),
+    ]
+)
+
+# Serving: `/crosswalk` answers
+CROSSWALK_LABELS = LabelNormalizer(
+    [("Safe crosswalk detected", ["Safe crosswalk detected"])],
+    default="No crosswalk",
+)
+
+# Serving: answers ordered from most to least severe, used to summarize a burst
+# of frames with `most_severe`
+OBSTACLE_SEVERITY = [
+    "Caution: Car approaching",
+    "Caution: Obstacle on path",
+    "Caution: Unknown danger",
+    "Caution: Unpaved surface",
+    "Clear: Path is safe",
+]
+CROSSWALK_SEVERITY = ["No crosswalk", "Safe crosswalk detected"]
+
+
+def most_severe(
+    results: Sequence[str], severity: Sequence[str], unlisted: Optional[str] = None
+) -> int:
+    """
+    Index of the most severe result. Results missing from `severity` rank like
+    the `unlisted` entry, or after every listed one when it is not given.
+    """
+    rank = {label: i for i, label in enumerate(severity)}
+    default = rank.get(unlisted, len(severity))
+    return min(range(len(results)), key=lambda i: rank.get(results[i], default))
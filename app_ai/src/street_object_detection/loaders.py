@@ -17,24 +17,178 @@ def fix_model_type_in_config_json(model_id: str):
         with open(config_path, "w") as f:
             json.dump(config, f, indent=2)
 
-def load_model_and_processor(model_id: str, cache_dir: str = "/models") -> tuple:
+def load_processor(model_id: str, cache_dir: str = "/models", max_image_tokens: int = 256):
     direct_path = Path(cache_dir) / model_id
     if direct_path.exists():
         fix_model_type_in_config_json(str(direct_path))
-        processor = AutoProcessor.from_pretrained(str(direct_path), max_image_tokens=256, local_files_only=True)
+        return AutoProcessor.from_pretrained(str(direct_path), max_image_tokens=max_image_tokens, local_files_only=True)
+
+    hf_token = os.getenv("HF_TOKEN")
+    if hf_token: login(token=hf_token)
+    return AutoProcessor.from_pretrained(model_id, max_image_tokens=max_image_tokens, token=hf_token)
+
+def load_model_and_processor(model_id: str, cache_dir: str = "/models", max_image_tokens: int = 256) -> tuple:
+    processor = load_processor(model_id, cache_dir, max_image_tokens)
+
+    direct_path = Path(cache_dir) / model_id
+    if direct_path.exists():
         model = AutoModelForImageTextToText.from_pretrained(
             str(direct_path), torch_dtype="bfloat16", device_map="auto", local_files_only=True
         )
         return model, processor
 
     hf_token = os.getenv("HF_TOKEN")
-    if hf_token: login(token=hf_token)
-    processor = AutoProcessor.from_pretrained(model_id, max_image_tokens=256, token=hf_token)
     model = AutoModelForImageTextToText.from_pretrained(model_id, torch_dtype="bfloat16", device_map="auto", token=hf_token)
     return model, processor
 
-def load_dataset(dataset_name, splits, n_samples=None, seed=42, cache_dir="/datasets"):
-    
+LIGHT_MAPPING = {0: "red", 1: "yellow", 2: "green"}
+
+def _format_crosswalk_test(batch):
+    texts = []
+    for i in range(len(batch['image'])):
+        is_crosswalk = False
+        if 'labels' in batch and len(batch['labels']) > i:
+            lbl = batch['labels'][i]
+            if isinstance(lbl, list) and len(lbl) > 3:
+                is_crosswalk = lbl[3] == 1
+        
+        texts.append("zebra" if is_crosswalk else "none")
+    return {'image': batch['image'], 'text_label': texts}
+
+def _format_crosswalk(batch):
+    texts = []
+    for i in range(len(batch['image'])):
+        is_crosswalk = False
+        if 'labels' in batch and len(batch['labels']) > i:
+            if isinstance(batch['labels'][i], list) and len(batch['labels'][i]) > 3:
+                is_crosswalk = batch['labels'][i][3] == 1
+        elif 'objects' in batch and len(batch['objects']) > i:
+            if len(batch['objects'][i]['category']) > 0:
+                is_crosswalk = True
+        
+        texts.append("zebra" if is_crosswalk else "none")
+    return {'image': batch['image'], 'text_label': texts}
+
+def _format_traffic_lights(batch):
+    texts = []
+    for i in range(len(batch['image'])):
+        text = "UNK"
+        if 'objects' in batch and len(batch['objects']) > i:
+            cats = batch['objects'][i].get('category', [])
+            if len(cats) > 0:
+                text = LIGHT_MAPPING.get(cats[0], "UNK")
+        elif 'label' in batch:
+            text = LIGHT_MAPPING.get(batch['label'][i], "UNK")
+        elif 'labels' in batch:
+            lbl = batch['labels'][i]
+            if isinstance(lbl, int): text = LIGHT_MAPPING.get(lbl, "UNK")
+        texts.append(text)
+    return {'image': batch['image'], 'text_label': texts}
+
+def _force_none(batch):
+    return {'text_label': ["none"] * len(batch['image'])}
+
+def _split_size(repo_id, split, cache_dir) -> int:
+    """Row count of a split from the dataset metadata; streamed datasets may not carry it."""
+    splits = datasets.load_dataset_builder(repo_id, cache_dir=cache_dir).info.splits
+    if not splits or split not in splits or not splits[split].num_examples:
+        raise ValueError(f"{repo_id} does not report the size of '{split}', cannot stream its tail")
+    return splits[split].num_examples
+
+def load_streaming_dataset(
+    dataset_name,
+    n_samples,
+    seed=42,
+    cache_dir="/datasets",
+    shuffle_buffer_size=1000,
+    mixing_probabilities=None,
+) -> datasets.IterableDataset:
+    """
+    Streaming counterpart of `load_dataset`: nothing is downloaded up front and
+    only the first `n_samples` of the mixed stream are ever read.
+
+    Crosswalk and traffic-light streams are interleaved with
+    `mixing_probabilities` (default 50/50, like the eager balance) and shuffled
+    through a bounded buffer of `shuffle_buffer_size` samples. The stream is
+    deterministic for a given seed, so `take`/`skip` give disjoint splits.
+    """
+    if dataset_name == "crosswalk-test-only":
+        print("🔍 Streaming Recaptcha Validation Set as Test...")
+        try:
+            ds = datasets.load_dataset("nobodyPerfecZ/recaptchav2-29k", split="validation", cache_dir=cache_dir, streaming=True)
+        except ValueError:
+            print(" Validation split empty, taking from end of Train...")
+            ds = datasets.load_dataset("nobodyPerfecZ/recaptchav2-29k", split="train", cache_dir=cache_dir, streaming=True)
+            ds = ds.skip(_split_size("nobodyPerfecZ/recaptchav2-29k", "train", cache_dir) - 1000)
+
+        ds = ds.map(_format_crosswalk_test, batched=True).select_columns(['image', 'text_label'])
+        return ds.shuffle(seed=seed, buffer_size=shuffle_buffer_size).take(n_samples)
+
+    print("🚶 Streaming Crosswalk Dataset (Mixed)...")
+    try:
+        ds_cross = datasets.load_dataset("nobodyPerfecZ/recaptchav2-29k", split="train", cache_dir=cache_dir, streaming=True)
+    except Exception:
+        ds_cross = datasets.load_dataset("keremberke/pedestrian-crossing-detection", "full", split="train", cache_dir=cache_dir, streaming=True)
+    ds_cross = ds_cross.map(_format_crosswalk, batched=True).select_columns(['image', 'text_label'])
+
+    print("🚦 Streaming Traffic Light Dataset...")
+    ds_lights = None
+    for repo_id in ["mehmetkeremturkcan/traffic-lights-of-new-york", "lucasvandroux/traffic-lights-classification"]:
+        try:
+            ds_lights = datasets.load_dataset(repo_id, split="train", cache_dir=cache_dir, streaming=True)
+            break
+        except Exception:
+            print(f"Traffic dataset {repo_id} failed. Trying fallback...")
+
+    if ds_lights is None:
+        # Same dummy fallback as the eager path; 50 samples would end an
+        # interleaved stream almost immediately, so they are mixed in by the shuffle
+        print("TRAFFIC LIGHT DATA MISSING OR BROKEN. Generating dummy samples.")
+        ds_lights = ds_cross.take(50).map(_force_none, batched=True)
+        mixed_ds = datasets.concatenate_datasets([ds_lights, ds_cross.skip(50)])
+    else:
+        ds_lights = ds_lights.map(_format_traffic_lights, batched=True).select_columns(['image', 'text_label'])
+        ds_lights = ds_lights.filter(lambda x: x['text_label'] != "UNK")
+        mixed_ds = datasets.interleave_datasets(
+            [ds_cross, ds_lights],
+            probabilities=mixing_probabilities or [0.5, 0.5],
+            seed=seed,
+            stopping_strategy="first_exhausted",
+        )
+
+    return mixed_ds.shuffle(seed=seed, buffer_size=shuffle_buffer_size).take(n_samples)
+
+def load_dataset(
+    dataset_name,
+    splits,
+    n_samples=None,
+    seed=42,
+    cache_dir="/datasets",
+    prepared_path=None,
+    streaming=False,
+    shuffle_buffer_size=1000,
+    mixing_probabilities=None,
+):
+
+    if streaming:
+        return load_streaming_dataset(
+            dataset_name,
+            n_samples,
+            seed=seed,
+            cache_dir=cache_dir,
+            shuffle_buffer_size=shuffle_buffer_size,
+            mixing_probabilities=mixing_probabilities,
+        )
+
+    if prepared_path is not None:
+        if not Path(prepared_path).exists():
+            raise FileNotFoundError(
+                f"No prepared dataset at {prepared_path}. Run `make prepare-data config=<config>` "
+                "with this config first, or set use_prepared_dataset: false"
+            )
+        print(f"📦 Loading prepared dataset from {prepared_path}...")
+        return datasets.load_from_disk(str(prepared_path))
+
     if dataset_name == "crosswalk-test-only":
         print("🔍 Loading Recaptcha Validation Set as Test...")
         try:
@@ -44,20 +198,8 @@ def load_dataset(dataset_name, splits, n_samples=None, seed=42, cache_dir="/data
             ds = datasets.load_dataset("nobodyPerfecZ/recaptchav2-29k", split="train", cache_dir=cache_dir)
             ds = ds.select(range(len(ds) - 1000, len(ds))) 
 
-        def format_test(batch):
-            texts = []
-            for i in range(len(batch['image'])):
-                is_crosswalk = False
-                if 'labels' in batch and len(batch['labels']) > i:
-                    lbl = batch['labels'][i]
-                    if isinstance(lbl, list) and len(lbl) > 3:
-                        is_crosswalk = lbl[3] == 1
-                
-                texts.append("zebra" if is_crosswalk else "none")
-            return {'image': batch['image'], 'text_label': texts}
-
         valid_cols = [c for c in ds.column_names if c != 'image']
-        ds = ds.map(format_test, batched=True, remove_columns=valid_cols)
+        ds = ds.map(_format_crosswalk_test, batched=True, remove_columns=valid_cols)
         
         if n_samples:
             ds = ds.shuffle(seed=seed).select(range(min(len(ds), n_samples)))
@@ -71,27 +213,11 @@ def load_dataset(dataset_name, splits, n_samples=None, seed=42, cache_dir="/data
     except:
         ds_cross = datasets.load_dataset("keremberke/pedestrian-crossing-detection", "full", split="train", cache_dir=cache_dir)
 
-    def format_cross(batch):
-        texts = []
-        for i in range(len(batch['image'])):
-            is_crosswalk = False
-            if 'labels' in batch and len(batch['labels']) > i:
-                if isinstance(batch['labels'][i], list) and len(batch['labels'][i]) > 3:
-                    is_crosswalk = batch['labels'][i][3] == 1
-            elif 'objects' in batch and len(batch['objects']) > i:
-                if len(batch['objects'][i]['category']) > 0:
-                    is_crosswalk = True
-            
-            texts.append("zebra" if is_crosswalk else "none")
-        return {'image': batch['image'], 'text_label': texts}
-
     valid_cols = [c for c in ds_cross.column_names if c != 'image']
-    ds_cross = ds_cross.map(format_cross, batched=True, remove_columns=valid_cols)
+    ds_cross = ds_cross.map(_format_crosswalk, batched=True, remove_columns=valid_cols)
 
     print("🚦 Loading Traffic Light Dataset...")
     ds_lights = None
-    light_mapping = {0: "red", 1: "yellow", 2: "green"}
-
     try:
         ds_lights = datasets.load_dataset("mehmetkeremturkcan/traffic-lights-of-new-york", split="train", cache_dir=cache_dir)
     except Exception as e:
@@ -101,26 +227,10 @@ def load_dataset(dataset_name, splits, n_samples=None, seed=42, cache_dir="/data
         except Exception as e2:
             print(f"Fallback dataset failed.")
 
-    def format_lights(batch):
-        texts = []
-        for i in range(len(batch['image'])):
-            text = "UNK"
-            if 'objects' in batch and len(batch['objects']) > i:
-                cats = batch['objects'][i].get('category', [])
-                if len(cats) > 0:
-                    text = light_mapping.get(cats[0], "UNK")
-            elif 'label' in batch:
-                text = light_mapping.get(batch['label'][i], "UNK")
-            elif 'labels' in batch:
-                lbl = batch['labels'][i]
-                if isinstance(lbl, int): text = light_mapping.get(lbl, "UNK")
-            texts.append(text)
-        return {'image': batch['image'], 'text_label': texts}
-
     if ds_lights is not None:
         cols_to_remove = [c for c in ds_lights.column_names if c != 'image']
         try:
-            ds_lights = ds_lights.map(format_lights, batched=True, remove_columns=cols_to_remove)
+            ds_lights = ds_lights.map(_format_traffic_lights, batched=True, remove_columns=cols_to_remove)
             ds_lights = ds_lights.filter(lambda x: x['text_label'] != "UNK")
         except Exception as e:
             ds_lights = None
@@ -128,9 +238,7 @@ def load_dataset(dataset_name, splits, n_samples=None, seed=42, cache_dir="/data
     if ds_lights is None or 'text_label' not in ds_lights.column_names or len(ds_lights) == 0:
         print("TRAFFIC LIGHT DATA MISSING OR BROKEN. Generating dummy samples.")
         ds_lights = ds_cross.select(range(min(50, len(ds_cross))))
-        def force_none(batch):
-            return {'text_label': ["none"] * len(batch['image'])}
-        ds_lights = ds_lights.map(force_none, batched=True)
+        ds_lights = ds_lights.map(_force_none, batched=True)
 
     ds_cross = ds_cross.select_columns(['image', 'text_label'])
     ds_lights = ds_lights.select_columns(['image', 'text_label'])
@@ -65,10 +65,22 @@ class CarIdentificationOutputType(BaseModel):
         return instance.model_dump_json()
 
 
+class PedestrianLabelOutputType(BaseModel):
+    pred_class: Literal["red", "green", "zebra", "none"]
+
+    @classmethod
+    def from_pred_class(cls, pred_class: str) -> str:
+        """Create instance from pred_class and return as JSON string."""
+        instance = cls(pred_class=pred_class)
+        return instance.model_dump_json()
+
+
 def get_model_output_schema(dataset_name: str) -> BaseModel:
     if dataset_name == "microsoft/cats_vs_dogs":
         return CatsVsDogsClassificationOutputType
     elif "stanford_cars" in dataset_name:
         return CarIdentificationOutputType
+    elif "pedestrian" in dataset_name or "crosswalk" in dataset_name:
+        return PedestrianLabelOutputType
     else:
         raise ValueError(f"Unsupported dataset: {dataset_name}")
\ No newline at end of file
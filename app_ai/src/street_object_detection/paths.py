@@ -17,6 +17,14 @@ def get_path_to_evals() -> str:
     return path
 
 
+def get_path_to_benchmarks() -> str:
+    path = str(Path(__file__).parent.parent.parent / "benchmarks")
+
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    return path
+
+
 from pathlib import Path
 
 def get_path_model_checkpoints_in_modal_volume(experiment_name: str) -> Path:
@@ -27,6 +35,40 @@ def get_path_model_checkpoints_in_modal_volume(experiment_name: str) -> Path:
     return base_path / experiment_name
 
 
+def get_path_preprocessed_cache_in_modal_volume(fingerprint: str) -> Path:
+    """
+    Returns the path of a preprocessed (tokenized) dataset cache within the
+    Modal Volume.
+    """
+    base_path = Path("/model_checkpoints") / "preprocessed"
+    return base_path / fingerprint
+
+
+def get_path_vision_feature_cache_in_modal_volume(
+    fingerprint: str, model_name: str, split: str
+) -> Path:
+    """
+    Returns the path of the cached vision-tower embeddings for a preprocessed
+    dataset cache and a base model within the Modal Volume.
+    """
+    model_short = model_name.replace("/", "--")
+    return (
+        get_path_preprocessed_cache_in_modal_volume(fingerprint)
+        / f"vision-{model_short}"
+        / split
+    )
+
+
+def get_path_prepared_dataset_in_modal_volume(
+    dataset_name: str, n_samples: int | None, seed: int, max_edge: int
+) -> Path:
+    """
+    Returns the path of a pre-resized, sharded dataset within the Modal Volume.
+    """
+    base_path = Path("/datasets") / "prepared"
+    return base_path / f"{dataset_name}-{n_samples or 'all'}-seed{seed}-{max_edge}px"
+
+
 def get_path_model_checkpoints() -> str:
     """Returns path to the local model checkpoints."""
     path = str(Path(__file__).parent.parent.parent / "model_checkpoints")
@@ -0,0 +1,64 @@
+"""
+Offline image preparation: every image is resized once to the processor's tile
+size, re-encoded as JPEG and written into sharded Arrow files that
+`load_dataset(prepared_path=...)` memory-maps directly.
+"""
+
+from .config import FineTuningConfig
+from .data_preparation import get_prepared_dataset_path, prepare_images
+from .loaders import load_dataset, load_processor
+from .modal_infra import get_docker_image, get_modal_app, get_secrets, get_volume
+
+app = get_modal_app("pedestrian-assistant")
+image = get_docker_image()
+datasets_volume = get_volume("datasets")
+
+SHARD_SIZE = "256MB"
+
+
+@app.function(
+    image=image,
+    cpu=8.0,
+    volumes={"/datasets": datasets_volume},
+    secrets=get_secrets(),
+    timeout=2 * 60 * 60,
+)
+def prepare_dataset(config: FineTuningConfig) -> str:
+    """Builds the pre-resized, sharded copy of the fine-tuning dataset."""
+    processor = load_processor(config.model_name, max_image_tokens=config.max_image_tokens)
+    output_path, max_edge = get_prepared_dataset_path(config, processor)
+
+    dataset = load_dataset(
+        dataset_name=config.dataset_name,
+        splits=config.dataset_splits,
+        n_samples=config.dataset_samples,
+        seed=config.seed,
+    )
+    # Materialize the shuffled order once so the saved shards read sequentially
+    dataset = dataset.flatten_indices(num_proc=config.preprocessing_workers)
+
+    print(f"🖼️  Resizing {len(dataset)} images to max {max_edge}px "
+          f"with {config.preprocessing_workers} workers...")
+    dataset = prepare_images(
+        dataset, config.dataset_image_column, max_edge, config.preprocessing_workers
+    )
+
+    dataset.save_to_disk(
+        str(output_path),
+        max_shard_size=SHARD_SIZE,
+        num_proc=config.preprocessing_workers,
+    )
+    datasets_volume.commit()
+    print(f"💾 Prepared dataset saved to: {output_path}")
+    return str(output_path)
+
+
+@app.local_entrypoint()
+def main(config_file_name: str):
+    """
+    Prepares the dataset of a fine-tuning config. Set `use_prepared_dataset`
+    in the same config to train on it.
+    """
+    config = FineTuningConfig.from_yaml(config_file_name)
+    output_path = prepare_dataset.remote(config=config)
+    print(f"✅ Dataset prepared at {output_path}")
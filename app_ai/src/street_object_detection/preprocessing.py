@@ -0,0 +1,180 @@
+"""Offline tokenization of the SFT dataset into a fingerprinted Arrow cache."""
+
+import hashlib
+import json
+import shutil
+
+import datasets
+import torch
+from datasets import Dataset
+
+from .config import FineTuningConfig
+from .data_preparation import (
+    build_conversation,
+    get_prepared_dataset_path,
+    split_dataset,
+)
+from .loaders import load_dataset
+from .paths import get_path_preprocessed_cache_in_modal_volume
+
+# Processor outputs with one row per sequence; every other output (pixel values,
+# masks, spatial shapes) has one row per image tile.
+TEXT_KEYS = ("input_ids", "attention_mask")
+
+
+def get_cache_fingerprint(config: FineTuningConfig, processor) -> str:
+    """
+    Hashes everything that changes the tokenized tensors: the dataset and how
+    it is sampled and split, the prompts, the processor configuration and the
+    image-token budget.
+    """
+    payload = {
+        "dataset": {
+            "name": config.dataset_name,
+            "splits": config.dataset_splits,
+            "samples": config.dataset_samples,
+            "seed": config.seed,
+            "train_split_ratio": config.train_split_ratio,
+            "image_column": config.dataset_image_column,
+            "label_column": config.dataset_label_colum,
+            "label_mapping": config.label_mapping,
+            "prepared": config.use_prepared_dataset,
+        },
+        "system_prompt": config.system_prompt,
+        "user_prompt": config.user_prompt,
+        "max_image_tokens": config.max_image_tokens,
+        "image_processor": processor.image_processor.to_dict(),
+        "tokenizer": {
+            "name": processor.tokenizer.name_or_path,
+            "vocab_size": len(processor.tokenizer),
+            "chat_template": processor.chat_template,
+        },
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def tokenize_dataset(
+    dataset: Dataset, config: FineTuningConfig, processor
+) -> Dataset:
+    """Runs the chat template, image preprocessing and tokenization once per sample."""
+
+    def tokenize_sample(sample):
+        answer = sample[config.dataset_label_colum]
+        if config.label_mapping:
+            answer = config.label_mapping.get(answer, answer)
+
+        conversation = build_conversation(
+            sample[config.dataset_image_column],
+            answer,
+            config.system_prompt,
+            config.user_prompt,
+        )
+        batch = processor.apply_chat_template(
+            [conversation], tokenize=True, return_dict=True, return_tensors="np"
+        )
+        return {
+            key: value[0] if key in TEXT_KEYS else value
+            for key, value in batch.items()
+        }
+
+    return dataset.map(
+        tokenize_sample,
+        remove_columns=dataset.column_names,
+        num_proc=config.preprocessing_workers,
+        desc="Tokenizing",
+    )
+
+
+def load_or_build_preprocessed_datasets(
+    config: FineTuningConfig, processor
+) -> tuple[Dataset, Dataset]:
+    """
+    Returns the tokenized (train, eval) datasets, memory-mapped from the Arrow
+    cache. On a cache miss the raw dataset is loaded, split and tokenized, and
+    the result is written to the cache for the next job.
+    """
+    fingerprint = get_cache_fingerprint(config, processor)
+    cache_path = get_path_preprocessed_cache_in_modal_volume(fingerprint)
+
+    if not (cache_path / "train").exists():
+        print(f"🧮 No preprocessed cache for {fingerprint}, tokenizing the dataset...")
+        raw_ds = load_dataset(
+            dataset_name=config.dataset_name,
+            splits=config.dataset_splits,
+            n_samples=config.dataset_samples,
+            seed=config.seed,
+            prepared_path=(
+                get_prepared_dataset_path(config, processor)[0]
+                if config.use_prepared_dataset
+                else None
+            ),
+        )
+        train_raw, eval_raw = split_dataset(
+            raw_ds, test_size=(1 - config.train_split_ratio), seed=config.seed
+        )
+
+        # Write next to the final location and move it in place at the end, so
+        # an interrupted job never leaves a half-written cache behind.
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tokenize_dataset(train_raw, config, processor).save_to_disk(
+            str(tmp_path / "train")
+        )
+        tokenize_dataset(eval_raw, config, processor).save_to_disk(
+            str(tmp_path / "eval")
+        )
+        shutil.rmtree(cache_path, ignore_errors=True)
+        tmp_path.rename(cache_path)
+    else:
+        print(f"♻️  Reusing preprocessed cache {fingerprint}")
+
+    train_dataset = datasets.load_from_disk(str(cache_path / "train"))
+    eval_dataset = datasets.load_from_disk(str(cache_path / "eval"))
+    train_dataset.set_format("torch")
+    eval_dataset.set_format("torch")
+    return train_dataset, eval_dataset
+
+
+def pad_and_cat(tensors: list[torch.Tensor]) -> torch.Tensor:
+    """Concatenates per-sample image tensors, zero-padding trailing dims if needed."""
+    trailing = [max(sizes) for sizes in zip(*(t.shape[1:] for t in tensors))]
+    padded = []
+    for tensor in tensors:
+        pad = []
+        for size, target in zip(reversed(tensor.shape[1:]), reversed(trailing)):
+            pad.extend([0, target - size])
+        padded.append(torch.nn.functional.pad(tensor, pad) if any(pad) else tensor)
+    return torch.cat(padded)
+
+
+def create_pretokenized_collate_fn(processor):
+    """
+    Collate function for the preprocessed cache. Samples are already tokenized,
+    so batching only pads the token sequences and stacks the image tensors.
+    """
+    pad_token_id = processor.tokenizer.pad_token_id
+    pad_left = processor.tokenizer.padding_side == "left"
+
+    def collate_fn(samples):
+        max_length = max(len(s["input_ids"]) for s in samples)
+        input_ids = torch.full((len(samples), max_length), pad_token_id)
+        attention_mask = torch.zeros((len(samples), max_length), dtype=torch.long)
+
+        for i, sample in enumerate(samples):
+            length = len(sample["input_ids"])
+            columns = slice(max_length - length, None) if pad_left else slice(0, length)
+            input_ids[i, columns] = sample["input_ids"]
+            attention_mask[i, columns] = sample["attention_mask"]
+
+        batch = {"input_ids": input_ids, "attention_mask": attention_mask}
+        for key in samples[0]:
+            if key not in TEXT_KEYS:
+                batch[key] = pad_and_cat([s[key] for s in samples])
+
+        labels = input_ids.clone()
+        labels[labels == pad_token_id] = -100
+        batch["labels"] = labels
+        return batch
+
+    return collate_fn
@@ -1,87 +1,366 @@
 import csv
-import textwrap
 from datetime import datetime
 from pathlib import Path
-from typing import Self
+from typing import Iterable, Self
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.metrics import confusion_matrix
 
+from .labels import OBJECT_TYPES, SAFETY_CATEGORIES, LabelNormalizer
 from .paths import get_path_to_evals
 
+UNKNOWN_LABEL = "unknown"
+STATS_FIELDS = [
+    "preprocess_s",
+    "prefill_s",
+    "decode_s",
+    "input_tokens",
+    "output_tokens",
+    "peak_memory_mb",
+]
+CSV_FIELDS = ["ground_truth", "predicted", "correct"] + STATS_FIELDS
+
+
 class EvalReport:
-    def __init__(self):
-        self.records = []
-
-    def add_record(self, image, ground_truth: str, predicted: str):
-        gt_clean = ground_truth.strip().lower()
-        pred_clean = predicted.strip().lower()
-        
-        is_correct = gt_clean == pred_clean
-        if pred_clean == 'unknown':
-            is_correct = False
-
-        self.records.append({
-            "ground_truth": gt_clean,
-            "predicted": pred_clean,
-            "correct": is_correct,
-        })
-
-    def to_csv(self) -> str:
+    """
+    Columnar evaluation report.
+
+    Labels are stored once in a small vocabulary and every record only keeps
+    the integer codes of its ground truth and prediction, so a million rows
+    take a few MB. The detailed confusion counts are updated on every add,
+    which makes accuracy and the confusion matrices O(vocabulary) instead of
+    O(records).
+
+    Each record can also carry the `InferenceStats` of its generation. The stats
+    columns are only allocated once the first stats arrive; missing values are
+    stored as NaN and ignored by `latency_summary`.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._labels: list[str] = []
+        self._label_codes: dict[str, int] = {}
+        self._gt = np.empty(capacity, dtype=np.int16)
+        self._pred = np.empty(capacity, dtype=np.int16)
+        self._stats: dict[str, np.ndarray] = {}
+        self._size = 0
+        self._confusion = np.zeros((8, 8), dtype=np.int64)
+        self._n_correct = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getstate__(self) -> dict:
+        # Drop the unused capacity so shipping a report between workers is cheap
+        state = self.__dict__.copy()
+        n_labels = len(self._labels)
+        state["_gt"] = self._gt[: self._size].copy()
+        state["_pred"] = self._pred[: self._size].copy()
+        state["_stats"] = {
+            name: column[: self._size].copy() for name, column in self._stats.items()
+        }
+        state["_confusion"] = self._confusion[:n_labels, :n_labels].copy()
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if self._confusion.shape[0] == 0:
+            self._confusion = np.zeros((8, 8), dtype=np.int64)
+
+    @property
+    def labels(self) -> list[str]:
+        return list(self._labels)
+
+    @property
+    def ground_truth(self) -> np.ndarray:
+        return np.asarray(self._labels, dtype=object)[self._gt[: self._size]]
+
+    @property
+    def predicted(self) -> np.ndarray:
+        return np.asarray(self._labels, dtype=object)[self._pred[: self._size]]
+
+    @property
+    def correct(self) -> np.ndarray:
+        gt = self._gt[: self._size]
+        pred = self._pred[: self._size]
+        unknown = self._label_codes.get(UNKNOWN_LABEL, -1)
+        return (gt == pred) & (pred != unknown)
+
+    def stats_column(self, name: str) -> np.ndarray:
+        if name not in self._stats:
+            return np.full(self._size, np.nan, dtype=np.float32)
+        return self._stats[name][: self._size]
+
+    def _ensure_stats(self):
+        if not self._stats:
+            self._stats = {
+                name: np.full(len(self._gt), np.nan, dtype=np.float32)
+                for name in STATS_FIELDS
+            }
+
+    @property
+    def records(self) -> list[dict]:
+        return [
+            {"ground_truth": gt, "predicted": pred, "correct": bool(ok)}
+            for gt, pred, ok in zip(self.ground_truth, self.predicted, self.correct)
+        ]
+
+    def _code(self, label: str) -> int:
+        code = self._label_codes.get(label)
+        if code is not None:
+            return code
+
+        code = len(self._labels)
+        self._labels.append(label)
+        self._label_codes[label] = code
+
+        if code > np.iinfo(self._gt.dtype).max:
+            self._gt = self._gt.astype(np.int32)
+            self._pred = self._pred.astype(np.int32)
+
+        if code >= self._confusion.shape[0]:
+            grown = np.zeros((2 * self._confusion.shape[0],) * 2, dtype=np.int64)
+            n = self._confusion.shape[0]
+            grown[:n, :n] = self._confusion
+            self._confusion = grown
+        return code
+
+    def _reserve(self, extra: int):
+        needed = self._size + extra
+        if needed <= len(self._gt):
+            return
+        capacity = max(needed, 2 * len(self._gt))
+        for name in ("_gt", "_pred"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            setattr(self, name, grown)
+        for name, column in self._stats.items():
+            grown = np.full(capacity, np.nan, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            self._stats[name] = grown
+
+    def add_record(self, ground_truth: str, predicted: str, stats=None):
+        gt = self._code(ground_truth.strip().lower())
+        pred = self._code(predicted.strip().lower())
+        self._reserve(1)
+        self._gt[self._size] = gt
+        self._pred[self._size] = pred
+        if stats is not None:
+            self._ensure_stats()
+            for name, column in self._stats.items():
+                column[self._size] = getattr(stats, name)
+        self._size += 1
+
+        self._confusion[gt, pred] += 1
+        if gt == pred and self._labels[pred] != UNKNOWN_LABEL:
+            self._n_correct += 1
+
+    def add_records(
+        self,
+        ground_truths: Iterable[str],
+        predictions: Iterable[str],
+        stats: dict[str, Iterable[float]] | None = None,
+    ):
+        """
+        Bulk version of `add_record`, encoding each distinct label only once.
+        `stats` maps names from `STATS_FIELDS` to one value per record.
+        """
+        gt_values = [str(g).strip().lower() for g in ground_truths]
+        pred_values = [str(p).strip().lower() for p in predictions]
+        if len(gt_values) != len(pred_values):
+            raise ValueError("ground_truths and predictions must have the same length")
+        if not gt_values:
+            return
+
+        uniques, inverse = np.unique(
+            np.asarray(gt_values + pred_values, dtype=object), return_inverse=True
+        )
+        codes = np.asarray([self._code(label) for label in uniques])[inverse]
+        self._append_codes(codes[: len(gt_values)], codes[len(gt_values) :], stats)
+
+    def _append_codes(self, gt: np.ndarray, pred: np.ndarray, stats=None):
+        self._reserve(len(gt))
+        rows = slice(self._size, self._size + len(gt))
+        self._gt[rows] = gt
+        self._pred[rows] = pred
+        if stats:
+            self._ensure_stats()
+        for name, values in (stats or {}).items():
+            self._stats[name][rows] = np.asarray(values, dtype=np.float32)
+        self._size += len(gt)
+
+        np.add.at(self._confusion, (gt, pred), 1)
+        unknown = self._label_codes.get(UNKNOWN_LABEL, -1)
+        self._n_correct += int(np.count_nonzero((gt == pred) & (pred != unknown)))
+
+    def merge(self, other: "EvalReport") -> Self:
+        """Appends the records of another report (e.g. from another shard)."""
+        if len(other) == 0:
+            return self
+        remap = np.asarray([self._code(label) for label in other._labels])
+        self._append_codes(
+            remap[other._gt[: other._size]],
+            remap[other._pred[: other._size]],
+            {name: other.stats_column(name) for name in other._stats},
+        )
+        return self
+
+    @classmethod
+    def merge_all(cls, reports: Iterable["EvalReport"]) -> "EvalReport":
+        merged = cls()
+        for report in reports:
+            merged.merge(report)
+        return merged
+
+    def to_csv(self, prefix: str = "predictions") -> str:
         path = Path(get_path_to_evals())
-        
+
         if not path.exists():
             path.mkdir(parents=True, exist_ok=True)
-            
+
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        csv_file_path = str(path / f"predictions_{timestamp}.csv")
-        
+        csv_file_path = str(path / f"{prefix}_{timestamp}.csv")
+
         with open(csv_file_path, "w", newline="", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=["ground_truth", "predicted", "correct"])
-            writer.writeheader()
-            writer.writerows(self.records)
-            
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_FIELDS)
+            stats = [
+                ["" if np.isnan(v) else f"{v:.6g}" for v in self.stats_column(name)]
+                for name in STATS_FIELDS
+            ]
+            writer.writerows(
+                zip(self.ground_truth, self.predicted, self.correct, *stats)
+            )
+
         print(f"📄 Predictions saved locally to: {csv_file_path}")
         return csv_file_path
 
+    @classmethod
+    def from_csv(
+        cls, csv_file_path: str, normalizer: LabelNormalizer | None = None
+    ) -> "EvalReport":
+        """
+        Loads a predictions CSV. With a `normalizer`, the predicted column is
+        re-normalized first, which re-scores the run with the current rules.
+        """
+        with open(csv_file_path, newline="", encoding="utf-8") as csvfile:
+            rows = list(csv.DictReader(csvfile))
+
+        predicted = [row["predicted"] for row in rows]
+        if normalizer is not None:
+            predicted = normalizer.normalize_many(predicted)
+
+        report = cls(capacity=max(len(rows), 1))
+        stats = {
+            name: [float(row[name] or "nan") for row in rows]
+            for name in STATS_FIELDS
+            if rows and name in rows[0]
+        }
+        report.add_records([row["ground_truth"] for row in rows], predicted, stats)
+        return report
+
+    def to_arrow(self):
+        """Returns the records as a dictionary-encoded `pyarrow.Table`."""
+        import pyarrow as pa
+
+        dictionary = pa.array(self._labels, type=pa.string())
+        return pa.table(
+            {
+                "ground_truth": pa.DictionaryArray.from_arrays(
+                    pa.array(self._gt[: self._size]), dictionary
+                ),
+                "predicted": pa.DictionaryArray.from_arrays(
+                    pa.array(self._pred[: self._size]), dictionary
+                ),
+                "correct": pa.array(self.correct),
+                **{name: pa.array(self.stats_column(name)) for name in STATS_FIELDS},
+            }
+        )
+
+    @classmethod
+    def from_arrow(
+        cls, table, normalizer: LabelNormalizer | None = None
+    ) -> "EvalReport":
+        import pyarrow as pa
+
+        predicted = table.column("predicted")
+        if normalizer is not None:
+            predicted = normalizer.normalize_arrow(predicted.cast(pa.string()))
+
+        report = cls(capacity=max(table.num_rows, 1))
+        report.add_records(
+            table.column("ground_truth").to_pylist(),
+            predicted.to_pylist(),
+            {
+                name: table.column(name).to_numpy(zero_copy_only=False)
+                for name in STATS_FIELDS
+                if name in table.column_names
+            },
+        )
+        return report
+
+    def to_parquet(self, prefix: str = "predictions") -> str:
+        import pyarrow.parquet as pq
+
+        path = Path(get_path_to_evals())
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        parquet_file_path = str(path / f"{prefix}_{timestamp}.parquet")
+        pq.write_table(self.to_arrow(), parquet_file_path)
+
+        print(f"📄 Predictions saved locally to: {parquet_file_path}")
+        return parquet_file_path
+
+    @classmethod
+    def from_parquet(
+        cls, parquet_file_path: str, normalizer: LabelNormalizer | None = None
+    ) -> "EvalReport":
+        import pyarrow.parquet as pq
+
+        return cls.from_arrow(pq.read_table(parquet_file_path), normalizer)
+
     def _get_safety_category(self, text: str) -> str:
-        t = text.lower()
-        if "green" in t: return "GO (Safe)"
-        if "zebra" in t or "crosswalk" in t: return "STOP/ALERT (Pedestrian)"
-        if "red" in t or "yellow" in t: return "STOP (Traffic Light)"
-        if "none" in t or "clear" in t: return "GO (Clear Road)"
-        return "UNKNOWN"
+        return SAFETY_CATEGORIES.normalize(text)
 
     def _get_object_type(self, text: str) -> str:
-        t = text.lower()
-        if "red" in t or "green" in t or "yellow" in t: return "Traffic Light"
-        if "zebra" in t or "crosswalk" in t: return "Crosswalk"
-        if "none" in t: return "Background/None"
-        return "Unknown"
+        return OBJECT_TYPES.normalize(text)
 
-    def plot_matrix(self, mode="detailed"):
-        if not self.records: return None
+    def confusion_counts(self, mode="detailed") -> tuple[list[str], np.ndarray]:
+        """
+        Returns the classes seen so far and their confusion counts for a mode.
+        The safety and type matrices are aggregated from the detailed counts,
+        so categories are derived once per label, not once per record.
+        """
+        n_labels = len(self._labels)
+        confusion = self._confusion[:n_labels, :n_labels]
 
         if mode == "safety":
-            gt = [self._get_safety_category(r["ground_truth"]) for r in self.records]
-            pred = [self._get_safety_category(r["predicted"]) for r in self.records]
-            title = "Safety Decision Matrix"
+            categories = [self._get_safety_category(label) for label in self._labels]
         elif mode == "type":
-            gt = [self._get_object_type(r["ground_truth"]) for r in self.records]
-            pred = [self._get_object_type(r["predicted"]) for r in self.records]
-            title = "Object Detection Matrix"
+            categories = [self._get_object_type(label) for label in self._labels]
         else:
-            gt = [r["ground_truth"] for r in self.records]
-            pred = [r["predicted"] for r in self.records]
-            title = "Detailed Confusion Matrix"
+            categories = list(self._labels)
 
-        classes = sorted(list(set(gt + pred)))
-        if not classes: return None
+        classes = sorted(set(categories))
+        class_index = {name: i for i, name in enumerate(classes)}
+        index = np.asarray([class_index[c] for c in categories], dtype=np.int64)
+
+        cm = np.zeros((len(classes), len(classes)), dtype=np.int64)
+        np.add.at(cm, (index[:, None], index[None, :]), confusion)
+
+        seen = (cm.sum(axis=0) + cm.sum(axis=1)) > 0
+        return [c for c, keep in zip(classes, seen) if keep], cm[seen][:, seen]
+
+    def plot_matrix(self, mode="detailed"):
+        if not self._size: return None
 
-        try:
-            cm = confusion_matrix(gt, pred, labels=classes)
-        except ValueError: return None
+        titles = {
+            "safety": "Safety Decision Matrix",
+            "type": "Object Detection Matrix",
+        }
+        title = titles.get(mode, "Detailed Confusion Matrix")
+
+        classes, cm = self.confusion_counts(mode)
+        if not classes: return None
 
         fig, ax = plt.subplots(figsize=(10, 8))
         sns.heatmap(cm, annot=True, fmt="d", cmap="Blues", xticklabels=classes, yticklabels=classes)
@@ -93,6 +372,55 @@ class EvalReport:
         plt.tight_layout()
         return fig
 
-    def get_accuracy(self) -> float:
-        if not self.records: return 0.0
-        return sum(1 for r in self.records if r["correct"]) / len(self.records)
\ No newline at end of file
+    def get_accuracy(self, mode="detailed") -> float:
+        """
+        Share of records whose prediction matches the ground truth. With the
+        "safety" or "type" mode, a prediction counts as correct when it falls in
+        the same category as the ground truth.
+        """
+        if not self._size: return 0.0
+        if mode in ("safety", "type"):
+            _, cm = self.confusion_counts(mode)
+            return float(np.trace(cm) / self._size)
+        return self._n_correct / self._size
+
+    def latency_summary(self) -> dict[str, float]:
+        """
+        p50/p95 of each latency stage and the end-to-end latency, plus
+        throughput, token counts and peak memory over the records with stats.
+        """
+        preprocess = self.stats_column("preprocess_s").astype(np.float64)
+        prefill = self.stats_column("prefill_s").astype(np.float64)
+        decode = self.stats_column("decode_s").astype(np.float64)
+        output_tokens = self.stats_column("output_tokens").astype(np.float64)
+        input_tokens = self.stats_column("input_tokens").astype(np.float64)
+
+        timed = ~(np.isnan(preprocess) | np.isnan(prefill) | np.isnan(decode))
+        if not timed.any():
+            return {}
+
+        summary = {}
+        stages = {
+            "latency": (preprocess + prefill + decode)[timed],
+            "preprocess": preprocess[timed],
+            "prefill": prefill[timed],
+            "decode": decode[timed],
+        }
+        for stage, values in stages.items():
+            summary[f"{stage}_p50_s"] = float(np.percentile(values, 50))
+            summary[f"{stage}_p95_s"] = float(np.percentile(values, 95))
+
+        generation_s = (prefill + decode)[timed].sum()
+        decode_s = decode[timed].sum()
+        n_output = output_tokens[timed]
+        summary["tokens_per_s"] = float(n_output.sum() / max(generation_s, 1e-9))
+        summary["decode_tokens_per_s"] = float(
+            np.clip(n_output - 1, 0, None).sum() / max(decode_s, 1e-9)
+        )
+        summary["mean_input_tokens"] = float(input_tokens[timed].mean())
+        summary["mean_output_tokens"] = float(n_output.mean())
+
+        peak_memory = self.stats_column("peak_memory_mb")
+        if not np.isnan(peak_memory).all():
+            summary["peak_memory_mb"] = float(np.nanmax(peak_memory))
+        return summary
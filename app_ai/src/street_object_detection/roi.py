@@ -0,0 +1,113 @@
+"""
+Region-of-interest cropping for path checks, shared by the serving backend and
+the evaluation code.
+
+A pedestrian's path is the lower-central part of a handheld camera frame; sky
+and building tops only cost image tokens. `compute_roi` returns that walking
+corridor, optionally starting just above a cheap horizon estimate. This module
+only depends on Pillow, so `backend/server.py` can import it without pulling in
+the training stack.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+# Horizon search runs on a tiny grayscale copy; the estimate only needs to be
+# right to a few percent of the frame height.
+_HORIZON_WIDTH = 64
+_HORIZON_HEIGHT = 48
+
+
+@dataclass(frozen=True)
+class RoiConfig:
+    """
+    Walking corridor as fractions of the frame.
+
+    The corridor spans `width` of the frame, centered, from `top` down to
+    `bottom`. With `use_horizon`, `top` is replaced by the estimated horizon
+    minus `horizon_margin`, but the corridor is kept at least `min_height` tall.
+    """
+
+    top: float = 0.35
+    bottom: float = 1.0
+    width: float = 0.7
+    use_horizon: bool = False
+    horizon_margin: float = 0.05
+    min_height: float = 0.4
+
+
+@dataclass(frozen=True)
+class RoiBox:
+    """Crop box as (left, top, right, bottom) fractions of the frame."""
+
+    left: float
+    top: float
+    right: float
+    bottom: float
+
+    def to_pixels(self, size: tuple[int, int]) -> tuple[int, int, int, int]:
+        width, height = size
+        return (
+            round(self.left * width),
+            round(self.top * height),
+            round(self.right * width),
+            round(self.bottom * height),
+        )
+
+    def as_list(self) -> list[float]:
+        return [round(v, 4) for v in (self.left, self.top, self.right, self.bottom)]
+
+
+def estimate_horizon(image: Image.Image) -> Optional[float]:
+    """
+    Estimates the horizon as a fraction of the frame height.
+
+    Rows are averaged on a 64x48 grayscale thumbnail and the horizon is taken as
+    the row that best splits the frame into a bright, flat upper part (sky,
+    facades) and a darker lower part (road, pavement). Returns None when no row
+    separates them clearly, e.g. for a camera pointed at the ground.
+    """
+    small = image.convert("L").resize(
+        (_HORIZON_WIDTH, _HORIZON_HEIGHT), Image.Resampling.BILINEAR
+    )
+    pixels = list(small.getdata())
+    rows = [
+        sum(pixels[r * _HORIZON_WIDTH : (r + 1) * _HORIZON_WIDTH]) / _HORIZON_WIDTH
+        for r in range(_HORIZON_HEIGHT)
+    ]
+
+    total = sum(rows)
+    best_row, best_score = None, 0.0
+    above = sum(rows[: _HORIZON_HEIGHT // 5])
+    # Only consider horizons between 20% and 70% of the frame height
+    for r in range(_HORIZON_HEIGHT // 5, int(_HORIZON_HEIGHT * 0.7)):
+        mean_above = above / r
+        mean_below = (total - above) / (_HORIZON_HEIGHT - r)
+        score = mean_above - mean_below
+        if score > best_score:
+            best_row, best_score = r, score
+        above += rows[r]
+
+    # Require a clear brightness step (in 0-255 gray levels)
+    if best_row is None or best_score < 12:
+        return None
+    return best_row / _HORIZON_HEIGHT
+
+
+def compute_roi(image: Image.Image, config: RoiConfig = RoiConfig()) -> RoiBox:
+    """Walking-corridor box of `image` for `config`."""
+    top = config.top
+    if config.use_horizon:
+        horizon = estimate_horizon(image)
+        if horizon is not None:
+            top = max(0.0, horizon - config.horizon_margin)
+    top = min(top, config.bottom - config.min_height)
+
+    margin = (1.0 - config.width) / 2
+    return RoiBox(left=margin, top=max(0.0, top), right=1.0 - margin, bottom=config.bottom)
+
+
+def crop_to_roi(image: Image.Image, box: RoiBox) -> Image.Image:
+    return image.crop(box.to_pixels(image.size))
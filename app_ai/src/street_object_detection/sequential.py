@@ -0,0 +1,133 @@
+"""
+Sequential early stopping for evaluations.
+
+Instead of always scoring every sample, `SequentialStopper` looks at the running
+`EvalReport` every `check_every` samples and stops once
+
+- the Wilson interval on accuracy, and on the recall of each watched safety
+  class, is narrower than `target_width`, or
+- the comparison with a reference run is decided: the Newcombe interval on the
+  accuracy difference no longer contains 0.
+
+Every look is another chance to stop on noise, so checks are spaced out and
+start after `min_samples`; raise `confidence` when screening with many looks.
+"""
+
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Optional
+
+from .report import EvalReport
+
+STOP_CLASSES = ["STOP/ALERT (Pedestrian)", "STOP (Traffic Light)"]
+
+
+def wilson_interval(successes: int, n: int, confidence: float = 0.95) -> tuple[float, float]:
+    """Wilson score interval of a binomial proportion."""
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    half_width = z * (p * (1 - p) / n + z**2 / (4 * n**2)) ** 0.5 / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def difference_interval(
+    successes: int, n: int, ref_successes: int, ref_n: int, confidence: float = 0.95
+) -> tuple[float, float]:
+    """Newcombe's interval on `p - p_ref` for two independent proportions."""
+    p, ref_p = successes / max(n, 1), ref_successes / max(ref_n, 1)
+    low, high = wilson_interval(successes, n, confidence)
+    ref_low, ref_high = wilson_interval(ref_successes, ref_n, confidence)
+    diff = p - ref_p
+    return (
+        diff - ((p - low) ** 2 + (ref_high - ref_p) ** 2) ** 0.5,
+        diff + ((high - p) ** 2 + (ref_p - ref_low) ** 2) ** 0.5,
+    )
+
+
+def recall_counts(report: EvalReport, mode: str = "safety") -> dict[str, tuple[int, int]]:
+    """(correct, total) ground-truth counts per class of a confusion mode."""
+    classes, cm = report.confusion_counts(mode)
+    return {name: (int(cm[i, i]), int(cm[i].sum())) for i, name in enumerate(classes)}
+
+
+def correct_count(report: EvalReport, mode: str = "detailed") -> int:
+    return int(round(report.get_accuracy(mode) * len(report)))
+
+
+@dataclass
+class SequentialStopper:
+    target_width: float = 0.05
+    confidence: float = 0.95
+    min_samples: int = 100
+    check_every: int = 50
+    recall_classes: list[str] = field(default_factory=lambda: list(STOP_CLASSES))
+    mode: str = "detailed"  # accuracy mode the width and the comparison use
+    reference: Optional[tuple[int, int]] = None  # (correct, total) of a reference run
+    reason: Optional[str] = None
+    _next_check: int = 0
+
+    @classmethod
+    def from_config(cls, config, reference: Optional[tuple[int, int]] = None) -> "SequentialStopper":
+        return cls(
+            target_width=config.ci_target_width,
+            confidence=config.ci_confidence,
+            min_samples=config.ci_min_samples,
+            check_every=config.ci_check_every,
+            recall_classes=list(config.ci_recall_classes),
+            mode=config.ci_mode,
+            reference=reference,
+        )
+
+    def intervals(self, report: EvalReport) -> dict[str, tuple[float, float]]:
+        """Accuracy interval, then one recall interval per watched class seen so far."""
+        n = len(report)
+        intervals = {"accuracy": wilson_interval(correct_count(report, self.mode), n, self.confidence)}
+        counts = recall_counts(report)
+        for name in self.recall_classes:
+            if name in counts:
+                intervals[f"recall/{name}"] = wilson_interval(*counts[name], self.confidence)
+        return intervals
+
+    def comparison(self, report: EvalReport) -> Optional[tuple[float, float]]:
+        if self.reference is None:
+            return None
+        return difference_interval(
+            correct_count(report, self.mode), len(report), *self.reference, self.confidence
+        )
+
+    def should_stop(self, report: EvalReport) -> bool:
+        n = len(report)
+        if n < max(self.min_samples, self._next_check):
+            return False
+        self._next_check = n + self.check_every
+
+        comparison = self.comparison(report)
+        if comparison is not None and (comparison[0] > 0 or comparison[1] < 0):
+            verdict = "better" if comparison[0] > 0 else "worse"
+            self.reason = (
+                f"{verdict} than the reference after {n} samples "
+                f"(difference in [{comparison[0]:+.3f}, {comparison[1]:+.3f}])"
+            )
+            return True
+
+        intervals = self.intervals(report)
+        if len(intervals) < 1 + len(self.recall_classes):
+            return False  # a watched class has no samples yet
+        widest = max(high - low for low, high in intervals.values())
+        if widest <= self.target_width:
+            self.reason = f"all intervals narrower than {self.target_width} after {n} samples"
+            return True
+        return False
+
+    def summary(self, report: EvalReport) -> dict[str, float]:
+        summary = {}
+        for name, (low, high) in self.intervals(report).items():
+            summary[f"{name}_low"], summary[f"{name}_high"] = low, high
+        comparison = self.comparison(report)
+        if comparison is not None:
+            summary["diff_vs_reference_low"], summary["diff_vs_reference_high"] = comparison
+        return summary
@@ -0,0 +1,125 @@
+"""
+Tiny randomly initialized LFM2-VL with a tokenizer built in code.
+
+Same architecture family and processor pipeline as `LiquidAI/LFM2-VL-*`
+(SigLIP2 vision encoder, pixel-unshuffle projector, LFM2 hybrid conv/attention
+language model), but only a few hundred thousand parameters and no downloads,
+so benchmarks and dry runs work offline on CPU. Outputs are meaningless.
+"""
+
+import torch
+
+IMAGE_TOKEN = "<image>"
+SPECIAL_TOKENS = {
+    "bos_token": "<|startoftext|>",
+    "eos_token": "<|im_end|>",
+    "pad_token": "<|pad|>",
+}
+IMAGE_SPECIAL_TOKENS = {
+    "image_token": IMAGE_TOKEN,
+    "image_start_token": "<|image_start|>",
+    "image_end_token": "<|image_end|>",
+    "image_thumbnail": "<|img_thumbnail|>",
+}
+
+# ChatML, with image items rendered as the image placeholder like the LFM2-VL template
+CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\n' }}"
+    "{% if message['content'] is string %}{{ message['content'] }}"
+    "{% else %}{% for item in message['content'] %}"
+    "{% if item['type'] == 'image' %}{{ '" + IMAGE_TOKEN + "' }}"
+    "{% elif item['type'] == 'text' %}{{ item['text'] }}{% endif %}"
+    "{% endfor %}{% endif %}"
+    "{{ '<|im_end|>\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+)
+
+
+def build_tiny_tokenizer():
+    """Byte-level tokenizer (one token per byte) with the LFM2-VL special tokens."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    byte_alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {char: i for i, char in enumerate(sorted(byte_alphabet))}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        **SPECIAL_TOKENS,
+        extra_special_tokens=IMAGE_SPECIAL_TOKENS,
+    )
+    tokenizer.add_special_tokens(
+        {"additional_special_tokens": ["<|im_start|>", *IMAGE_SPECIAL_TOKENS.values()]}
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    return tokenizer
+
+
+def build_tiny_processor(max_image_tokens: int = 64):
+    from transformers import Lfm2VlImageProcessorFast, Lfm2VlProcessor
+
+    image_processor = Lfm2VlImageProcessorFast(
+        max_image_tokens=max_image_tokens,
+        min_image_tokens=min(16, max_image_tokens),
+    )
+    return Lfm2VlProcessor(
+        image_processor=image_processor,
+        tokenizer=build_tiny_tokenizer(),
+        chat_template=CHAT_TEMPLATE,
+    )
+
+
+def build_tiny_model(processor, seed: int = 0, hidden_size: int = 64):
+    from transformers import (
+        Lfm2Config,
+        Lfm2VlConfig,
+        Lfm2VlForConditionalGeneration,
+        Siglip2VisionConfig,
+    )
+
+    tokenizer = processor.tokenizer
+    text_config = Lfm2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        layer_types=["conv", "full_attention"],
+        max_position_embeddings=4096,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    vision_config = Siglip2VisionConfig(
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        patch_size=processor.image_processor.encoder_patch_size,
+        num_patches=256,
+    )
+    config = Lfm2VlConfig(
+        vision_config=vision_config.to_dict(),
+        text_config=text_config.to_dict(),
+        image_token_id=tokenizer.convert_tokens_to_ids(IMAGE_TOKEN),
+        projector_hidden_size=hidden_size,
+        downsample_factor=processor.image_processor.downsample_factor,
+    )
+
+    torch.manual_seed(seed)
+    model = Lfm2VlForConditionalGeneration(config).eval()
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    return model
+
+
+def build_tiny_model_and_processor(max_image_tokens: int = 64, seed: int = 0) -> tuple:
+    processor = build_tiny_processor(max_image_tokens)
+    return build_tiny_model(processor, seed=seed), processor
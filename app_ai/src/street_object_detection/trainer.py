@@ -0,0 +1,74 @@
+"""SFT trainer with the project's training-loop customizations."""
+
+from typing import Optional
+
+from trl import SFTTrainer
+
+from .bucketing import LengthBucketSampler
+
+
+class PedestrianSFTTrainer(SFTTrainer):
+    """
+    `SFTTrainer` that can batch training samples by sequence length and train
+    from cached image embeddings.
+
+    Pass `train_lengths` (see `bucketing.compute_sample_lengths`) to replace the
+    random sampler with a `LengthBucketSampler`; the padding ratio of every
+    epoch is then printed and logged.
+
+    Batches that carry `image_features` (see `vision_cache`) are fed to the
+    model as `inputs_embeds`, with the cached embeddings scattered into the
+    positions of `image_token_id`, so the vision tower never runs.
+    """
+
+    def __init__(
+        self,
+        *args,
+        train_lengths: Optional[list[int]] = None,
+        bucket_size_multiplier: int = 50,
+        image_token_id: Optional[int] = None,
+        **kwargs,
+    ):
+        self.train_lengths = train_lengths
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.image_token_id = image_token_id
+        super().__init__(*args, **kwargs)
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        if "image_features" in inputs:
+            inputs = self._embed_cached_image_features(model, inputs)
+        return super().compute_loss(model, inputs, *args, **kwargs)
+
+    def prediction_step(self, model, inputs, *args, **kwargs):
+        if "image_features" in inputs:
+            inputs = self._embed_cached_image_features(model, inputs)
+        return super().prediction_step(model, inputs, *args, **kwargs)
+
+    def _embed_cached_image_features(self, model, inputs: dict) -> dict:
+        inputs = dict(inputs)
+        input_ids = inputs.pop("input_ids")
+        image_features = inputs.pop("image_features")
+
+        embeddings = model.get_input_embeddings()(input_ids)
+        image_mask = (input_ids == self.image_token_id).unsqueeze(-1)
+        inputs["inputs_embeds"] = embeddings.masked_scatter(
+            image_mask.expand_as(embeddings),
+            image_features.to(embeddings.device, embeddings.dtype),
+        )
+        return inputs
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+
+        return LengthBucketSampler(
+            self.train_lengths,
+            batch_size=self.args.per_device_train_batch_size,
+            bucket_size_multiplier=self.bucket_size_multiplier,
+            seed=self.args.seed,
+            on_epoch=self._log_padding_ratio,
+        )
+
+    def _log_padding_ratio(self, ratio: float):
+        print(f"📏 Padding ratio this epoch: {ratio:.1%}")
+        self.log({"padding_ratio": ratio})
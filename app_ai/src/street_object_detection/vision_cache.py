@@ -0,0 +1,149 @@
+"""
+Memory-mapped cache of the frozen vision tower's image embeddings.
+
+When LoRA only adapts the language model, the vision encoder and projector
+produce the same embeddings for an image in every epoch. The cache runs them
+once per sample; training then scatters the cached embeddings into the token
+embeddings (see `PedestrianSFTTrainer`) and skips the vision forward pass.
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from datasets import Dataset
+from torch.utils.data import Dataset as TorchDataset
+from tqdm import tqdm
+
+from .preprocessing import TEXT_KEYS, pad_and_cat
+
+# numpy has no bfloat16, so embeddings are stored as raw integers of the same
+# width and viewed back as the model dtype on read.
+_STORAGE_DTYPES = {2: (torch.int16, np.int16), 4: (torch.int32, np.int32)}
+_TORCH_DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32,
+}
+
+
+def lora_targets_for_language_model(target_modules: list[str]) -> str:
+    """
+    PEFT regex restricting LoRA to the language model. The SigLIP vision
+    encoder also has `q_proj`/`k_proj`/`v_proj` layers, which plain module names
+    would adapt too, and then cached embeddings would go stale.
+    """
+    names = "|".join(target_modules)
+    return rf".*language_model.*\.({names})"
+
+
+@torch.no_grad()
+def build_vision_feature_cache(
+    model, dataset: Dataset, cache_path: Path, batch_size: int = 8
+) -> None:
+    """Runs the vision tower once over a pre-tokenized dataset and stores the output."""
+    model.eval()
+    image_keys = [k for k in dataset.column_names if k not in TEXT_KEYS]
+    image_token_id = model.config.image_token_id
+
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    offsets = [0]
+    hidden_size = dtype = None
+    with open(tmp_path / "features.bin", "wb") as f:
+        for start in tqdm(range(0, len(dataset), batch_size), desc="Vision features"):
+            end = min(start + batch_size, len(dataset))
+            samples = [dataset[i] for i in range(start, end)]
+            image_inputs = {
+                key: pad_and_cat([s[key] for s in samples]).to(model.device)
+                for key in image_keys
+            }
+            image_inputs["pixel_values"] = image_inputs["pixel_values"].to(model.dtype)
+
+            # One embedding tensor per image tile, in sample order
+            tiles = list(model.get_image_features(**image_inputs))
+            for sample in samples:
+                n_tiles = len(sample["pixel_values"])
+                features = torch.cat(tiles[:n_tiles])
+                tiles = tiles[n_tiles:]
+
+                n_image_tokens = int((sample["input_ids"] == image_token_id).sum())
+                if features.shape[0] != n_image_tokens:
+                    raise ValueError(
+                        f"Vision tower returned {features.shape[0]} embeddings for "
+                        f"{n_image_tokens} image tokens"
+                    )
+
+                hidden_size, dtype = features.shape[1], features.dtype
+                storage, _ = _STORAGE_DTYPES[features.element_size()]
+                f.write(features.cpu().contiguous().view(storage).numpy().tobytes())
+                offsets.append(offsets[-1] + features.shape[0])
+
+    np.save(tmp_path / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    with open(tmp_path / "meta.json", "w") as f:
+        dtype_name = str(dtype).removeprefix("torch.")
+        json.dump({"hidden_size": hidden_size, "dtype": dtype_name}, f)
+
+    shutil.rmtree(cache_path, ignore_errors=True)
+    tmp_path.rename(cache_path)
+
+
+class VisionFeatureCache:
+    """Read-only, memory-mapped view of a cache built by `build_vision_feature_cache`."""
+
+    def __init__(self, cache_path: Path):
+        with open(cache_path / "meta.json") as f:
+            meta = json.load(f)
+        self.dtype = _TORCH_DTYPES[meta["dtype"]]
+        self.offsets = np.load(cache_path / "offsets.npy")
+
+        _, storage = _STORAGE_DTYPES[torch.empty(0, dtype=self.dtype).element_size()]
+        self.features = np.memmap(
+            cache_path / "features.bin",
+            dtype=storage,
+            mode="r",
+            shape=(int(self.offsets[-1]), meta["hidden_size"]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        rows = self.features[self.offsets[idx] : self.offsets[idx + 1]]
+        return torch.from_numpy(np.array(rows)).view(self.dtype)
+
+
+class VisionFeatureDataset(TorchDataset):
+    """
+    Pre-tokenized samples with their cached image embeddings in place of the
+    pixel tensors. Works with `create_pretokenized_collate_fn`.
+    """
+
+    def __init__(self, dataset: Dataset, cache: VisionFeatureCache):
+        if len(dataset) != len(cache):
+            raise ValueError("Vision feature cache does not match the dataset")
+        self.dataset = dataset.select_columns(list(TEXT_KEYS))
+        self.cache = cache
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> dict:
+        sample = dict(self.dataset[idx])
+        sample["image_features"] = self.cache[idx]
+        return sample
+
+
+def load_or_build_vision_feature_dataset(
+    model, dataset: Dataset, cache_path: Path
+) -> VisionFeatureDataset:
+    if not (cache_path / "meta.json").exists():
+        print(f"👁️  Caching vision features to {cache_path}...")
+        build_vision_feature_cache(model, dataset, cache_path)
+    else:
+        print(f"♻️  Reusing vision feature cache {cache_path}")
+    return VisionFeatureDataset(dataset, VisionFeatureCache(cache_path))
@@ -0,0 +1,299 @@
+"""
+Serving autotuner.
+
+Sweeps torch threads, the image-token tier of the classification endpoints,
+weight quantization and the number of inference workers on this machine. Every
+combination is measured under a closed-loop load of `--concurrency` clients
+calling `server.run_inference_sync` on synthetic or recorded frames. Then the
+batch size for `/obstacles/batch` is tuned on the chosen setting.
+
+The chosen setting is the highest-throughput point on the Pareto frontier
+(throughput vs. p95 latency) that meets `--max-p95`. It is written to
+`serving_profile.json`, which `server.py` loads at startup. Lower image-token
+tiers are faster but less accurate: check them with `image_token_tiers` in an
+eval config before keeping one.
+
+    python backend/autotune.py --dry-run                # print the frontier only
+    python backend/autotune.py --frames captures/ --max-p95 2.0
+    python backend/autotune.py --tiny --dry-run         # plumbing check on CPU
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+import server
+from tiering import LARGE, percentile
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def parse_list(value: str, cast=str) -> list:
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+
+def synthetic_frames(n: int, size=(1280, 720), seed: int = 0) -> list[bytes]:
+    """Camera-sized JPEGs of random noise (the worst case for decoding)."""
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(n):
+        image = Image.frombytes("RGB", size, rng.randbytes(size[0] * size[1] * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=server.UPLOAD_JPEG_QUALITY)
+        frames.append(buffer.getvalue())
+    return frames
+
+
+def recorded_frames(directory: Path, limit: int) -> list[bytes]:
+    paths = sorted(p for p in directory.rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES)
+    if not paths:
+        raise SystemExit(f"No images found in {directory}")
+    return [p.read_bytes() for p in paths[:limit]]
+
+
+def measure_load(infer, frames: list[bytes], concurrency: int, workers: int, n_requests: int) -> dict:
+    """
+    Closed-loop load: `concurrency` clients each send their next request as soon
+    as the previous one is answered, served by a pool of `workers` threads like
+    the server's executor. Latency includes the time queued for a worker.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def client(index: int):
+            for i in range(index, n_requests, concurrency):
+                start = time.perf_counter()
+                executor.submit(infer, frames[i % len(frames)]).result()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as clients:
+            list(clients.map(client, range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+    }
+
+
+def pareto_frontier(points: list[dict]) -> list[dict]:
+    """Points no other point beats on both throughput and p95 latency."""
+    def dominates(a, b):
+        return (
+            a["throughput_rps"] >= b["throughput_rps"]
+            and a["p95_s"] <= b["p95_s"]
+            and (a["throughput_rps"] > b["throughput_rps"] or a["p95_s"] < b["p95_s"])
+        )
+
+    frontier = [p for p in points if not any(dominates(q, p) for q in points)]
+    return sorted(frontier, key=lambda p: p["throughput_rps"])
+
+
+def choose_point(frontier: list[dict], max_p95: float | None) -> dict:
+    """Highest throughput within the latency budget, else the lowest p95."""
+    within = [p for p in frontier if max_p95 is None or p["p95_s"] <= max_p95]
+    if within:
+        return max(within, key=lambda p: p["throughput_rps"])
+    return min(frontier, key=lambda p: p["p95_s"])
+
+
+class Candidates:
+    """Loads one model per quantization mode and one processor per tier."""
+
+    def __init__(self, args):
+        self.args = args
+        self.use_cuda = torch.cuda.is_available() and not args.tiny
+
+    def load_model(self, quantization: str):
+        if self.args.tiny:
+            from street_object_detection.tiny_model import build_tiny_model, build_tiny_processor
+
+            return build_tiny_model(build_tiny_processor())
+        bnb_config = server.make_quantization_config(quantization, self.use_cuda)
+        return server.load_model(self.args.model, self.args.arch, bnb_config, self.use_cuda)
+
+    def load_processor(self, tier: str):
+        max_image_tokens = server.IMAGE_TOKEN_TIERS[tier]
+        if self.args.tiny:
+            from street_object_detection.tiny_model import build_tiny_processor
+
+            processor = build_tiny_processor(max_image_tokens)
+        else:
+            from transformers import AutoProcessor
+
+            processor = AutoProcessor.from_pretrained(
+                self.args.arch, trust_remote_code=True, max_image_tokens=max_image_tokens
+            )
+        processor.tokenizer.padding_side = "left"
+        return processor
+
+
+def install(model, processor, tier: str):
+    """Points the server's globals at the candidate model and processor."""
+    server.models[LARGE] = model
+    server.model = model
+    server.processors[(LARGE, tier)] = processor
+    server.image_limits[tier] = server.compute_image_limits(processor)
+
+
+def obstacle_inference(tier: str):
+    def infer(data: bytes):
+        image = server.decode_image(data, tier)
+        return server.run_inference_sync(image, server.OBSTACLE_PROMPT, server.SAFETY_SYSTEM_PROMPT, tier)
+    return infer
+
+
+def sweep(args, frames: list[bytes]) -> list[dict]:
+    candidates = Candidates(args)
+    quantizations = args.quantization if candidates.use_cuda else ["none"]
+    points = []
+
+    for quantization in quantizations:
+        print(f"📦 Loading model ({quantization})...")
+        model = candidates.load_model(quantization)
+        for tier in args.tiers:
+            install(model, candidates.load_processor(tier), tier)
+            infer = obstacle_inference(tier)
+            for threads in args.threads:
+                torch.set_num_threads(threads)
+                infer(frames[0])  # warmup
+                for workers in args.workers:
+                    result = measure_load(infer, frames, args.concurrency, workers, args.requests)
+                    point = {"quantization": quantization, "tier": tier, "threads": threads, "workers": workers, **result}
+                    points.append(point)
+                    print(
+                        f"  {quantization:>5} {tier:>7} threads={threads:<3} workers={workers:<3} "
+                        f"{result['throughput_rps']:6.2f} req/s  p95 {result['p95_s']:.2f}s"
+                    )
+        # Only one model variant is resident at a time
+        del model
+        server.models.clear()
+        server.model = None
+        if candidates.use_cuda:
+            torch.cuda.empty_cache()
+    return points
+
+
+def tune_batch_size(args, frames: list[bytes], point: dict) -> tuple[int, list[dict]]:
+    """Largest batch whose p95 fits the budget, else the best frames/s."""
+    candidates = Candidates(args)
+    model = candidates.load_model(point["quantization"])
+    install(model, candidates.load_processor(point["tier"]), point["tier"])
+    torch.set_num_threads(point["threads"])
+
+    results = []
+    for batch_size in args.batch_sizes:
+        images = [server.decode_image(frames[i % len(frames)], point["tier"]) for i in range(batch_size)]
+        latencies = []
+        for _ in range(args.batch_repeats + 1):
+            start = time.perf_counter()
+            server.run_batch_inference_sync(
+                images, server.OBSTACLE_PROMPT, server.SAFETY_SYSTEM_PROMPT, point["tier"]
+            )
+            latencies.append(time.perf_counter() - start)
+        latencies = latencies[1:]  # first run is warmup
+        p95 = percentile(latencies, 95)
+        results.append({"batch_size": batch_size, "p95_s": p95, "frames_per_s": batch_size / percentile(latencies, 50)})
+        print(f"  batch={batch_size:<3} {results[-1]['frames_per_s']:6.2f} frames/s  p95 {p95:.2f}s")
+
+    within = [r for r in results if args.max_p95 is None or r["p95_s"] <= args.max_p95]
+    best = max(within, key=lambda r: r["batch_size"]) if within else max(results, key=lambda r: r["frames_per_s"])
+    return best["batch_size"], results
+
+
+def print_frontier(points: list[dict], frontier: list[dict], chosen: dict):
+    print(f"\n{'':2}{'quant':>6} {'tier':>7} {'threads':>8} {'workers':>8} {'req/s':>7} {'p50 s':>7} {'p95 s':>7}")
+    for point in sorted(points, key=lambda p: -p["throughput_rps"]):
+        mark = "→" if point is chosen else "*" if point in frontier else ""
+        print(
+            f"{mark:2}{point['quantization']:>6} {point['tier']:>7} {point['threads']:>8} {point['workers']:>8} "
+            f"{point['throughput_rps']:>7.2f} {point['p50_s']:>7.2f} {point['p95_s']:>7.2f}"
+        )
+    print("* Pareto frontier (throughput vs p95), → chosen")
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_threads = sorted({1, max(1, cpu_count // 2), cpu_count})
+
+    parser = argparse.ArgumentParser(description="Tune the serving settings for this machine")
+    parser.add_argument("--model", default=server.MY_MODEL_ID)
+    parser.add_argument("--arch", default=server.BASE_ARCH_ID)
+    parser.add_argument("--tiny", action="store_true", help="use a tiny random model (numbers meaningless)")
+    parser.add_argument("--frames", type=Path, help="directory of recorded frames (default: synthetic)")
+    parser.add_argument("--n-frames", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4, help="simulated concurrent clients")
+    parser.add_argument("--requests", type=int, default=24, help="requests per measurement")
+    parser.add_argument("--threads", type=lambda v: parse_list(v, int), default=default_threads)
+    parser.add_argument("--tiers", type=parse_list, default=["low", "medium"])
+    parser.add_argument("--quantization", type=parse_list, default=["4bit", "8bit", "none"])
+    parser.add_argument("--workers", type=lambda v: parse_list(v, int), default=[1, 2, 4])
+    parser.add_argument("--batch-sizes", type=lambda v: parse_list(v, int), default=[1, 2, 4, 8])
+    parser.add_argument("--batch-repeats", type=int, default=3)
+    parser.add_argument("--max-p95", type=float, default=None, help="p95 latency budget in seconds")
+    parser.add_argument("--output", type=Path, default=server.SERVING_PROFILE)
+    parser.add_argument("--dry-run", action="store_true", help="report the frontier without writing a profile")
+    args = parser.parse_args()
+
+    unknown = set(args.tiers) - set(server.IMAGE_TOKEN_TIERS)
+    if unknown:
+        raise SystemExit(f"Unknown tiers {sorted(unknown)}, known: {sorted(server.IMAGE_TOKEN_TIERS)}")
+
+    frames = recorded_frames(args.frames, args.n_frames) if args.frames else synthetic_frames(args.n_frames)
+    print(f"Sweeping with {len(frames)} frames, {args.concurrency} concurrent clients")
+
+    points = sweep(args, frames)
+    frontier = pareto_frontier(points)
+    chosen = choose_point(frontier, args.max_p95)
+    print_frontier(points, frontier, chosen)
+
+    print("\n📏 Tuning the batch size on the chosen setting...")
+    batch_size, batch_results = tune_batch_size(args, frames, chosen)
+
+    settings = {
+        "threads": chosen["threads"],
+        "workers": chosen["workers"],
+        "quantization": chosen["quantization"],
+        "endpoint_tiers": {endpoint: chosen["tier"] for endpoint in ("obstacles", "crosswalk")},
+        "max_batch_images": batch_size,
+    }
+    print(f"\nChosen settings: {settings}")
+    if args.dry_run:
+        print("Dry run, no profile written.")
+        return
+
+    profile = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "host": {
+            "platform": platform.platform(),
+            "cpu_count": cpu_count,
+            "gpu": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        },
+        "model": "tiny" if args.tiny else args.model,
+        "concurrency": args.concurrency,
+        "max_p95_s": args.max_p95,
+        "settings": settings,
+        "measured": {"chosen": chosen, "frontier": frontier, "batch_sizes": batch_results},
+    }
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(f"💾 Profile written to {args.output}; restart the server to apply it.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Opt-in capture of live traffic into an offline replay corpus.
+
+A sampled share of requests is stored under a capture directory:
+
+    index.jsonl                   one line per request (endpoint, prompt, form
+                                  fields, arrival time, latency, served result)
+    blobs/ab/abcdef....jpg        uploaded images, named by their SHA-256
+
+Images are content-addressed, so a frame that is sent repeatedly is stored
+once. Capturing stops when the blobs and the index reach `max_bytes`. Writes
+happen on a background thread and requests are dropped from the capture (never
+delayed) if it falls behind. Session ids are stored hashed.
+
+Replay a corpus with `python backend/replay.py`.
+"""
+
+import hashlib
+import json
+import queue
+import random
+import threading
+from pathlib import Path
+from typing import Optional
+
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+
+
+def hash_session(session_id: Optional[str]) -> Optional[str]:
+    if not session_id:
+        return None
+    return hashlib.sha256(session_id.encode()).hexdigest()[:16]
+
+
+class TrafficCapture:
+    def __init__(self, directory: Path, sample_rate: float = 0.1, max_bytes: int = 500 * 1024 * 1024, seed: Optional[int] = None):
+        self.directory = Path(directory)
+        self.blob_dir = self.directory / "blobs"
+        self.index_path = self.directory / "index.jsonl"
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.full = False
+        self._rng = random.Random(seed)
+        # /custom image ids returned to clients -> hash of their image, so a
+        # follow-up can be replayed against the image it referred to
+        self._image_ids: dict[str, str] = {}
+        self._queue: queue.Queue = queue.Queue(maxsize=256)
+
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.used_bytes = sum(p.stat().st_size for p in self.directory.rglob("*") if p.is_file())
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def sample(self) -> bool:
+        """Decides, when a request arrives, whether it is captured."""
+        return not self.full and self._rng.random() < self.sample_rate
+
+    def record(
+        self,
+        endpoint: str,
+        arrival: float,
+        latency_s: float,
+        images: list[tuple[bytes, str]],
+        result: dict,
+        session_id: Optional[str] = None,
+        prompt: Optional[str] = None,
+        fields: Optional[dict] = None,
+    ) -> None:
+        """
+        Queues one request: `images` are (bytes, content type) pairs in upload
+        order, `arrival` its wall-clock time and `result` the JSON response.
+        """
+        entry = {
+            "arrival": arrival,
+            "endpoint": endpoint,
+            "session": hash_session(session_id),
+            "prompt": prompt,
+            "fields": dict(fields or {}),
+            "latency_s": round(latency_s, 4),
+            "result": result,
+        }
+        image_id = entry["fields"].get("image_id")
+        if image_id:
+            # Follow-up without an image; replay resolves it by hash
+            entry["fields"]["image_id"] = None
+            entry["follows"] = self._image_ids.get(image_id)
+        try:
+            self._queue.put_nowait((entry, images))
+        except queue.Full:
+            pass
+
+    def remember_image_id(self, image_id: str, data: bytes) -> None:
+        self._image_ids[image_id] = hashlib.sha256(data).hexdigest()
+        if len(self._image_ids) > 4096:
+            self._image_ids.pop(next(iter(self._image_ids)))
+
+    def _store_blob(self, data: bytes, content_type: str) -> dict:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_dir / digest[:2] / f"{digest}{EXTENSIONS.get(content_type, '.bin')}"
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+            self.used_bytes += len(data)
+        return {"sha256": digest, "content_type": content_type, "bytes": len(data), "path": str(path.relative_to(self.directory))}
+
+    def _run(self):
+        while True:
+            entry, images = self._queue.get()
+            incoming = sum(len(data) for data, _ in images)
+            if self.used_bytes + incoming > self.max_bytes:
+                if not self.full:
+                    print(f"Traffic capture full ({self.used_bytes / 1e6:.0f} MB), stopping")
+                self.full = True
+                continue
+            try:
+                entry["images"] = [self._store_blob(data, content_type) for data, content_type in images]
+                line = json.dumps(entry) + "\n"
+                with open(self.index_path, "a") as f:
+                    f.write(line)
+                self.used_bytes += len(line)
+            except OSError as e:
+                print(f"Traffic capture failed: {e}")
+
+
+def load_corpus(directory: Path) -> list[dict]:
+    """Captured requests in arrival order."""
+    with open(Path(directory) / "index.jsonl") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda entry: entry["arrival"])
@@ -0,0 +1,142 @@
+"""
+Request deadlines and cancellation of abandoned work.
+
+A client may send `X-Deadline-Ms`, the time it is willing to wait for an
+answer. Every request gets a `RequestContext` that is abandoned when that
+deadline passes or when the client disconnects (see `watch_disconnect`).
+Inference wrapped in `RequestContext.compute` is then
+
+- dropped without running if it is already abandoned when a worker picks it up,
+- stopped between decode steps through `stopping_criteria`, and
+- discarded if the client is gone by the time it finishes.
+
+`WasteCounters` keeps count of what was dropped and of the compute seconds
+spent on answers nobody received.
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+DEADLINE = "deadline"
+DISCONNECT = "disconnect"
+
+
+class RequestAbandoned(Exception):
+    """The client gave up (deadline passed or disconnected) before the answer was ready."""
+
+
+class WasteCounters:
+    def __init__(self):
+        self.dropped = {DEADLINE: 0, DISCONNECT: 0}  # never started
+        self.aborted = {DEADLINE: 0, DISCONNECT: 0}  # stopped or discarded after starting
+        self.wasted_compute_s = 0.0
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def record_dropped(self, reason: str):
+        with self._lock:
+            self.dropped[reason] += 1
+
+    def record_aborted(self, reason: str, compute_s: float):
+        with self._lock:
+            self.aborted[reason] += 1
+            self.wasted_compute_s += compute_s
+
+    def record_completed(self):
+        with self._lock:
+            self.completed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "completed": self.completed,
+                "dropped": dict(self.dropped),
+                "aborted": dict(self.aborted),
+                "wasted_compute_s": round(self.wasted_compute_s, 3),
+            }
+
+
+class RequestContext:
+    def __init__(self, deadline_s: Optional[float], counters: WasteCounters, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + deadline_s if deadline_s else None
+        self.counters = counters
+        self._cancel_reason: Optional[str] = None
+
+    def cancel(self, reason: str):
+        self._cancel_reason = reason
+
+    def abandoned(self) -> Optional[str]:
+        """Why the answer is no longer wanted, or None while it still is."""
+        if self._cancel_reason is not None:
+            return self._cancel_reason
+        if self.expires_at is not None and self.clock() >= self.expires_at:
+            return DEADLINE
+        return None
+
+    def stopping_criteria(self) -> StoppingCriteriaList:
+        return StoppingCriteriaList([AbandonedStoppingCriteria(self)])
+
+    @contextmanager
+    def compute(self):
+        """Runs a unit of inference on a worker thread, see the module docstring."""
+        reason = self.abandoned()
+        if reason is not None:
+            self.counters.record_dropped(reason)
+            raise RequestAbandoned(reason)
+
+        start = time.perf_counter()
+        yield
+        reason = self.abandoned()
+        if reason is not None:
+            self.counters.record_aborted(reason, time.perf_counter() - start)
+            raise RequestAbandoned(reason)
+        self.counters.record_completed()
+
+
+class AbandonedStoppingCriteria(StoppingCriteria):
+    """Ends generation for the whole batch once the request is abandoned."""
+
+    def __init__(self, context: RequestContext):
+        self.context = context
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        stop = self.context.abandoned() is not None
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+def parse_deadline_ms(value: Optional[str], default_s: Optional[float] = None) -> Optional[float]:
+    """Deadline in seconds from an `X-Deadline-Ms` header, else `default_s`."""
+    if not value:
+        return default_s
+    try:
+        deadline_s = float(value) / 1000
+    except ValueError:
+        return default_s
+    if deadline_s <= 0:
+        return default_s
+    return min(deadline_s, default_s) if default_s else deadline_s
+
+
+@asynccontextmanager
+async def watch_disconnect(request, context: RequestContext, interval_s: float = 0.25):
+    """Cancels `context` as soon as the client of `request` disconnects."""
+
+    async def poll():
+        while context.abandoned() is None:
+            if await request.is_disconnected():
+                context.cancel(DISCONNECT)
+                return
+            await asyncio.sleep(interval_s)
+
+    task = asyncio.create_task(poll())
+    try:
+        yield context
+    finally:
+        task.cancel()
@@ -0,0 +1,82 @@
+"""
+Reusable image prefixes for follow-up `/custom` questions.
+
+In the chat template the image comes before the question, so the prompt splits
+into a prefix (system prompt, start of the user turn, image tokens) and a short
+text suffix (question, end of turn, assistant header). `encode_image_prefix`
+runs the vision encoder and the prefill of the prefix once and keeps the
+resulting KV/conv state; `generate_from_prefix` answers a question by
+prefilling only the suffix tokens on a copy of that state, so a follow-up costs
+little more than its decode.
+"""
+
+import copy
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+
+
+@dataclass
+class ImagePrefix:
+    input_ids: torch.Tensor  # (1, prefix_len), image tokens expanded
+    cache: Any  # model cache holding the state after the prefix
+    system_prompt: str
+    model_tier: str
+    tier: str
+    session_id: str
+
+
+def _template_text(processor, system_prompt: str, prompt_text: str) -> str:
+    conversation = [
+        {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+        {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt_text}]},
+    ]
+    return processor.apply_chat_template(conversation, add_generation_prompt=True)
+
+
+def split_at_image(processor, system_prompt: str, prompt_text: str) -> tuple[str, str]:
+    """Templated prompt split right after the image placeholder."""
+    text = _template_text(processor, system_prompt, prompt_text)
+    prefix, suffix = text.split(processor.image_token, 1)
+    return prefix + processor.image_token, suffix
+
+
+@torch.no_grad()
+def encode_image_prefix(model, processor, image, system_prompt: str, **metadata) -> ImagePrefix:
+    """Encodes the image and prefills everything up to and including it."""
+    prefix_text, _ = split_at_image(processor, system_prompt, "")
+    inputs = processor(images=[image], text=prefix_text, return_tensors="pt").to(model.device)
+    outputs = model(**inputs, use_cache=True)
+    return ImagePrefix(
+        input_ids=inputs["input_ids"],
+        cache=outputs.past_key_values,
+        system_prompt=system_prompt,
+        **metadata,
+    )
+
+
+@torch.no_grad()
+def generate_from_prefix(model, processor, prefix: ImagePrefix, prompt_text: str, max_new_tokens: int = 15, stopping_criteria=None) -> str:
+    """
+    Answers `prompt_text` about the prefix image. Generation extends a copy of
+    the cached state, so the prefix can serve any number of questions.
+    """
+    _, suffix_text = split_at_image(processor, prefix.system_prompt, prompt_text)
+    suffix_ids = processor.tokenizer(
+        suffix_text, add_special_tokens=False, return_tensors="pt"
+    )["input_ids"].to(prefix.input_ids.device)
+    input_ids = torch.cat([prefix.input_ids, suffix_ids], dim=1)
+
+    # Only the uncached suffix is run; pixel values are not needed past the prefix
+    output_ids = model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        past_key_values=copy.deepcopy(prefix.cache),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        repetition_penalty=1.0,
+        stopping_criteria=stopping_criteria,
+    )
+    generated_ids = output_ids[:, input_ids.shape[1]:]
+    return processor.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
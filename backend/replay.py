@@ -0,0 +1,233 @@
+"""
+Replays a traffic capture (see capture.py) against a running server.
+
+Requests are sent at their original pacing, `--speed` times faster, or back to
+back with `--speed 0`. Each response is written to a results JSONL next to the
+captured one, so builds can be compared on the same corpus:
+
+    python backend/replay.py run captures/ --url http://127.0.0.1:8000 --output build_a.jsonl
+    python backend/replay.py run captures/ --speed 4 --output build_b.jsonl
+    python backend/replay.py compare build_a.jsonl build_b.jsonl
+    python backend/replay.py compare build_b.jsonl   # against the captured answers
+
+Only the standard library is used, so it runs from any machine.
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from capture import load_corpus
+from tiering import percentile
+
+
+def encode_multipart(fields: dict, files: list[tuple[str, bytes, str]]) -> tuple[bytes, str]:
+    """multipart/form-data body for `fields` and (field name, bytes, content type) files."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for i, (name, data, content_type) in enumerate(files):
+        header = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="frame{i}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        )
+        parts.append(header.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def post(url: str, fields: dict, files: list, session: Optional[str], timeout: float) -> tuple[Optional[int], Optional[dict], Optional[str]]:
+    """(status, JSON response, error); status is None when no response arrived."""
+    body, content_type = encode_multipart(fields, files)
+    headers = {"Content-Type": content_type}
+    if session:
+        headers["X-Session-Id"] = session
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read()), None
+    except urllib.error.HTTPError as e:
+        return e.code, None, None
+    except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+        # Counted as an error instead of aborting the whole run
+        return None, None, str(e)
+
+
+def outcome(response: Optional[dict]):
+    """The part of a response compared between builds."""
+    if response is None:
+        return None
+    if "results" in response:
+        return [item["result"] for item in response["results"]]
+    return response.get("result")
+
+
+class Replayer:
+    def __init__(self, corpus_dir: Path, url: str, timeout: float):
+        self.corpus_dir = corpus_dir
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.blob_paths = {p.stem: p for p in (corpus_dir / "blobs").rglob("*") if p.is_file()}
+        # (session, image hash) -> image_id returned during this replay
+        self.image_ids: dict[tuple, str] = {}
+        self._lock = threading.Lock()
+
+    def _files(self, entry: dict) -> list:
+        field = "files" if entry["endpoint"].endswith("/batch") else "file"
+        return [
+            (field, (self.corpus_dir / image["path"]).read_bytes(), image["content_type"])
+            for image in entry["images"]
+        ]
+
+    def send(self, index: int, entry: dict) -> dict:
+        fields = {key: value for key, value in entry["fields"].items() if value is not None}
+        if entry["prompt"] is not None:
+            fields["prompt"] = entry["prompt"]
+        files = self._files(entry)
+
+        if "follows" in entry:
+            # Follow-up question: reuse this replay's image id, else send the image
+            follows = entry["follows"]
+            image_id = self.image_ids.get((entry["session"], follows))
+            if image_id:
+                fields["image_id"] = image_id
+            elif follows in self.blob_paths:
+                files = [("file", self.blob_paths[follows].read_bytes(), "image/jpeg")]
+            else:
+                return {"index": index, "endpoint": entry["endpoint"], "skipped": "image not captured"}
+
+        start = time.perf_counter()
+        status, response, error = post(self.url + entry["endpoint"], fields, files, entry["session"], self.timeout)
+        latency = time.perf_counter() - start
+
+        if response and response.get("image_id") and entry["images"]:
+            with self._lock:
+                self.image_ids[(entry["session"], entry["images"][0]["sha256"])] = response["image_id"]
+
+        result = {
+            "index": index,
+            "endpoint": entry["endpoint"],
+            "status": status,
+            "latency_s": round(latency, 4),
+            "captured_latency_s": entry["latency_s"],
+            "outcome": outcome(response),
+            "captured_outcome": outcome(entry["result"]),
+        }
+        if error is not None:
+            result["error"] = error
+        return result
+
+
+def run(args):
+    entries = load_corpus(args.corpus)[: args.limit]
+    if not entries:
+        raise SystemExit("Empty corpus")
+    replayer = Replayer(args.corpus, args.url, args.timeout)
+    first = entries[0]["arrival"]
+    print(f"Replaying {len(entries)} requests against {args.url} "
+          f"({'back to back' if args.speed == 0 else f'{args.speed}x pacing'})")
+
+    futures = []
+    start = time.perf_counter()
+    workers = args.concurrency if args.speed == 0 else 64
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, entry in enumerate(entries):
+            if args.speed > 0:
+                delay = (entry["arrival"] - first) / args.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(replayer.send, index, entry))
+        results = [future.result() for future in futures]
+
+    with open(args.output, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    print(f"📄 Results written to {args.output}")
+    print_summary({args.output.name: results})
+
+
+def load_results(path: Path) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def latency_stats(results: list[dict], key: str = "latency_s") -> dict:
+    latencies = [r[key] for r in results if r.get(key) is not None and r.get("status", 200) == 200]
+    return {
+        "n": len(latencies),
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+    }
+
+
+def print_summary(runs: dict[str, list[dict]]):
+    print(f"{'run':<24} {'endpoint':<18} {'n':>5} {'p50 s':>8} {'p95 s':>8} {'errors':>7}")
+    for name, results in runs.items():
+        for endpoint in sorted({r["endpoint"] for r in results}):
+            subset = [r for r in results if r["endpoint"] == endpoint]
+            stats = latency_stats(subset)
+            errors = sum(1 for r in subset if "skipped" not in r and r.get("status") != 200)
+            p50 = f"{stats['p50_s']:.3f}" if stats["p50_s"] is not None else "-"
+            p95 = f"{stats['p95_s']:.3f}" if stats["p95_s"] is not None else "-"
+            print(f"{name:<24} {endpoint:<18} {stats['n']:>5} {p50:>8} {p95:>8} {errors:>7}")
+
+
+def compare(args):
+    a = load_results(args.a)
+    if args.b is None:
+        # Against what the server answered when the traffic was captured
+        runs = {"captured": [{**r, "latency_s": r.get("captured_latency_s"), "outcome": r.get("captured_outcome"), "status": 200} for r in a], args.a.name: a}
+    else:
+        runs = {args.a.name: a, args.b.name: load_results(args.b)}
+    print_summary(runs)
+
+    (name_a, results_a), (name_b, results_b) = runs.items()
+    by_index = {r["index"]: r for r in results_b}
+    pairs = [
+        (r, by_index[r["index"]]) for r in results_a
+        if r["index"] in by_index and "skipped" not in r and "skipped" not in by_index[r["index"]]
+    ]
+    same = sum(1 for x, y in pairs if x["outcome"] == y["outcome"])
+    print(f"\nOutputs identical between {name_a} and {name_b}: {same}/{len(pairs)}"
+          f" ({same / max(len(pairs), 1):.1%})")
+    for x, y in [(x, y) for x, y in pairs if x["outcome"] != y["outcome"]][: args.show]:
+        print(f"  #{x['index']} {x['endpoint']}: {x['outcome']!r} -> {y['outcome']!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a server")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="replay a capture directory")
+    run_parser.add_argument("corpus", type=Path)
+    run_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="pacing multiplier, 0 = back to back")
+    run_parser.add_argument("--concurrency", type=int, default=4, help="parallel requests with --speed 0")
+    run_parser.add_argument("--limit", type=int, default=None)
+    run_parser.add_argument("--timeout", type=float, default=400)
+    run_parser.add_argument("--output", type=Path, default=Path("replay_results.jsonl"))
+
+    compare_parser = sub.add_parser("compare", help="compare two replays, or one with the capture")
+    compare_parser.add_argument("a", type=Path)
+    compare_parser.add_argument("b", type=Path, nargs="?")
+    compare_parser.add_argument("--show", type=int, default=10, help="differing outputs to print")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
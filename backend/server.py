@@ -1,9 +1,14 @@
 import os
+import sys
 import torch
 import io
 import asyncio
+import json
+import math
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, Request
 from fastapi.responses import JSONResponse
 from typing import Optional, List
 from PIL import Image
@@ -11,12 +16,61 @@ from transformers import AutoModelForImageTextToText, AutoProcessor, BitsAndByte
 import uvicorn
 from huggingface_hub import login
 import time
+from pathlib import Path
+
+# Label normalization is shared with the evaluation code in app_ai
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app_ai" / "src"))
+from street_object_detection.labels import (  # noqa: E402
+    CROSSWALK_LABELS,
+    CROSSWALK_SEVERITY,
+    OBSTACLE_LABELS,
+    OBSTACLE_SEVERITY,
+    LabelNormalizer,
+    most_severe,
+)
+from street_object_detection.roi import RoiConfig, compute_roi, crop_to_roi  # noqa: E402
+from session_cache import SessionCache  # noqa: E402
+from tiering import LARGE, SMALL, TieringConfig, TieringPolicy  # noqa: E402
+from generation import StaticDecodeEngine  # noqa: E402
+from prefix_cache import encode_image_prefix, generate_from_prefix  # noqa: E402
+from capture import TrafficCapture  # noqa: E402
+from deadlines import DISCONNECT, RequestAbandoned, RequestContext, WasteCounters, parse_deadline_ms, watch_disconnect  # noqa: E402
 
 # --- Configuration ---
 # The ID of your fine-tuned model (weights)
 MY_MODEL_ID = "calinMoglan/pedestrian-detector-v1"
 # The ID of the base architecture (used for configuration and processor files)
 BASE_ARCH_ID = "LiquidAI/LFM2-VL-1.6B"
+# Optional smaller model, fine-tuned on the same data, kept resident to serve
+# classification requests while the large one is saturated (see tiering.py).
+# Tiering is disabled when SMALL_MODEL_ID is not set.
+SMALL_MODEL_ID = os.getenv("SMALL_MODEL_ID")
+SMALL_BASE_ARCH_ID = os.getenv("SMALL_BASE_ARCH_ID", "LiquidAI/LFM2-VL-450M")
+
+MODEL_TIERS = {LARGE: (MY_MODEL_ID, BASE_ARCH_ID)}
+if SMALL_MODEL_ID:
+    MODEL_TIERS[SMALL] = (SMALL_MODEL_ID, SMALL_BASE_ARCH_ID)
+
+# Host-specific serving settings written by `python backend/autotune.py`
+# (threads, workers, quantization, endpoint tiers, max batch size). Environment
+# variables still override every setting.
+SERVING_PROFILE = Path(os.getenv("SERVING_PROFILE", Path(__file__).resolve().parent / "serving_profile.json"))
+
+def load_serving_profile(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        settings = json.load(f).get("settings", {})
+    print(f"Loaded serving profile from {path}: {settings}")
+    return settings
+
+profile = load_serving_profile(SERVING_PROFILE)
+
+# Weight quantization on GPU: "4bit" (NF4), "8bit" or "none"; CPU always runs unquantized
+QUANTIZATION = os.getenv("QUANTIZATION", profile.get("quantization", "4bit"))
+# Torch intra-op threads (0 keeps the torch default) and inference worker threads
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", profile.get("threads", 0)))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", profile.get("workers", 0)))
 
 # System prompts to guide the model's behavior
 SAFETY_SYSTEM_PROMPT = (
@@ -30,17 +84,123 @@ GENERAL_SYSTEM_PROMPT = (
     "Be helpful, accurate, and concise."
 )
 
-# Global variables to hold the model in memory
+OBSTACLE_PROMPT = (
+    "Analyze the path ahead. Output ONLY one of the following sentences:\n"
+    "- 'Caution: Car approaching'\n"
+    "- 'Caution: Obstacle on path'\n"
+    "- 'Clear: Path is safe'\n"
+    "- 'Caution: Unpaved surface'"
+)
+OBSTACLE_FALLBACK = "Caution: Unknown danger"
+
+CROSSWALK_PROMPT = "Check the path ahead for a pedestrian crosswalk."
+CROSSWALK_SYSTEM_PROMPT = (
+    "You are an advanced visual assistant for pedestrian safety.\n"
+    "Analyze the image and output ONLY one of the following classification labels:\n"
+    "- \"Safe crosswalk detected\": if a pedestrian crosswalk (white stripes) is clearly visible on the road.\n"
+    "- \"No crosswalk\": if no crosswalk is visible.\n"
+    "Do not provide explanations. Output only the label."
+)
+
+# Most frames one /obstacles/batch or /crosswalk/batch request may carry
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", profile.get("max_batch_images", 8)))
+
+# Global variables to hold the models in memory
 model = None
-processor = None
+models = {}
 device = None
+tiering = TieringPolicy(small_available=False)
 
 ALLOWED_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp"}
 MAX_IMAGE_BYTES = 10 * 1024 * 1024
 
+# Upload negotiation (see /capabilities). Clients resize to `max_edge` and
+# encode as JPEG with this quality; images already that small are used as-is.
+UPLOAD_JPEG_QUALITY = 85
+
+def parse_mapping(value: str, cast) -> dict:
+    """Parses 'a=1,b=2' style environment overrides."""
+    pairs = (item.split("=", 1) for item in value.split(",") if item.strip())
+    return {key.strip(): cast(val.strip()) for key, val in pairs}
+
+# Image-token budget tiers and the tier each endpoint uses. Coarse safety
+# classifications need far fewer image tokens than free-form questions.
+# Override with e.g. IMAGE_TOKEN_TIERS="low=64,medium=256,high=961" and
+# ENDPOINT_TIERS="obstacles=low,crosswalk=medium,custom=high".
+IMAGE_TOKEN_TIERS = {
+    "low": 64,
+    "medium": 256,
+    "high": 961,
+    **parse_mapping(os.getenv("IMAGE_TOKEN_TIERS", ""), int),
+}
+ENDPOINT_TIERS = {
+    "obstacles": "medium",
+    "crosswalk": "medium",
+    "custom": "high",
+    **profile.get("endpoint_tiers", {}),
+    **parse_mapping(os.getenv("ENDPOINT_TIERS", ""), str),
+}
+for endpoint_name, tier_name in ENDPOINT_TIERS.items():
+    if tier_name not in IMAGE_TOKEN_TIERS:
+        raise ValueError(f"Unknown image-token tier '{tier_name}' for /{endpoint_name}")
+
+# Region-of-interest mode for /obstacles: crop to the lower-central walking
+# corridor before preprocessing. The crop box is cached per X-Session-Id so it
+# stays stable across the frames of one walk.
+OBSTACLE_ROI = os.getenv("OBSTACLE_ROI", "0") == "1"
+ROI_CONFIG = RoiConfig(
+    top=float(os.getenv("ROI_TOP", RoiConfig.top)),
+    width=float(os.getenv("ROI_WIDTH", RoiConfig.width)),
+    use_horizon=os.getenv("ROI_USE_HORIZON", "0") == "1",
+)
+roi_sessions = SessionCache(ttl_s=float(os.getenv("ROI_SESSION_TTL_S", "30")))
+
+# Decode with a reused static KV cache and a compiled decode step (see
+# generation.py) instead of `model.generate`. The cache must hold the longest
+# prompt (image tokens included) plus the output; longer requests use generate.
+STATIC_DECODE = os.getenv("STATIC_DECODE", "0") == "1"
+STATIC_CACHE_LEN = int(os.getenv("STATIC_CACHE_LEN", "2048"))
+engines = {}
+
+# Follow-up /custom questions about the same image reuse its encoded prefix
+# (vision encoder output and prefill state, see prefix_cache.py) instead of
+# re-uploading it. Prefixes are stored under an `image_id` returned by the first
+# call, only for clients that send X-Session-Id, and expire after
+# CUSTOM_PREFIX_TTL_S seconds. Opt-in: the app takes a new picture for every
+# question, so caching would only cost a split prefill and GPU memory.
+CUSTOM_PREFIX_CACHE = os.getenv("CUSTOM_PREFIX_CACHE", "0") == "1"
+image_prefixes = SessionCache(
+    ttl_s=float(os.getenv("CUSTOM_PREFIX_TTL_S", "120")),
+    max_sessions=int(os.getenv("CUSTOM_PREFIX_MAX", "32")),
+)
+
+# Opt-in capture of a sample of the live traffic for offline replay (see
+# capture.py and replay.py). Enabled by setting CAPTURE_DIR.
+CAPTURE_DIR = os.getenv("CAPTURE_DIR")
+capture = None
+if CAPTURE_DIR:
+    capture = TrafficCapture(
+        Path(CAPTURE_DIR),
+        sample_rate=float(os.getenv("CAPTURE_SAMPLE_RATE", "0.1")),
+        max_bytes=int(float(os.getenv("CAPTURE_MAX_MB", "500")) * 1024 * 1024),
+    )
+
+# Requests may carry `X-Deadline-Ms`, how long the client waits for the answer
+# (DEFAULT_DEADLINE_S applies otherwise and caps it; 0 = no default). Work for a
+# request past its deadline or whose client disconnected is dropped from the
+# queue or stopped mid-generation (see deadlines.py); /health reports the
+# wasted compute.
+DEFAULT_DEADLINE_S = float(os.getenv("DEFAULT_DEADLINE_S", "0")) or None
+waste = WasteCounters()
+
+# One processor per (model tier, image-token tier), loaded at startup; image
+# limits per image-token tier
+processors = {}
+image_limits = {}
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model, processor, device
+    global model, device, tiering
     
     # Authenticate with Hugging Face if a token is present
     hf_token = os.getenv("HF_TOKEN")
@@ -54,40 +214,33 @@ async def lifespan(app: FastAPI):
     device = "cuda" if use_cuda else "cpu"
     print(f"Server running on: {device}")
 
+    if TORCH_THREADS:
+        torch.set_num_threads(TORCH_THREADS)
+    if INFERENCE_WORKERS:
+        # asyncio.to_thread runs inference on the loop's default executor
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=INFERENCE_WORKERS))
+    print(f"Torch threads: {torch.get_num_threads()}, inference workers: {INFERENCE_WORKERS or 'default'}")
+
     try:
-        # Configure 4-bit quantization to reduce memory usage on the GPU
-        bnb_config = None
-        if use_cuda:
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.float16,
-                bnb_4bit_use_double_quant=True
-            )
+        bnb_config = make_quantization_config(QUANTIZATION, use_cuda)
 
-        print(f"Loading Configuration from: {BASE_ARCH_ID} ...")
-        # Load the architecture configuration from the original LiquidAI repository
-        # This ensures we have the correct Python code definitions for the model structure
-        config = AutoConfig.from_pretrained(BASE_ARCH_ID, trust_remote_code=True)
-        
-        print(f"Loading Weights from: {MY_MODEL_ID} ...")
-        # Load the actual fine-tuned weights from your repository
-        model = AutoModelForImageTextToText.from_pretrained(
-            MY_MODEL_ID,
-            config=config,
-            quantization_config=bnb_config if use_cuda else None,
-            device_map="auto" if use_cuda else "cpu",
-            dtype=torch.float16 if use_cuda else torch.float32,
-            trust_remote_code=True
-        )
+        for model_tier, (model_id, arch_id) in MODEL_TIERS.items():
+            models[model_tier] = load_model(model_id, arch_id, bnb_config, use_cuda)
+            if STATIC_DECODE:
+                engines[model_tier] = StaticDecodeEngine(models[model_tier], STATIC_CACHE_LEN)
+                print(f"Static decode for {model_tier} model: "
+                      f"{'enabled' if engines[model_tier].static else 'unsupported, using generate'}")
+        model = models[LARGE]
+        tiering = TieringPolicy(TieringConfig.from_env(), small_available=SMALL in models)
         
-        print(f"Loading processor from: {BASE_ARCH_ID} ...")
-        # Load the image processor (handles resizing and normalization)
-        processor = AutoProcessor.from_pretrained(
-            BASE_ARCH_ID, 
-            trust_remote_code=True,
-            max_image_tokens=961
-        )
+        # Load the image processors (handle resizing and normalization), one per
+        # image-token tier that an endpoint uses
+        for tier in sorted(set(ENDPOINT_TIERS.values())):
+            for model_tier in models:
+                get_processor(tier, model_tier)
+            image_limits[tier] = compute_image_limits(get_processor(tier))
+            print(f"Tier '{tier}': {IMAGE_TOKEN_TIERS[tier]} image tokens, "
+                  f"preferred upload size {image_limits[tier]['max_edge']}px")
         print("Model loaded successfully.")
 
     except Exception as e:
@@ -99,14 +252,121 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(title="Scene Assistant Backend", lifespan=lifespan)
 
-def run_inference_sync(image: Image.Image, prompt_text: str, system_prompt: str) -> str:
+def make_quantization_config(mode: str, use_cuda: bool):
+    """BitsAndBytes config for a QUANTIZATION mode; None when unquantized."""
+    if not use_cuda or mode == "none":
+        return None
+    if mode == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if mode == "4bit":
+        # 4-bit NF4 to reduce memory usage on the GPU
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True
+        )
+    raise ValueError(f"Unknown quantization mode '{mode}'")
+
+def load_model(model_id: str, arch_id: str, bnb_config, use_cuda: bool):
+    print(f"Loading Configuration from: {arch_id} ...")
+    # Load the architecture configuration from the original LiquidAI repository
+    # This ensures we have the correct Python code definitions for the model structure
+    config = AutoConfig.from_pretrained(arch_id, trust_remote_code=True)
+    
+    print(f"Loading Weights from: {model_id} ...")
+    # Load the actual fine-tuned weights from your repository
+    return AutoModelForImageTextToText.from_pretrained(
+        model_id,
+        config=config,
+        quantization_config=bnb_config if use_cuda else None,
+        device_map="auto" if use_cuda else "cpu",
+        dtype=torch.float16 if use_cuda else torch.float32,
+        trust_remote_code=True
+    )
+
+def get_processor(tier: str, model_tier: str = LARGE):
+    """Processor for an image-token tier of a model tier, created once and cached."""
+    key = (model_tier, tier)
+    if key not in processors:
+        arch_id = MODEL_TIERS[model_tier][1]
+        print(f"Loading processor from: {arch_id} ({tier}) ...")
+        processors[key] = AutoProcessor.from_pretrained(
+            arch_id,
+            trust_remote_code=True,
+            max_image_tokens=IMAGE_TOKEN_TIERS[tier]
+        )
+        # Batched generation needs the prompts right-aligned
+        processors[key].tokenizer.padding_side = "left"
+    return processors[key]
+
+def compute_image_limits(processor) -> dict:
+    """
+    Largest image edge worth uploading: the square that `max_image_tokens`
+    covers, as a multiple of the encoder patch size. Anything larger is
+    downscaled by the processor anyway.
+    """
+    image_processor = processor.image_processor
+    patch_multiple = getattr(image_processor, "encoder_patch_size", 16) * getattr(
+        image_processor, "downsample_factor", 2
+    )
+    max_tokens = image_processor.max_image_tokens
+    max_edge = math.isqrt(max_tokens) * patch_multiple
+    return {
+        "max_image_tokens": max_tokens,
+        "max_edge": max_edge,
+        "tile_size": getattr(image_processor, "tile_size", None),
+        "patch_multiple": patch_multiple,
+    }
+
+def decode_image(contents: bytes, tier: str) -> Image.Image:
+    """
+    Decodes an upload as RGB. Pre-resized uploads are used as they are; larger
+    ones are downscaled to `max_edge` here, letting the JPEG decoder skip
+    straight to a smaller scale instead of decoding every camera pixel.
+    """
+    img = Image.open(io.BytesIO(contents))
+    max_edge = image_limits[tier]["max_edge"]
+    if max(img.size) > max_edge:
+        img.draft("RGB", (max_edge, max_edge))
+        img = img.convert("RGB")
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        return img
+    return img.convert("RGB")
+
+def run_inference_sync(image: Image.Image, prompt_text: str, system_prompt: str, tier: str, model_tier: str = LARGE, stopping_criteria=None) -> str:
     
    # Helper function to run the model inference synchronously.
     #It prepares the inputs, generates the text, and decodes the output.
     
-    global processor, model
+    model = models[model_tier]
+    processor = processors[(model_tier, tier)]
+    
+    conversation = build_conversation(image, prompt_text, system_prompt)
     
-    conversation = [
+    text_prompt = processor.apply_chat_template(conversation, add_generation_prompt=True)
+    inputs = processor(images=[image], text=text_prompt, return_tensors="pt").to(model.device)
+
+    if model_tier in engines:
+        generated_ids = engines[model_tier].generate(inputs, max_new_tokens=15, stopping_criteria=stopping_criteria)
+    else:
+        with torch.no_grad():
+            output_ids = model.generate(
+                **inputs,
+                max_new_tokens=15, 
+                do_sample=False,
+                repetition_penalty=1.0,
+                stopping_criteria=stopping_criteria,
+            )
+
+        # Decode only the new tokens generated by the model
+        generated_ids = output_ids[:, inputs['input_ids'].shape[1]:]
+    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    
+    return generated_text.strip()
+
+def build_conversation(image: Image.Image, prompt_text: str, system_prompt: str) -> list:
+    return [
         {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
         {
             "role": "user",
@@ -116,40 +376,135 @@ def run_inference_sync(image: Image.Image, prompt_text: str, system_prompt: str)
             ],
         },
     ]
-    
-    text_prompt = processor.apply_chat_template(conversation, add_generation_prompt=True)
-    inputs = processor(images=[image], text=text_prompt, return_tensors="pt").to(model.device)
+
+def run_batch_inference_sync(images: List[Image.Image], prompt_text: str, system_prompt: str, tier: str, model_tier: str = LARGE, stopping_criteria=None) -> List[str]:
+    """
+    Runs several frames with the same prompt through one preprocessing call and
+    one left-padded `generate`, returning the answers in input order.
+    """
+    model = models[model_tier]
+    processor = processors[(model_tier, tier)]
+
+    text_prompt = processor.apply_chat_template(
+        build_conversation(images[0], prompt_text, system_prompt), add_generation_prompt=True
+    )
+    inputs = processor(
+        images=[[image] for image in images],
+        text=[text_prompt] * len(images),
+        padding=True,
+        return_tensors="pt",
+    ).to(model.device)
 
     with torch.no_grad():
         output_ids = model.generate(
             **inputs,
-            max_new_tokens=15, 
+            max_new_tokens=15,
             do_sample=False,
-            repetition_penalty=1.0 
+            repetition_penalty=1.0,
+            stopping_criteria=stopping_criteria,
         )
 
-    # Decode only the new tokens generated by the model
     generated_ids = output_ids[:, inputs['input_ids'].shape[1]:]
-    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    
-    return generated_text.strip()
-    
+    return [text.strip() for text in processor.batch_decode(generated_ids, skip_special_tokens=True)]
+
+def run_custom_sync(image: Optional[Image.Image], prompt_text: str, tier: str, model_tier: str, session_id: Optional[str], prefix, image_id: Optional[str], stopping_criteria=None) -> tuple:
+    """
+    Answers a /custom question from the cached image `prefix` when there is
+    one. A new image is first encoded and cached for sessions (see
+    prefix_cache.py). Returns (prefix, image_id, answer).
+    """
+    if prefix is None and CUSTOM_PREFIX_CACHE and session_id:
+        prefix = encode_image_prefix(
+            models[model_tier], processors[(model_tier, tier)], image, GENERAL_SYSTEM_PROMPT,
+            model_tier=model_tier, tier=tier, session_id=session_id,
+        )
+        image_id = uuid.uuid4().hex
+        image_prefixes.set(image_id, prefix)
+
+    if prefix is not None:
+        answer = generate_from_prefix(
+            models[model_tier], processors[(model_tier, tier)], prefix, prompt_text, stopping_criteria=stopping_criteria
+        )
+    else:
+        answer = run_inference_sync(image, prompt_text, GENERAL_SYSTEM_PROMPT, tier, model_tier, stopping_criteria)
+    return prefix, image_id, answer
+
+def run_with_context(context: RequestContext, fn, *args, **kwargs):
+    """Runs `fn` on an inference worker, unless `context` was abandoned while queued."""
+    with context.compute():
+        return fn(*args, **kwargs)
+
+def new_context(x_deadline_ms: Optional[str]) -> RequestContext:
+    return RequestContext(parse_deadline_ms(x_deadline_ms, DEFAULT_DEADLINE_S), waste)
 
+def abandoned_error(e: RequestAbandoned) -> HTTPException:
+    # 499 (client closed request) is never read by the client, it is for the logs
+    if str(e) == DISCONNECT:
+        return HTTPException(status_code=499, detail="Client disconnected")
+    return HTTPException(status_code=504, detail="Deadline exceeded")
 
+def batch_response(kind: str, results: List[str], mode: str, severity: List[str], confidence: float, model_tier: str, unlisted: Optional[str] = None) -> dict:
+    """Response for a burst of frames: every result in order, or only the most severe."""
+    if mode == "most_severe":
+        index = most_severe(results, severity, unlisted)
+        return {"type": kind, "mode": mode, "result": results[index], "index": index, "confidence": confidence, "model_tier": model_tier}
+    return {
+        "type": kind,
+        "mode": mode,
+        "results": [{"index": i, "result": result} for i, result in enumerate(results)],
+        "confidence": confidence,
+        "model_tier": model_tier,
+    }
 
-def clean_model_response(raw_text: str, valid_phrases: List[str], default_response: str) -> str:
+async def read_batch_images(files: List[UploadFile], mode: str, tier: str) -> tuple:
+    """Decoded frames, and the raw (bytes, content type) uploads for capture."""
+    if not files: raise HTTPException(status_code=400, detail="Missing file")
+    if len(files) > MAX_BATCH_IMAGES: raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IMAGES} images per batch")
+    if mode not in ("all", "most_severe"): raise HTTPException(status_code=400, detail="mode must be 'all' or 'most_severe'")
+    images, uploads = [], []
+    for file in files:
+        await validate_image(file)
+        contents = await file.read()
+        images.append(decode_image(contents, tier))
+        uploads.append((contents, file.content_type))
+    return images, uploads
+
+
+def clean_model_response(raw_text: str, normalizer: LabelNormalizer, default_response: str) -> str:
     """
-    Validates the model's output against a list of allowed phrases.
+    Validates the model's output against the normalizer's allowed labels.
     If the model hallucinates or is too verbose, it falls back to a default.
     """
-    raw_lower = raw_text.lower()
-    for phrase in valid_phrases:
-        if phrase.lower() in raw_lower:
-            return phrase
+    label = normalizer.normalize(raw_text)
+    if label is not None:
+        return label
     if len(raw_text) > 100:
         return default_response
     return raw_text
 
+def crop_obstacle_roi(image: Image.Image, session_id: Optional[str]) -> tuple:
+    """
+    Crops the image to the walking corridor. Clients that send a session id
+    reuse the box computed for their first frame until it expires.
+    """
+    box = roi_sessions.get(session_id) if session_id else None
+    if box is None:
+        box = compute_roi(image, ROI_CONFIG)
+        if session_id:
+            roi_sessions.set(session_id, box)
+    return crop_to_roi(image, box), box
+
+def begin_capture() -> Optional[tuple]:
+    """Arrival time and start of a request picked for capture, else None."""
+    if capture is None or not capture.sample():
+        return None
+    return time.time(), time.perf_counter()
+
+def end_capture(captured: Optional[tuple], endpoint: str, uploads: list, content: dict, session_id: Optional[str] = None, prompt: Optional[str] = None, fields: Optional[dict] = None) -> None:
+    if captured is not None:
+        arrival, start = captured
+        capture.record(endpoint, arrival, time.perf_counter() - start, uploads, content, session_id, prompt, fields)
+
 async def validate_image(file: Optional[UploadFile]) -> None:
     """
     Checks if the uploaded file is a valid image and within size limits.
@@ -163,102 +518,254 @@ async def validate_image(file: Optional[UploadFile]) -> None:
 
 @app.get("/health")
 def health_check():
-    return {"status": "OK", "model": MY_MODEL_ID}
+    return {
+        "status": "OK",
+        "model": MY_MODEL_ID,
+        "model_tiers": {name: ids[0] for name, ids in MODEL_TIERS.items()},
+        "tiering": tiering.snapshot(),
+        "wasted_compute": waste.snapshot(),
+    }
+
+@app.get("/capabilities")
+def capabilities():
+    """
+    Upload preferences, so clients can resize and compress images before
+    sending them instead of uploading full camera frames.
+    """
+    if not image_limits: raise HTTPException(status_code=503, detail="Model not loaded")
+    endpoints = {
+        name: {"tier": tier, **image_limits[tier]} for name, tier in ENDPOINT_TIERS.items()
+    }
+    largest = max(endpoints.values(), key=lambda limits: limits["max_edge"])
+    return {
+        **largest,
+        "endpoints": endpoints,
+        "formats": sorted(ALLOWED_IMAGE_TYPES),
+        "preferred_format": "image/jpeg",
+        "jpeg_quality": UPLOAD_JPEG_QUALITY,
+        "max_upload_bytes": MAX_IMAGE_BYTES,
+    }
 
 @app.post("/obstacles")
-async def obstacles(file: Optional[UploadFile] = File(None)):
+async def obstacles(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    x_session_id: Optional[str] = Header(None),
+    x_deadline_ms: Optional[str] = Header(None),
+):
     """
     Endpoint for detecting immediate dangers (cars, obstacles, etc.).
     Uses a strict prompt to force the model into specific classification categories.
     """
+    captured = begin_capture()
+    context = new_context(x_deadline_ms)
     await validate_image(file)
     if model is None: raise HTTPException(status_code=503, detail="Model not loaded")
     
     contents = await file.read()
-    image = Image.open(io.BytesIO(contents)).convert("RGB")
-    
-    prompt = (
-        "Analyze the path ahead. Output ONLY one of the following sentences:\n"
-        "- 'Caution: Car approaching'\n"
-        "- 'Caution: Obstacle on path'\n"
-        "- 'Clear: Path is safe'\n"
-        "- 'Caution: Unpaved surface'"
-    )
+    image = decode_image(contents, ENDPOINT_TIERS["obstacles"])
+    roi = None
+    if OBSTACLE_ROI:
+        image, roi = crop_obstacle_roi(image, x_session_id)
     
     try:
-        raw_response = await asyncio.to_thread(
-            run_inference_sync, image, prompt, SAFETY_SYSTEM_PROMPT
-        )
+        model_tier = tiering.choose("obstacles")
+        with tiering.track(model_tier):
+            async with watch_disconnect(request, context):
+                raw_response = await asyncio.to_thread(
+                    run_with_context, context, run_inference_sync, image, OBSTACLE_PROMPT, SAFETY_SYSTEM_PROMPT,
+                    ENDPOINT_TIERS["obstacles"], model_tier, stopping_criteria=context.stopping_criteria(),
+                )
         
-        valid_options = ["Caution: Car approaching", "Caution: Obstacle on path", "Clear: Path is safe", "Caution: Unpaved surface"]
-        clean_result = clean_model_response(raw_response, valid_options, "Caution: Unknown danger")
+        clean_result = clean_model_response(raw_response, OBSTACLE_LABELS, OBSTACLE_FALLBACK)
         
-        return JSONResponse(content={"type": "obstacle_detection", "result": clean_result, "confidence": 0.65})
+        content = {"type": "obstacle_detection", "result": clean_result, "confidence": 0.65, "model_tier": model_tier}
+        if roi is not None:
+            content["roi"] = roi.as_list()
+        end_capture(captured, "/obstacles", [(contents, file.content_type)], content, x_session_id)
+        return JSONResponse(content=content)
+    except RequestAbandoned as e:
+        raise abandoned_error(e)
     except Exception as e:
         print(f"Error in obstacles: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/crosswalk")
-async def crosswalk(file: Optional[UploadFile] = File(None)):
+async def crosswalk(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    x_session_id: Optional[str] = Header(None),
+    x_deadline_ms: Optional[str] = Header(None),
+):
     """
     Endpoint for detecting pedestrian crosswalks.
     """
+    captured = begin_capture()
+    context = new_context(x_deadline_ms)
     await validate_image(file)
     if model is None: raise HTTPException(status_code=503, detail="Model not loaded")
     
     contents = await file.read()
-    image = Image.open(io.BytesIO(contents)).convert("RGB")
-
-    prompt = "Check the path ahead for a pedestrian crosswalk."
-    system_prompt = (
-        "You are an advanced visual assistant for pedestrian safety.\n"
-        "Analyze the image and output ONLY one of the following classification labels:\n"
-        "- \"Safe crosswalk detected\": if a pedestrian crosswalk (white stripes) is clearly visible on the road.\n"
-        "- \"No crosswalk\": if no crosswalk is visible.\n"
-        "Do not provide explanations. Output only the label."
-    )
+    image = decode_image(contents, ENDPOINT_TIERS["crosswalk"])
     
     try:
-        raw_response = await asyncio.to_thread(
-            run_inference_sync, image, prompt, system_prompt
-        )
+        model_tier = tiering.choose("crosswalk")
+        with tiering.track(model_tier):
+            async with watch_disconnect(request, context):
+                raw_response = await asyncio.to_thread(
+                    run_with_context, context, run_inference_sync, image, CROSSWALK_PROMPT, CROSSWALK_SYSTEM_PROMPT,
+                    ENDPOINT_TIERS["crosswalk"], model_tier, stopping_criteria=context.stopping_criteria(),
+                )
 
         # Log the raw response for monitoring
         print(f"Debug Crosswalk Model: '{raw_response}'")
         
-        clean_response = raw_response.replace('"', '').strip()
-        if "Safe crosswalk detected" in clean_response:
-            clean_result = "Safe crosswalk detected"
-        else:
-            clean_result = "No crosswalk"
+        clean_result = CROSSWALK_LABELS.normalize(raw_response)
             
-        return JSONResponse(content={
+        content = {
             "type": "crosswalk_analysis", 
             "result": clean_result, 
-            "confidence": 0.90 
-        })
+            "confidence": 0.90,
+            "model_tier": model_tier,
+        }
+        end_capture(captured, "/crosswalk", [(contents, file.content_type)], content, x_session_id)
+        return JSONResponse(content=content)
+    except RequestAbandoned as e:
+        raise abandoned_error(e)
     except Exception as e:
         print(f"Error in crosswalk: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/obstacles/batch")
+async def obstacles_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    mode: str = Form("all"),
+    x_session_id: Optional[str] = Header(None),
+    x_deadline_ms: Optional[str] = Header(None),
+):
+    """
+    Obstacle check for a burst of frames in one request, run as one batch.
+    With mode=most_severe only the most severe answer is returned.
+    """
+    captured = begin_capture()
+    context = new_context(x_deadline_ms)
+    if model is None: raise HTTPException(status_code=503, detail="Model not loaded")
+    images, uploads = await read_batch_images(files, mode, ENDPOINT_TIERS["obstacles"])
+    if OBSTACLE_ROI:
+        images = [crop_obstacle_roi(image, x_session_id)[0] for image in images]
+
+    try:
+        model_tier = tiering.choose("obstacles")
+        with tiering.track(model_tier):
+            async with watch_disconnect(request, context):
+                raw_responses = await asyncio.to_thread(
+                    run_with_context, context, run_batch_inference_sync, images, OBSTACLE_PROMPT, SAFETY_SYSTEM_PROMPT,
+                    ENDPOINT_TIERS["obstacles"], model_tier, stopping_criteria=context.stopping_criteria(),
+                )
+
+        results = [clean_model_response(r, OBSTACLE_LABELS, OBSTACLE_FALLBACK) for r in raw_responses]
+        content = batch_response(
+            "obstacle_detection_batch", results, mode, OBSTACLE_SEVERITY, 0.65, model_tier, unlisted=OBSTACLE_FALLBACK
+        )
+        end_capture(captured, "/obstacles/batch", uploads, content, x_session_id, fields={"mode": mode})
+        return JSONResponse(content=content)
+    except RequestAbandoned as e:
+        raise abandoned_error(e)
+    except Exception as e:
+        print(f"Error in obstacles batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/crosswalk/batch")
+async def crosswalk_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    mode: str = Form("all"),
+    x_session_id: Optional[str] = Header(None),
+    x_deadline_ms: Optional[str] = Header(None),
+):
+    """
+    Crosswalk check for a burst of frames in one request, run as one batch.
+    With mode=most_severe only the most cautious answer is returned.
+    """
+    captured = begin_capture()
+    context = new_context(x_deadline_ms)
+    if model is None: raise HTTPException(status_code=503, detail="Model not loaded")
+    images, uploads = await read_batch_images(files, mode, ENDPOINT_TIERS["crosswalk"])
+
+    try:
+        model_tier = tiering.choose("crosswalk")
+        with tiering.track(model_tier):
+            async with watch_disconnect(request, context):
+                raw_responses = await asyncio.to_thread(
+                    run_with_context, context, run_batch_inference_sync, images, CROSSWALK_PROMPT, CROSSWALK_SYSTEM_PROMPT,
+                    ENDPOINT_TIERS["crosswalk"], model_tier, stopping_criteria=context.stopping_criteria(),
+                )
+
+        results = [CROSSWALK_LABELS.normalize(r) for r in raw_responses]
+        content = batch_response(
+            "crosswalk_analysis_batch", results, mode, CROSSWALK_SEVERITY, 0.90, model_tier
+        )
+        end_capture(captured, "/crosswalk/batch", uploads, content, x_session_id, fields={"mode": mode})
+        return JSONResponse(content=content)
+    except RequestAbandoned as e:
+        raise abandoned_error(e)
+    except Exception as e:
+        print(f"Error in crosswalk batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/custom")
-async def custom(file: Optional[UploadFile] = File(None), prompt: Optional[str] = Form(None)):
+async def custom(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    prompt: Optional[str] = Form(None),
+    image_id: Optional[str] = Form(None),
+    x_session_id: Optional[str] = Header(None),
+    x_deadline_ms: Optional[str] = Header(None),
+):
     """
     Endpoint for general user queries (e.g., 'What color is the shirt?').
+    Follow-up questions may send the `image_id` of an earlier answer instead of
+    the image; 410 means it expired and the image must be sent again.
     """
-    await validate_image(file)
+    captured = begin_capture()
+    context = new_context(x_deadline_ms)
+    prefix = None
+    if file is None and image_id:
+        prefix = image_prefixes.get(image_id)
+        if prefix is None or prefix.session_id != x_session_id:
+            raise HTTPException(status_code=410, detail="Image expired, send it again")
+    else:
+        await validate_image(file)
     if not prompt or not prompt.strip(): raise HTTPException(status_code=400, detail="Missing prompt")
     if model is None: raise HTTPException(status_code=503, detail="Model not loaded")
-    
-    contents = await file.read()
-    image = Image.open(io.BytesIO(contents)).convert("RGB")
-    
+
+    reused = prefix is not None
+    tier = prefix.tier if reused else ENDPOINT_TIERS["custom"]
+    uploads = [] if reused else [(await file.read(), file.content_type)]
+    image = None if reused else decode_image(uploads[0][0], tier)
+
     try:
-        response = await asyncio.to_thread(
-            run_inference_sync, image, prompt.strip(), GENERAL_SYSTEM_PROMPT
-        )
-        
-        return JSONResponse(content={"type": "custom_query", "prompt": prompt.strip(), "result": response, "confidence": 0.65})
+        model_tier = prefix.model_tier if reused else tiering.choose("custom")
+        with tiering.track(model_tier):
+            async with watch_disconnect(request, context):
+                # One unit of work, so the request is counted once in the waste counters
+                prefix, image_id, response = await asyncio.to_thread(
+                    run_with_context, context, run_custom_sync, image, prompt.strip(), tier, model_tier,
+                    x_session_id, prefix, image_id, stopping_criteria=context.stopping_criteria(),
+                )
+
+        content = {"type": "custom_query", "prompt": prompt.strip(), "result": response, "confidence": 0.65, "model_tier": model_tier}
+        if prefix is not None:
+            content.update({"image_id": image_id, "image_reused": reused})
+            if capture is not None and not reused:
+                # Every image id, so a sampled follow-up can be replayed even
+                # when the first question was not sampled
+                capture.remember_image_id(image_id, uploads[0][0])
+        end_capture(captured, "/custom", uploads, content, x_session_id, prompt.strip(), {"image_id": image_id if reused else None})
+        return JSONResponse(content=content)
+    except RequestAbandoned as e:
+        raise abandoned_error(e)
     except Exception as e:
         print(f"Error in custom: {e}")
         raise HTTPException(status_code=500, detail=str(e))
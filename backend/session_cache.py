@@ -0,0 +1,41 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class SessionCache:
+    """
+    Small thread-safe TTL cache keyed by client session id.
+
+    Entries expire `ttl_s` seconds after they were stored; when the cache is
+    full the least recently used session is dropped first.
+    """
+
+    def __init__(self, ttl_s: float = 30.0, max_sessions: int = 1024):
+        self.ttl_s = ttl_s
+        self.max_sessions = max_sessions
+        self._entries: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_s:
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return value
+
+    def set(self, session_id: str, value: Any) -> None:
+        with self._lock:
+            self._entries[session_id] = (time.monotonic(), value)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,221 @@
+"""
+Load-adaptive model tiering.
+
+The server keeps a small model resident next to the main one. `TieringPolicy`
+routes classification requests to the small model while the backend is
+saturated, judged by the number of requests in flight and the recent p95
+latency, and back to the large model once load drops and a cooldown passed.
+
+Run `python backend/tiering.py` to tune the thresholds against a simulated
+fake-latency model:
+
+    python backend/tiering.py --rate 1.5 --max-queue-depth 3 --max-p95 2.5
+"""
+
+import argparse
+import heapq
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+LARGE = "large"
+SMALL = "small"
+
+# Only coarse classifications may be served by the small model; free-form
+# questions always go to the large one.
+CLASSIFICATION_ENDPOINTS = {"obstacles", "crosswalk"}
+
+
+@dataclass
+class TieringConfig:
+    max_queue_depth: int = 4  # requests in flight before falling back
+    max_p95_s: float = 3.0  # recent p95 latency before falling back
+    window: int = 50  # completed requests the p95 is computed over
+    cooldown_s: float = 15.0  # minimum time on the small model once triggered
+
+    @classmethod
+    def from_env(cls) -> "TieringConfig":
+        return cls(
+            max_queue_depth=int(os.getenv("TIERING_MAX_QUEUE_DEPTH", cls.max_queue_depth)),
+            max_p95_s=float(os.getenv("TIERING_MAX_P95_S", cls.max_p95_s)),
+            window=int(os.getenv("TIERING_WINDOW", cls.window)),
+            cooldown_s=float(os.getenv("TIERING_COOLDOWN_S", cls.cooldown_s)),
+        )
+
+
+def percentile(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class TieringPolicy:
+    """
+    Chooses the model tier per request.
+
+    Call `choose` when a request arrives and wrap its inference in `track`, so
+    the policy sees the queue depth and the end-to-end latencies. `clock` is
+    injectable so the policy can be driven by simulated time.
+    """
+
+    def __init__(
+        self,
+        config: TieringConfig = TieringConfig(),
+        small_available: bool = True,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.config = config
+        self.small_available = small_available
+        self.clock = clock
+        self.in_flight = 0
+        self.latencies = deque(maxlen=config.window)
+        self.served = {LARGE: 0, SMALL: 0}
+        self._degraded_until = float("-inf")
+        self._lock = threading.Lock()
+
+    def recent_p95(self) -> Optional[float]:
+        return percentile(list(self.latencies), 95)
+
+    def overloaded(self) -> bool:
+        if self.in_flight >= self.config.max_queue_depth:
+            return True
+        p95 = self.recent_p95()
+        return p95 is not None and p95 > self.config.max_p95_s
+
+    def choose(self, endpoint: str) -> str:
+        if not self.small_available or endpoint not in CLASSIFICATION_ENDPOINTS:
+            return LARGE
+        with self._lock:
+            now = self.clock()
+            if self.overloaded():
+                self._degraded_until = now + self.config.cooldown_s
+            return SMALL if now < self._degraded_until else LARGE
+
+    def begin(self, model_tier: str):
+        with self._lock:
+            self.in_flight += 1
+            self.served[model_tier] += 1
+
+    def end(self, latency_s: float):
+        with self._lock:
+            self.in_flight -= 1
+            self.latencies.append(latency_s)
+
+    @contextmanager
+    def track(self, model_tier: str):
+        start = self.clock()
+        self.begin(model_tier)
+        try:
+            yield
+        finally:
+            self.end(self.clock() - start)
+
+    def snapshot(self) -> dict:
+        p95 = self.recent_p95()
+        return {
+            "in_flight": self.in_flight,
+            "recent_p95_s": round(p95, 3) if p95 is not None else None,
+            "degraded": self.clock() < self._degraded_until,
+            "served": dict(self.served),
+        }
+
+
+class FakeModel:
+    """Service time of a model tier: normally distributed around `mean_s`."""
+
+    def __init__(self, mean_s: float, jitter_s: float, rng: random.Random):
+        self.mean_s = mean_s
+        self.jitter_s = jitter_s
+        self.rng = rng
+
+    def service_time(self) -> float:
+        return max(0.01, self.rng.gauss(self.mean_s, self.jitter_s))
+
+
+def simulate(
+    policy: TieringPolicy,
+    models: dict,
+    rate: float,
+    n_requests: int,
+    seed: int = 0,
+    endpoint: str = "obstacles",
+) -> dict:
+    """
+    Discrete-event simulation of one GPU worker serving requests FIFO, with
+    Poisson arrivals at `rate` requests/s. Returns latency percentiles and the
+    share of requests each tier served.
+    """
+    rng = random.Random(seed)
+    now = [0.0]
+    policy.clock = lambda: now[0]
+
+    events = []  # (time, order, kind, payload)
+    arrival = 0.0
+    for i in range(n_requests):
+        arrival += rng.expovariate(rate)
+        heapq.heappush(events, (arrival, i, "arrive", None))
+
+    order = n_requests
+    worker_free_at = 0.0
+    latencies = []
+    while events:
+        now[0], _, kind, payload = heapq.heappop(events)
+        if kind == "arrive":
+            tier = policy.choose(endpoint)
+            policy.begin(tier)
+            start = max(now[0], worker_free_at)
+            worker_free_at = start + models[tier].service_time()
+            heapq.heappush(events, (worker_free_at, order, "done", now[0]))
+            order += 1
+        else:
+            latency = now[0] - payload
+            policy.end(latency)
+            latencies.append(latency)
+
+    return {
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "max_s": max(latencies),
+        "small_share": policy.served[SMALL] / n_requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the model tiering policy")
+    parser.add_argument("--rate", type=float, default=1.5, help="arrivals per second")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--large-latency", type=float, default=0.8)
+    parser.add_argument("--small-latency", type=float, default=0.25)
+    parser.add_argument("--max-queue-depth", type=int, default=TieringConfig.max_queue_depth)
+    parser.add_argument("--max-p95", type=float, default=TieringConfig.max_p95_s)
+    parser.add_argument("--window", type=int, default=TieringConfig.window)
+    parser.add_argument("--cooldown", type=float, default=TieringConfig.cooldown_s)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = TieringConfig(args.max_queue_depth, args.max_p95, args.window, args.cooldown)
+    rng = random.Random(args.seed)
+    models = {
+        LARGE: FakeModel(args.large_latency, args.large_latency * 0.15, rng),
+        SMALL: FakeModel(args.small_latency, args.small_latency * 0.15, rng),
+    }
+
+    print(f"Arrival rate {args.rate}/s, {args.requests} requests")
+    for name, small_available in [("large only", False), ("tiered", True)]:
+        policy = TieringPolicy(config, small_available=small_available)
+        result = simulate(policy, models, args.rate, args.requests, seed=args.seed)
+        print(
+            f"{name:>10}: p50 {result['p50_s']:.2f}s  p95 {result['p95_s']:.2f}s  "
+            f"max {result['max_s']:.2f}s  small model {result['small_share']:.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import 'dart:async';
 import 'dart:convert';
+import 'dart:math';
+import 'dart:typed_data';
+import 'dart:ui' as ui;
 import 'package:camera/camera.dart';
 import 'package:http/http.dart' as http;
 import 'package:http_parser/http_parser.dart';
@@ -14,6 +17,69 @@ class ApiException implements Exception {
   String toString() => message;
 }
 
+/// Upload preferences advertised by the backend's `/capabilities` endpoint.
+class ServerCapabilities {
+  const ServerCapabilities({
+    required this.maxEdge,
+    required this.jpegQuality,
+    required this.maxUploadBytes,
+    this.endpointMaxEdges = const {},
+  });
+
+  factory ServerCapabilities.fromJson(Map<String, dynamic> json) {
+    final endpoints = json['endpoints'];
+    return ServerCapabilities(
+      maxEdge: (json['max_edge'] as num).toInt(),
+      jpegQuality: (json['jpeg_quality'] as num?)?.toInt() ?? 85,
+      maxUploadBytes: (json['max_upload_bytes'] as num?)?.toInt() ?? 10 * 1024 * 1024,
+      endpointMaxEdges: endpoints is Map<String, dynamic>
+          ? {
+              for (final entry in endpoints.entries)
+                '/${entry.key}': ((entry.value as Map)['max_edge'] as num).toInt(),
+            }
+          : const {},
+    );
+  }
+
+  final int maxEdge;
+  final int jpegQuality;
+  final int maxUploadBytes;
+
+  /// Max edge per endpoint path (e.g. `/obstacles`), since endpoints may use
+  /// different image-token tiers.
+  final Map<String, int> endpointMaxEdges;
+
+  int maxEdgeFor(String endpoint) => endpointMaxEdges[endpoint] ?? maxEdge;
+}
+
+/// Downscales [bytes] so the longest edge is at most [maxEdge], using the
+/// engine's image codec. It can only encode PNG, so the result is returned only
+/// when it is smaller than [bytes]. Returns null when the image is already small
+/// enough or the PNG would be larger; the original is then sent as-is.
+Future<Uint8List?> _resizeForUpload(Uint8List bytes, int maxEdge) async {
+  final buffer = await ui.ImmutableBuffer.fromUint8List(bytes);
+  final descriptor = await ui.ImageDescriptor.encoded(buffer);
+  try {
+    final width = descriptor.width;
+    final height = descriptor.height;
+    if ((width > height ? width : height) <= maxEdge) return null;
+
+    final codec = await descriptor.instantiateCodec(
+      targetWidth: width >= height ? maxEdge : null,
+      targetHeight: width >= height ? null : maxEdge,
+    );
+    final frame = await codec.getNextFrame();
+    final png = await frame.image.toByteData(format: ui.ImageByteFormat.png);
+    frame.image.dispose();
+    codec.dispose();
+    if (png == null || png.lengthInBytes >= bytes.length) return null;
+    return png.buffer.asUint8List(png.offsetInBytes, png.lengthInBytes);
+  } finally {
+    descriptor.dispose();
+    buffer.dispose();
+  }
+}
+
 class ApiClient {
   ApiClient({String? baseUrl, http.Client? client})
       : baseUrl = baseUrl ?? defaultBaseUrl,
@@ -31,11 +97,47 @@ class ApiClient {
   final String baseUrl;
   final http.Client _client;
 
-  // Increased timeout for CPU inference which can take 60-120 seconds
+  /// Sent as `X-Session-Id` so the server can keep per-session state (e.g. a
+  /// stable region-of-interest crop) across the frames of one walk.
+  final String sessionId = _newSessionId();
+
+  static String _newSessionId() {
+    final random = Random.secure();
+    return List.generate(16, (_) => random.nextInt(256).toRadixString(16).padLeft(2, '0')).join();
+  }
+
+  // Increased timeout for CPU inference which can take 60-120 seconds. Also
+  // sent as `X-Deadline-Ms` so the server stops work the client gave up on.
   static const Duration _timeout = Duration(seconds: 400);
 
   Uri _uri(String path) => Uri.parse('$baseUrl$path');
 
+  // Fetched once per client; null until the server has answered.
+  Future<ServerCapabilities?>? _capabilities;
+
+  /// Upload preferences from `/capabilities`, or null if the server does not
+  /// provide them (images are then uploaded unchanged).
+  Future<ServerCapabilities?> capabilities() {
+    return _capabilities ??= _fetchCapabilities();
+  }
+
+  Future<ServerCapabilities?> _fetchCapabilities() async {
+    try {
+      final response = await _client
+          .get(_uri('/capabilities'))
+          .timeout(const Duration(seconds: 10));
+      if (response.statusCode == 200) {
+        return ServerCapabilities.fromJson(_decodeJsonObject(response.body));
+      }
+      print('API Client: /capabilities returned ${response.statusCode}');
+    } catch (e) {
+      print('API Client: Could not fetch capabilities: $e');
+    }
+    // Retry on the next request instead of caching the failure
+    _capabilities = null;
+    return null;
+  }
+
   /// Sends only an image to `/obstacles`.
   Future<Map<String, dynamic>> sendObstacles(XFile file) async {
     return _sendImageOnly('/obstacles', file);
@@ -46,13 +148,57 @@ class ApiClient {
     return _sendImageOnly('/crosswalk', file);
   }
 
+  /// Sends a burst of frames to `/obstacles/batch`. With [mostSevere] the server
+  /// answers with the single most severe result instead of one per frame.
+  Future<Map<String, dynamic>> sendObstaclesBatch(List<XFile> files, {bool mostSevere = false}) async {
+    return _sendBatch('/obstacles/batch', files, mostSevere);
+  }
+
+  /// Sends a burst of frames to `/crosswalk/batch`.
+  Future<Map<String, dynamic>> sendCrosswalkBatch(List<XFile> files, {bool mostSevere = false}) async {
+    return _sendBatch('/crosswalk/batch', files, mostSevere);
+  }
+
   /// Sends an image + prompt string to `/custom`.
   Future<Map<String, dynamic>> sendCustom(XFile file, String prompt) async {
     final uri = _uri('/custom');
     print('API Client: Sending request to $uri');
     
     final request = http.MultipartRequest('POST', uri);
-    request.files.add(await _imagePart(file));
+    request.headers['X-Session-Id'] = sessionId;
+    request.headers['X-Deadline-Ms'] = '${_timeout.inMilliseconds}';
+    request.files.add(await _imagePart(file, '/custom'));
+    request.fields['prompt'] = prompt;
+
+    try {
+      final streamed = await _client.send(request).timeout(_timeout);
+      final body = await streamed.stream.bytesToString();
+
+      if (streamed.statusCode >= 200 && streamed.statusCode < 300) {
+        return _decodeJsonObject(body);
+      }
+
+      throw _exceptionFromBody(streamed.statusCode, body);
+    } on TimeoutException {
+      print('API Client: Request to $uri timed out after ${_timeout.inSeconds} seconds');
+      throw ApiException('Request timed out. The server may be slow or unreachable. Check your connection and ensure the backend is running.', statusCode: 408);
+    } on http.ClientException catch (e) {
+      print('API Client: Network error connecting to $uri: $e');
+      throw ApiException('Cannot connect to server at $baseUrl. Make sure the backend is running and the URL is correct.', statusCode: null);
+    }
+  }
+
+  /// Asks another question about the image of an earlier `/custom` answer,
+  /// sending only its `image_id`. Falls back to re-uploading [file] when the
+  /// server no longer has the image (HTTP 410).
+  Future<Map<String, dynamic>> sendCustomFollowUp(String imageId, String prompt, XFile file) async {
+    final uri = _uri('/custom');
+    print('API Client: Sending follow-up to $uri');
+
+    final request = http.MultipartRequest('POST', uri);
+    request.headers['X-Session-Id'] = sessionId;
+    request.headers['X-Deadline-Ms'] = '${_timeout.inMilliseconds}';
+    request.fields['image_id'] = imageId;
     request.fields['prompt'] = prompt;
 
     try {
@@ -62,6 +208,9 @@ class ApiClient {
       if (streamed.statusCode >= 200 && streamed.statusCode < 300) {
         return _decodeJsonObject(body);
       }
+      if (streamed.statusCode == 410) {
+        return sendCustom(file, prompt);
+      }
 
       throw _exceptionFromBody(streamed.statusCode, body);
     } on TimeoutException {
@@ -78,7 +227,41 @@ class ApiClient {
     print('API Client: Sending request to $uri');
     
     final request = http.MultipartRequest('POST', uri);
-    request.files.add(await _imagePart(file));
+    request.headers['X-Session-Id'] = sessionId;
+    request.headers['X-Deadline-Ms'] = '${_timeout.inMilliseconds}';
+    request.files.add(await _imagePart(file, endpoint));
+
+    try {
+      final streamed = await _client.send(request).timeout(_timeout);
+      final body = await streamed.stream.bytesToString();
+
+      if (streamed.statusCode >= 200 && streamed.statusCode < 300) {
+        return _decodeJsonObject(body);
+      }
+
+      throw _exceptionFromBody(streamed.statusCode, body);
+    } on TimeoutException {
+      print('API Client: Request to $uri timed out after ${_timeout.inSeconds} seconds');
+      throw ApiException('Request timed out. The server may be slow or unreachable. Check your connection and ensure the backend is running.', statusCode: 408);
+    } on http.ClientException catch (e) {
+      print('API Client: Network error connecting to $uri: $e');
+      throw ApiException('Cannot connect to server at $baseUrl. Make sure the backend is running and the URL is correct.', statusCode: null);
+    }
+  }
+
+  Future<Map<String, dynamic>> _sendBatch(String endpoint, List<XFile> files, bool mostSevere) async {
+    final uri = _uri(endpoint);
+    print('API Client: Sending ${files.length} frames to $uri');
+
+    final request = http.MultipartRequest('POST', uri);
+    request.headers['X-Session-Id'] = sessionId;
+    request.headers['X-Deadline-Ms'] = '${_timeout.inMilliseconds}';
+    // Resize for the single-frame endpoint; the batch uses the same tier.
+    final singleEndpoint = endpoint.replaceAll('/batch', '');
+    for (final file in files) {
+      request.files.add(await _imagePart(file, singleEndpoint, field: 'files'));
+    }
+    request.fields['mode'] = mostSevere ? 'most_severe' : 'all';
 
     try {
       final streamed = await _client.send(request).timeout(_timeout);
@@ -120,7 +303,24 @@ class ApiClient {
     }
   }
 
-  Future<http.MultipartFile> _imagePart(XFile file) async {
+  Future<http.MultipartFile> _imagePart(XFile file, String endpoint, {String field = 'file'}) async {
+    // Resize on the phone to what the server actually uses, so we don't upload
+    // (and the server doesn't decode) full-resolution camera frames.
+    final caps = await capabilities();
+    if (caps != null) {
+      final bytes = await file.readAsBytes();
+      final resized = await _resizeForUpload(bytes, caps.maxEdgeFor(endpoint));
+      if (resized != null) {
+        print('API Client: Resized upload ${bytes.length} -> ${resized.length} bytes');
+        return http.MultipartFile.fromBytes(
+          field,
+          resized,
+          filename: 'image.png',
+          contentType: MediaType('image', 'png'),
+        );
+      }
+    }
+
     // package:http defaults to application/octet-stream; our backend validates
     // content-type, so we must set it correctly.
     final lower = file.path.toLowerCase();
@@ -133,7 +333,7 @@ class ApiClient {
     }
 
     return http.MultipartFile.fromPath(
-      'file',
+      field,
       file.path,
       contentType: contentType,
     );